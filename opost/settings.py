@@ -1,6 +1,7 @@
 """Django settings for the opost project."""
 import environ
 import os
+from importlib.util import find_spec
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -37,6 +38,7 @@ INSTALLED_APPS += [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",  # Various request validators
+    "postapi.middleware.CompressionMiddleware",  # Compresses API responses
     "django.contrib.sessions.middleware.SessionMiddleware",  # Creates and loads session state as needed
     "django.middleware.common.CommonMiddleware",  # Tweaks for perfectionists
     "django.middleware.csrf.CsrfViewMiddleware",  # CSRF protection
@@ -67,6 +69,20 @@ WSGI_APPLICATION = "opost.wsgi.application"
 
 DATABASES = {"default": env.db_url()}
 
+# Post bodies rendered from Markdown to HTML are cached in "markdown", keyed
+# by their text and the renderer's version, so each body is rendered once
+# per process. Point it at a shared cache, such as memcached, to render each
+# body once for the whole site.
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "markdown": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "markdown",
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
 _PASSWORD_VALIDATORS = [
     "UserAttributeSimilarity",
     "MinimumLength",
@@ -110,6 +126,16 @@ LOGGING = {
             "level": "ERROR",
             "propagate": True,
         },
+        "postapi.agents": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": True,
+        },
+        "postapi.delivery": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": True,
+        },
         "postweb.services": {
             "handlers": ["console"],
             "level": "DEBUG",
@@ -144,8 +170,79 @@ REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticatedOrReadOnly"
     ],
+    # Lists are paged by keyset; see postapi.pagination. Each list view's
+    # ordering attribute gives the order to page in.
+    "DEFAULT_PAGINATION_CLASS": "postapi.pagination.KeysetPagination",
+    "PAGE_SIZE": 100,
+    # JSON is rendered and parsed with orjson when it's installed, and
+    # MessagePack is offered when msgpack is installed.
+    "DEFAULT_RENDERER_CLASSES": [
+        "postapi.renderers.ORJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ]
+    + (["postapi.renderers.MessagePackRenderer"] if find_spec("msgpack") else []),
+    "DEFAULT_PARSER_CLASSES": [
+        "postapi.parsers.ORJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ]
+    + (["postapi.parsers.MessagePackParser"] if find_spec("msgpack") else []),
 }
 
+# Limits on the work done by a single sync action. Progress is committed in
+# chunks, so a sync that runs out of budget can be resumed by syncing again.
+POSTAPI_SYNC_CHUNK_SIZE = 1000
+POSTAPI_SYNC_MAX_ROWS = 10000
+POSTAPI_SYNC_MAX_SECONDS = 5.0
+
+# Whether the deliver actions queue posts for delivery by run_delivery_queue
+# (and answer 202 with a receipt) when the request doesn't say.
+POSTAPI_DEFER_DELIVERY = False
+
+# Hybrid push/pull fan-out: posts delivered to a box are pushed right away
+# to the targets of its subscriptions that have been active within this many
+# seconds; other targets pull them when they sync. None turns pushing off.
+POSTAPI_PUSH_ACTIVE_WITHIN = None
+
+# Deliveries that fail are parked and retried with exponential backoff: the
+# first retry comes after the base delay, and each later one waits twice as
+# long, up to the maximum delay. After the maximum number of attempts, the
+# delivery is given up on.
+POSTAPI_RETRY_BASE_DELAY = 30.0
+POSTAPI_RETRY_MAX_DELAY = 6 * 60 * 60.0
+POSTAPI_RETRY_MAX_ATTEMPTS = 10
+
+# The number of posts the batch deliver action creates per transaction.
+POSTAPI_BATCH_SIZE = 500
+
+# The number of rows an export fetches from the database at a time.
+POSTAPI_EXPORT_CHUNK_SIZE = 2000
+
+# The number of input rows the import_mail command loads and merges per
+# transaction.
+POSTAPI_IMPORT_CHUNK_SIZE = 10000
+
+# Whether list views build their pages from .values() rows and URL templates
+# rather than through the serializers. The output is the same either way.
+POSTAPI_FAST_LISTS = True
+
+# Box name autocompletion returns at most this many names, and caches the
+# names for this many of the most recently used prefixes, each for this many
+# seconds. Creating or deleting a box clears its prefixes right away, but
+# only in the process that did it.
+POSTAPI_AUTOCOMPLETE_LIMIT = 10
+POSTAPI_AUTOCOMPLETE_CACHE_SIZE = 1024
+POSTAPI_AUTOCOMPLETE_CACHE_TTL = 60.0
+
+# Whether new posts keep their bodies in the body store, where identical
+# bodies are saved once, and bodies of at least POSTAPI_BODY_COMPRESS_MIN
+# bytes are compressed. The compression is "zstd" or "zlib"; None picks zstd
+# if the zstandard package is installed. The body_storage command reports
+# the savings, and moves existing bodies into the store.
+POSTAPI_BODY_STORE = False
+POSTAPI_BODY_COMPRESS_MIN = 256
+POSTAPI_BODY_COMPRESSION = None
+
 SERVICES = {
     "postapi": {
         "endpoint": "http://localhost:5100/postapi/",
@@ -13,6 +13,16 @@ class DeliveredPostAdmin(admin.ModelAdmin):
     pass
 
 
+@admin.register(postapi.DeliveryJob)
+class DeliveryJobAdmin(admin.ModelAdmin):
+    pass
+
+
+@admin.register(postapi.DeliveryRetry)
+class DeliveryRetryAdmin(admin.ModelAdmin):
+    pass
+
+
 @admin.register(postapi.Post)
 class PostAdmin(admin.ModelAdmin):
     pass
@@ -0,0 +1,214 @@
+"""Background agents that keep mail moving outside of API requests.
+
+An agent runs a series of passes. Each pass picks a batch of work from the
+database, hands it to a pool of worker threads, and waits for the batch to
+finish before picking the next one. When there's nothing to do, or none of
+the batch could be done because other agents hold its locks, the agent
+sleeps for an interval before looking again.
+"""
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from postapi import delivery
+from postapi.models import Box
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """A fixed set of threads that run jobs from a queue.
+
+    Each thread uses its own database connection, which is closed when the
+    thread exits, and replaced between jobs if it has gone bad, as it is
+    between requests. Once the stop event is set, jobs that haven't started
+    yet are dropped, and jobs already running are allowed to finish.
+
+    The handler returns whether the job got anything done.
+    """
+
+    def __init__(self, handler, workers, stop_event):
+        self.handler = handler
+        self.stop_event = stop_event
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.progress = 0
+        self.threads = [
+            threading.Thread(target=self._work, name=f"worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, job):
+        self.jobs.put(job)
+
+    def wait(self):
+        """Wait for every submitted job to finish (or be dropped).
+
+        Returns how many jobs got something done since the last wait.
+        """
+
+        self.jobs.join()
+        with self.lock:
+            progress, self.progress = self.progress, 0
+        return progress
+
+    def shutdown(self):
+        """Stop the workers once they're done with their current jobs."""
+
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        try:
+            while True:
+                job = self.jobs.get()
+                try:
+                    if job is None:
+                        return
+                    if not self.stop_event.is_set():
+                        close_old_connections()
+                        try:
+                            if self.handler(job):
+                                with self.lock:
+                                    self.progress += 1
+                        finally:
+                            close_old_connections()
+                except Exception:
+                    logger.exception("Job failed: %s", job)
+                finally:
+                    self.jobs.task_done()
+        finally:
+            connection.close()
+
+
+class Agent(object):
+    """Base class for agents. Subclasses implement next_batch and handle."""
+
+    def __init__(self, workers=4, interval=5.0):
+        self.workers = workers
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def next_batch(self):
+        """Return a list of jobs to run in the next pass."""
+
+        raise NotImplementedError
+
+    def handle(self, job):
+        """Run a single job. Called from a worker thread.
+
+        Returns whether the job got anything done.
+        """
+
+        raise NotImplementedError
+
+    def stop(self):
+        """Ask the agent to shut down once its in-flight jobs are done."""
+
+        self.stop_event.set()
+
+    def run_pass(self, pool):
+        """Run one batch of jobs to completion. Returns how many got anything done."""
+
+        close_old_connections()
+        jobs = self.next_batch()
+        for job in jobs:
+            pool.submit(job)
+        return pool.wait()
+
+    def run(self, once=False):
+        """Run passes until stopped (or just one, if once is set)."""
+
+        pool = WorkerPool(self.handle, self.workers, self.stop_event)
+        pool.start()
+        try:
+            while not self.stop_event.is_set():
+                progress = self.run_pass(pool)
+                if once:
+                    break
+                if progress == 0:
+                    self.stop_event.wait(self.interval)
+        finally:
+            pool.shutdown()
+
+
+class DeliveryAgent(Agent):
+    """Keeps subscription watermarks advancing in the background.
+
+    Each pass syncs a batch of boxes with pending subscription posts, most
+    recently active boxes first, so that inbox reads mostly find their box
+    already up to date.
+    """
+
+    def __init__(self, batch_size=100, active_within=None, **kwargs):
+        super(DeliveryAgent, self).__init__(**kwargs)
+        self.batch_size = batch_size
+        self.active_within = active_within
+
+    def next_batch(self):
+        active_since = None
+        if self.active_within is not None:
+            active_since = timezone.now() - self.active_within
+        boxes = delivery.pending_boxes(self.batch_size, active_since)
+        return list(boxes.values_list("id", flat=True))
+
+    def handle(self, box_id):
+        box = Box.objects.get(id=box_id)
+        # Bound each sync so one huge backlog doesn't hold up the whole pass;
+        # a box with posts still pending is picked up again next pass.
+        result = delivery.sync_box(box, max_rows=settings.POSTAPI_SYNC_MAX_ROWS)
+        logger.debug("Delivered %d posts to %s", result.delivered, box.name)
+        # Nothing is scanned if other agents hold all of the box's subscriptions.
+        return result.scanned > 0
+
+
+class DeliveryQueueAgent(Agent):
+    """Works through the queue of deferred deliveries, oldest first.
+
+    Jobs are locked while they run, so several queue agents can share the
+    queue without delivering a post twice.
+    """
+
+    def __init__(self, batch_size=100, **kwargs):
+        super(DeliveryQueueAgent, self).__init__(**kwargs)
+        self.batch_size = batch_size
+
+    def next_batch(self):
+        return list(delivery.pending_jobs(self.batch_size).values_list("id", flat=True))
+
+    def handle(self, job_id):
+        ran = delivery.run_job(job_id)
+        if ran:
+            logger.debug("Ran delivery job %d", job_id)
+        return ran
+
+
+class DeliveryRetryAgent(Agent):
+    """Retries failed deliveries as they come due.
+
+    Each retry that fails again is rescheduled with a longer delay, until it
+    runs out of attempts.
+    """
+
+    def __init__(self, batch_size=100, **kwargs):
+        super(DeliveryRetryAgent, self).__init__(**kwargs)
+        self.batch_size = batch_size
+
+    def next_batch(self):
+        return list(delivery.due_retries(self.batch_size).values_list("id", flat=True))
+
+    def handle(self, retry_id):
+        retried = delivery.retry_delivery(retry_id)
+        if retried:
+            logger.debug("Retried delivery %d", retry_id)
+        return retried
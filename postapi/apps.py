@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PostapiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "postapi"
+
+    def ready(self):
+        # Connect the signal receivers that keep the autocomplete cache fresh.
+        from postapi import autocomplete  # noqa: F401
@@ -0,0 +1,96 @@
+"""Box name autocompletion, with an in-process cache of hot prefixes.
+
+Every keystroke in an address field asks for the names starting with what's
+been typed so far, and most of those prefixes are short and shared, so the
+names found for each prefix are kept in a small least-recently-used cache.
+Creating or deleting a box drops the cached prefixes of its name, through
+the model signals connected in PostapiConfig.ready. Those signals only
+reach this process, so entries also expire after a while, which bounds how
+stale other processes' caches can be.
+"""
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.functions import Lower
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from postapi.models import Box
+
+
+class PrefixCache(object):
+    """A thread-safe LRU cache of names by prefix, whose entries expire."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, prefix):
+        """The cached names for the prefix, or None if they aren't cached."""
+
+        with self.lock:
+            entry = self.entries.get(prefix)
+            if entry is None:
+                return None
+            expires, names = entry
+            if expires <= time.monotonic():
+                del self.entries[prefix]
+                return None
+            self.entries.move_to_end(prefix)
+            return names
+
+    def set(self, prefix, names):
+        with self.lock:
+            self.entries[prefix] = (time.monotonic() + self.ttl, names)
+            self.entries.move_to_end(prefix)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard_prefixes_of(self, name):
+        """Drop the entries for every prefix of the name, which may now be wrong."""
+
+        with self.lock:
+            for i in range(len(name) + 1):
+                self.entries.pop(name[:i], None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = PrefixCache(
+    settings.POSTAPI_AUTOCOMPLETE_CACHE_SIZE, settings.POSTAPI_AUTOCOMPLETE_CACHE_TTL
+)
+
+
+def box_names(prefix, limit=None):
+    """The names of boxes starting with the prefix, ignoring case, in order.
+
+    At most POSTAPI_AUTOCOMPLETE_LIMIT names are looked up and cached for a
+    prefix, and a smaller limit takes the first of those.
+    """
+
+    max_limit = settings.POSTAPI_AUTOCOMPLETE_LIMIT
+    limit = max_limit if limit is None else min(limit, max_limit)
+    prefix = prefix.lower()
+    names = cache.get(prefix)
+    if names is None:
+        boxes = Box.objects.name_prefix(prefix).order_by(Lower("name"), "name")
+        names = tuple(boxes.values_list("name", flat=True)[:max_limit])
+        cache.set(prefix, names)
+    return list(names[:limit])
+
+
+@receiver(post_save, sender=Box, dispatch_uid="postapi_autocomplete_box_saved")
+def box_saved(sender, instance, created, **kwargs):
+    if created:
+        cache.discard_prefixes_of(instance.name.lower())
+
+
+@receiver(post_delete, sender=Box, dispatch_uid="postapi_autocomplete_box_deleted")
+def box_deleted(sender, instance, **kwargs):
+    cache.discard_prefixes_of(instance.name.lower())
@@ -0,0 +1,426 @@
+"""Benchmarks for the postapi delivery engine.
+
+These are not part of the regular test suite (the test runner only discovers
+test*.py modules). Run them explicitly against a test database with:
+
+    python manage.py test postapi.benchmarks
+
+Results are written to stdout as simple tables.
+"""
+import json
+import sys
+import threading
+import time
+import unittest
+
+import django.test
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import FloatField, Value
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from postapi import delivery, search
+from postapi.fastlists import Links
+from postapi.models import Box, DeliveredPost, Post, Subscription
+from postapi.pagination import KeysetPagination
+from postapi.serializers import DeliveredPostSerializer
+from postapi.views import DeliveredPostList
+
+BACKLOG_SIZES = (10, 100, 1000, 10000)
+
+THREAD_COUNTS = (1, 2, 4, 8)
+
+BATCH_POSTS = 1000
+
+PAGE_DEPTHS = (0, 100, 1000)
+
+SERIALIZE_ROWS = (100, 1000, 10000)
+
+SEARCH_CORPUS = 2000000
+
+# Words per post, and how many different words there are. Words are drawn
+# with a skewed distribution, so a few are common and most are rare.
+SEARCH_POST_WORDS = 30
+SEARCH_VOCABULARY = 20000
+
+# The row-at-a-time loop is too slow to bother with past this size.
+LEGACY_MAX_BACKLOG = 1000
+
+
+def report(title, header, rows):
+    """Write a benchmark result table to stdout."""
+
+    out = sys.stdout
+    out.write(f"\n{title}\n")
+    out.write(" | ".join(f"{col:>12}" for col in header) + "\n")
+    for row in rows:
+        out.write(" | ".join(f"{col:>12}" for col in row) + "\n")
+    out.flush()
+
+
+def create_backlog(sender, source, count):
+    """Deliver the given number of new posts to the source box."""
+
+    posts = Post.objects.bulk_create(
+        Post(sender=sender, subject=f"Post {i}", body="Hello!") for i in range(count)
+    )
+    DeliveredPost.objects.bulk_create(
+        DeliveredPost(
+            box=source,
+            post=post,
+            post_sender=sender,
+            post_created=post.created,
+            post_subject=post.subject,
+        )
+        for post in posts
+    )
+
+
+def legacy_sync_box(box):
+    """The original row-at-a-time subscription sync, kept for comparison."""
+
+    for sub in Subscription.objects.filter(target=box):
+        dposts = DeliveredPost.objects.filter(
+            box=sub.source, id__gt=sub.watermark
+        ).order_by("id")
+        new_watermark = sub.watermark
+        for dpost in dposts:
+            DeliveredPost.objects.get_or_create(
+                box=box,
+                post=dpost.post,
+                post_sender=dpost.post.sender,
+                post_created=dpost.post.created,
+                post_subject=dpost.post.subject,
+            )
+            new_watermark = dpost.id
+        sub.watermark = new_watermark
+        sub.save()
+
+
+class SyncBenchmark(django.test.TestCase):
+    """How sync latency grows with the size of a subscription's backlog."""
+
+    def setUp(self):
+        self.sender = User.objects.create(username="bench")
+
+    def time_sync(self, sync_fn, name, count):
+        source = Box.objects.create(name=f"{name}-source-{count}")
+        target = Box.objects.create(name=f"{name}-target-{count}")
+        Subscription.objects.create(source=source, target=target)
+        create_backlog(self.sender, source, count)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            sync_fn(target)
+            elapsed = time.perf_counter() - start
+        self.assertEqual(DeliveredPost.objects.filter(box=target).count(), count)
+        return elapsed, len(queries)
+
+    def test_sync_backlog(self):
+        rows = []
+        for count in BACKLOG_SIZES:
+            elapsed, queries = self.time_sync(delivery.sync_box, "set", count)
+            row = [count, f"{elapsed * 1000:.1f}", queries]
+            if count <= LEGACY_MAX_BACKLOG:
+                elapsed, queries = self.time_sync(legacy_sync_box, "legacy", count)
+                row += [f"{elapsed * 1000:.1f}", queries]
+            else:
+                row += ["-", "-"]
+            rows.append(row)
+        report(
+            f"Sync latency by backlog size ({connection.vendor})",
+            ["backlog", "set ms", "set queries", "legacy ms", "legacy queries"],
+            rows,
+        )
+
+
+@unittest.skipUnless(
+    connection.vendor == "postgresql", "requires row locking and concurrent writers"
+)
+class ConcurrentSyncBenchmark(django.test.TransactionTestCase):
+    """Sync throughput when many threads sync the same boxes at once."""
+
+    TARGETS = 20
+    BACKLOG = 2000
+
+    def setUp(self):
+        sender = User.objects.create(username="bench")
+        source = Box.objects.create(name="everyone")
+        self.targets = [
+            Box.objects.create(name=f"user{i}") for i in range(self.TARGETS)
+        ]
+        for target in self.targets:
+            Subscription.objects.create(source=source, target=target)
+        create_backlog(sender, source, self.BACKLOG)
+
+    def reset(self):
+        DeliveredPost.objects.filter(box__in=self.targets).delete()
+        Subscription.objects.update(watermark=0)
+
+    def run_threads(self, count):
+        def work(n):
+            try:
+                targets = self.targets[n:] + self.targets[:n]
+                pending = True
+                while pending:
+                    pending = False
+                    progress = 0
+                    for target in targets:
+                        result = delivery.sync_box(target, chunk_size=500)
+                        pending = pending or result.more_pending
+                        progress += result.scanned
+                    if pending and not progress:
+                        # Everything left is being synced by other threads.
+                        time.sleep(0.01)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def test_sync_threads(self):
+        rows = []
+        total = self.TARGETS * self.BACKLOG
+        for count in THREAD_COUNTS:
+            self.reset()
+            elapsed = self.run_threads(count)
+            self.assertEqual(
+                DeliveredPost.objects.filter(box__in=self.targets).count(), total
+            )
+            rows.append([count, f"{elapsed * 1000:.1f}", f"{total / elapsed:.0f}"])
+        report(
+            f"Concurrent sync of {self.TARGETS} boxes x {self.BACKLOG} posts",
+            ["threads", "ms", "rows/s"],
+            rows,
+        )
+
+
+class BatchDeliverBenchmark(django.test.TestCase):
+    """Ingest throughput of one deliver call per post versus a batch deliver."""
+
+    def setUp(self):
+        user = User.objects.create_user(username="bench", password="bench")
+        self.client.force_login(user)
+        self.to = [f"http://testserver/postapi/boxes/user{i}" for i in range(5)]
+        Box.objects.bulk_create(Box(name=f"user{i}") for i in range(5))
+
+    def item(self, i):
+        return {"to": self.to, "subject": f"Post {i}", "body": "Hello!"}
+
+    def deliver_each(self):
+        for i in range(BATCH_POSTS):
+            r = self.client.post(
+                "/postapi/actions/deliver",
+                json.dumps(self.item(i)),
+                content_type="application/json",
+            )
+            self.assertEqual(r.status_code, 200)
+
+    def deliver_batch(self):
+        body = "\n".join(json.dumps(self.item(i)) for i in range(BATCH_POSTS))
+        r = self.client.post(
+            "/postapi/actions/batch-deliver",
+            body,
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(b"".join(r.streaming_content).splitlines()), BATCH_POSTS)
+
+    def test_batch_deliver(self):
+        rows = []
+        for name, fn in (("deliver", self.deliver_each), ("batch", self.deliver_batch)):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            rows.append([name, f"{elapsed * 1000:.1f}", f"{BATCH_POSTS / elapsed:.0f}"])
+        self.assertEqual(Post.objects.count(), 2 * BATCH_POSTS)
+        report(
+            f"Ingest of {BATCH_POSTS} posts to {len(self.to)} boxes ({connection.vendor})",
+            ["method", "ms", "posts/s"],
+            rows,
+        )
+
+
+class PaginationBenchmark(django.test.TestCase):
+    """Latency of deep pages, by keyset versus by OFFSET."""
+
+    PAGE_SIZE = 50
+
+    def setUp(self):
+        sender = User.objects.create(username="bench")
+        source = Box.objects.create(name="everyone")
+        create_backlog(sender, source, self.PAGE_SIZE * (max(PAGE_DEPTHS) + 1))
+        self.dposts = DeliveredPost.objects.order_by("post_created", "id")
+
+    def time_page(self, fetch):
+        start = time.perf_counter()
+        for _ in range(10):
+            page = list(fetch())
+        self.assertEqual(len(page), self.PAGE_SIZE)
+        return (time.perf_counter() - start) / 10
+
+    def test_deep_pages(self):
+        rows = []
+        for depth in PAGE_DEPTHS:
+            offset = depth * self.PAGE_SIZE
+            last = self.dposts[offset - 1] if offset else None
+            keyset = self.dposts
+            if last is not None:
+                paginator = KeysetPagination()
+                paginator.ordering = ["post_created", "id"]
+                keyset = keyset.filter(paginator.after([last.post_created, last.id]))
+            keyset_time = self.time_page(lambda: keyset[: self.PAGE_SIZE])
+            offset_time = self.time_page(
+                lambda: self.dposts[offset : offset + self.PAGE_SIZE]
+            )
+            rows.append(
+                [depth, f"{keyset_time * 1000:.2f}", f"{offset_time * 1000:.2f}"]
+            )
+        report(
+            f"Page latency by depth, {self.PAGE_SIZE} per page ({connection.vendor})",
+            ["page", "keyset ms", "offset ms"],
+            rows,
+        )
+
+
+class SerializationBenchmark(django.test.TestCase):
+    """Delivered post list serialization: DeliveredPostSerializer versus the fast path."""
+
+    def setUp(self):
+        sender = User.objects.create(username="bench")
+        source = Box.objects.create(name="everyone")
+        create_backlog(sender, source, max(SERIALIZE_ROWS))
+        self.request = Request(APIRequestFactory().get("/postapi/delivered-posts"))
+        self.dposts = DeliveredPost.objects.order_by("post_created", "id")
+
+    def serialize(self, count):
+        dposts = self.dposts.select_related("box", "post_sender")[:count]
+        serializer = DeliveredPostSerializer(
+            dposts, many=True, context={"request": self.request}
+        )
+        return serializer.data
+
+    def fast(self, count):
+        view = DeliveredPostList()
+        links = Links(self.request)
+        rows = self.dposts.values(*view.fast_values)[:count]
+        return [view.fast_row(row, links) for row in rows]
+
+    def time_rows(self, fn, count):
+        start = time.perf_counter()
+        content = JSONRenderer().render(fn(count))
+        return time.perf_counter() - start, content
+
+    def test_serialize(self):
+        rows = []
+        for count in SERIALIZE_ROWS:
+            slow_time, slow = self.time_rows(self.serialize, count)
+            fast_time, fast = self.time_rows(self.fast, count)
+            self.assertEqual(fast, slow)
+            rows.append(
+                [
+                    count,
+                    f"{count / slow_time:.0f}",
+                    f"{count / fast_time:.0f}",
+                    f"{slow_time / fast_time:.1f}x",
+                ]
+            )
+        report(
+            f"Delivered post rows serialized per second ({connection.vendor})",
+            ["rows", "serializer", "fast path", "speedup"],
+            rows,
+        )
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "requires full-text search")
+class SearchBenchmark(django.test.TestCase):
+    """Search latency over a large synthetic corpus, by index versus by substring scan."""
+
+    BOXES = 10
+    PAGE_SIZE = 50
+    ORDERING = ("-rank", "-post_created", "-id")
+
+    # Each post's words are drawn at random from w0x..wNx, skewed towards
+    # w0x. The x keeps one word from being a substring of another, so the
+    # scan finds the same posts. The empty substr() ties the subquery to the
+    # row, so it's run per post.
+    CORPUS_SQL = """
+    INSERT INTO {post} (created, sender_id, subject, content_type, body)
+    SELECT now() - g.n * interval '1 second', %s, words.subject,
+        'text/x-markdown', words.body
+    FROM generate_series(1, %s) AS g(n), LATERAL (
+        SELECT string_agg(word, ' ') FILTER (WHERE i <= 5) AS subject,
+            string_agg(word, ' ') AS body
+        FROM (
+            SELECT i, 'w' || floor(power(random(), 4) * %s)::int || 'x'
+                || substr(g.n::text, 1, 0) AS word
+            FROM generate_series(1, %s) AS i
+        ) w
+    ) words
+    """
+
+    DELIVER_SQL = """
+    INSERT INTO {dpost} (box_id, post_id, created, is_read, post_sender_id,
+        post_created, post_subject)
+    SELECT (%s::bigint[])[1 + id %% %s], id, now(), false, sender_id, created,
+        subject
+    FROM {post}
+    """
+
+    def setUp(self):
+        sender = User.objects.create(username="bench")
+        boxes = [Box.objects.create(name=f"box{i}") for i in range(self.BOXES)]
+        self.box = boxes[0]
+        start = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self.CORPUS_SQL.format(post=Post._meta.db_table),
+                [sender.id, SEARCH_CORPUS, SEARCH_VOCABULARY, SEARCH_POST_WORDS],
+            )
+            cursor.execute(
+                self.DELIVER_SQL.format(
+                    dpost=DeliveredPost._meta.db_table, post=Post._meta.db_table
+                ),
+                [[box.id for box in boxes], self.BOXES],
+            )
+            cursor.execute(f"ANALYZE {Post._meta.db_table}")
+            cursor.execute(f"ANALYZE {DeliveredPost._meta.db_table}")
+        self.setup_time = time.perf_counter() - start
+
+    def time_page(self, queryset):
+        queryset = queryset.order_by(*self.ORDERING)
+        start = time.perf_counter()
+        for _ in range(5):
+            list(queryset[: self.PAGE_SIZE])
+        return (time.perf_counter() - start) / 5
+
+    def test_search(self):
+        dposts = DeliveredPost.objects.filter(box=self.box)
+        rows = []
+        for query in ("w0x", "w3x w5x", f"w{SEARCH_VOCABULARY // 2}x", "w1x -w2x"):
+            indexed = search.search_box(self.box, query)
+            found = indexed.count()
+            row = [query, found, f"{self.time_page(indexed) * 1000:.1f}"]
+            if "-" in query:
+                # The scan can't exclude words.
+                row.append("-")
+            else:
+                scanned = search.match_words(dposts, query).annotate(
+                    rank=Value(0.0, output_field=FloatField())
+                )
+                self.assertEqual(scanned.count(), found)
+                row.append(f"{self.time_page(scanned) * 1000:.1f}")
+            rows.append(row)
+        report(
+            f"First page of search results in one of {self.BOXES} boxes, over "
+            f"{SEARCH_CORPUS} posts (loaded in {self.setup_time:.0f}s)",
+            ["query", "results", "index ms", "scan ms"],
+            rows,
+        )
@@ -0,0 +1,75 @@
+"""Digests and compression for the post body store.
+
+With POSTAPI_BODY_STORE on, a post's body is saved as a PostBody, keyed by
+the SHA-256 digest of its text, so the thousands of posts a broadcast or a
+templated notification produces share one copy of the body. Bodies of at
+least POSTAPI_BODY_COMPRESS_MIN bytes are compressed, with zstd if the
+zstandard package is installed, or zlib otherwise. Each body records how
+it was compressed, so bodies written either way can be read back.
+"""
+import hashlib
+import zlib
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB = "zlib"
+ZSTD = "zstd"
+
+COMPRESSION_CHOICES = (("", "None"), (ZLIB, "zlib"), (ZSTD, "zstd"))
+
+
+def default_compression():
+    """The compression new bodies get: the setting, or the best one available."""
+
+    compression = settings.POSTAPI_BODY_COMPRESSION
+    if compression is None:
+        compression = ZSTD if zstandard is not None else ZLIB
+    return compression
+
+
+def digest(text):
+    """The key a body is stored under."""
+
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def compress(text, compression=None):
+    """Encode a body for storage. Returns the compression used and the data.
+
+    A body is left uncompressed if it's small, or if compressing it wouldn't
+    make it any smaller.
+    """
+
+    data = text.encode()
+    compression = compression or default_compression()
+    if len(data) < settings.POSTAPI_BODY_COMPRESS_MIN:
+        return "", data
+    if compression == ZSTD:
+        packed = zstandard.ZstdCompressor().compress(data)
+    elif compression == ZLIB:
+        packed = zlib.compress(data)
+    else:
+        raise ValueError(f"Unknown body compression {compression!r}")
+    if len(packed) >= len(data):
+        return "", data
+    return compression, packed
+
+
+def decompress(compression, data):
+    """Decode a stored body back into its text."""
+
+    data = bytes(data)
+    if compression == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Reading zstd-compressed bodies needs zstandard")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif compression == ZLIB:
+        data = zlib.decompress(data)
+    elif compression:
+        raise ValueError(f"Unknown body compression {compression!r}")
+    return data.decode()
@@ -0,0 +1,77 @@
+"""Conditional GETs: ETags computed from cheap state, checked before serializing.
+
+A view that mixes in ConditionalGetMixin says what its response depends on
+by returning a small tuple from get_etag_state, typically a box's ID and its
+counter's version, which changes whenever the box's posts do. That state is
+hashed along with the request's path, query, and negotiated media type into a
+strong ETag. If the client already has that ETag, the view answers
+304 Not Modified without running its queryset or serializing anything.
+"""
+import hashlib
+
+from django.db.models import Count, Max, Sum
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from postapi.models import Box
+
+
+def make_etag(request, state):
+    """A strong ETag for the response to the request, given the state it depends on."""
+
+    key = repr(
+        (request.get_full_path(), getattr(request, "accepted_media_type", None), state)
+    )
+    return quote_etag(hashlib.sha1(key.encode()).hexdigest())
+
+
+def box_state(name):
+    """The state of a box's posts: its ID and counter version, or None if there's no such box."""
+
+    return Box.objects.filter(name=name).values_list("id", "counter__version").first()
+
+
+def all_boxes_state():
+    """The state of every box and all of their posts, in one aggregate query.
+
+    The number of boxes and the highest box ID change when boxes are created
+    or deleted, and the sum of the counter versions grows whenever any box's
+    posts change.
+    """
+
+    state = Box.objects.aggregate(
+        boxes=Count("id"), last=Max("id"), versions=Sum("counter__version")
+    )
+    return (state["boxes"], state["last"], state["versions"])
+
+
+def conditional_response(request, state, **kwargs):
+    """The ETag for the state, and a 304 response if the client already has it.
+
+    Extra keyword arguments (e.g. last_modified) are passed through to
+    Django's get_conditional_response.
+    """
+
+    etag = make_etag(request, state)
+    return etag, get_conditional_response(request, etag=etag, **kwargs)
+
+
+class ConditionalGetMixin(object):
+    """A mixin for generic views that answers If-None-Match before doing any work.
+
+    Subclasses implement get_etag_state. If it returns None, the response
+    has no ETag and is never a 304.
+    """
+
+    def get_etag_state(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        state = self.get_etag_state()
+        if state is None:
+            return super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+        etag, response = conditional_response(request, state)
+        if response is None:
+            response = super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+        response["ETag"] = etag
+        return response
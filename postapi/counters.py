@@ -0,0 +1,68 @@
+"""Repairs the per-box post counters.
+
+The counters are maintained by database triggers, so they should never
+drift; but a trigger that was disabled during a bulk load, or a row changed
+by hand, would leave them wrong until the next change to the box. The
+reconcile functions recount the posts in each box and fix the counters that
+disagree, bumping their versions so that cached copies are refreshed.
+"""
+from django.db import transaction
+from django.db.models import Count, Q
+
+from postapi.models import Box, BoxCounter, DeliveredPost
+
+
+def reconcile_boxes(box_ids):
+    """Recount the posts in the given boxes, and repair the counters that are wrong.
+
+    Missing counters are created. The counters are locked while the posts are
+    counted, so that the count can't race with a delivery to the box.
+    Returns the number of counters repaired.
+    """
+
+    with transaction.atomic():
+        BoxCounter.objects.bulk_create(
+            [BoxCounter(box_id=box_id) for box_id in box_ids], ignore_conflicts=True
+        )
+        counters = list(
+            BoxCounter.objects.select_for_update()
+            .filter(box_id__in=box_ids)
+            .order_by("box_id")
+        )
+        actual = {
+            row["box_id"]: (row["total"], row["unread"])
+            for row in DeliveredPost.objects.filter(box_id__in=box_ids)
+            .values("box_id")
+            .annotate(total=Count("id"), unread=Count("id", filter=Q(is_read=False)))
+            .order_by()
+        }
+        repaired = []
+        for counter in counters:
+            total, unread = actual.get(counter.box_id, (0, 0))
+            if (counter.total, counter.unread) != (total, unread):
+                counter.total, counter.unread = total, unread
+                counter.version += 1
+                repaired.append(counter)
+        BoxCounter.objects.bulk_update(repaired, ["total", "unread", "version"])
+    return len(repaired)
+
+
+def reconcile_counters(batch_size=1000):
+    """Reconcile the counters of every box, a batch of boxes at a time.
+
+    Returns the number of boxes checked and the number of counters repaired.
+    """
+
+    checked = repaired = 0
+    last_id = 0
+    while True:
+        box_ids = list(
+            Box.objects.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not box_ids:
+            return checked, repaired
+        repaired += reconcile_boxes(box_ids)
+        checked += len(box_ids)
+        last_id = box_ids[-1]
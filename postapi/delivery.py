@@ -0,0 +1,616 @@
+"""The delivery engine: moves posts into boxes.
+
+Subscriptions are processed with set-based statements rather than row by
+row: each chunk of a subscription's backlog is copied from the source box to
+the target box with a single INSERT ... SELECT, and rows the target already
+has are skipped by the (box, post) unique constraint.
+
+Subscriptions are pull-based, but posts can also be pushed: when a post is
+delivered to a box, it is copied right away to the targets of the box's
+subscriptions that have been active lately, so that their next read has
+nothing to catch up on.
+
+If a set-based statement fails, the same work is redone a row at a time, and
+the individual deliveries that still fail are parked in the retry table
+rather than holding up the rest.
+"""
+import collections
+import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Avg, Case, Count, DurationField, ExpressionWrapper, F
+from django.db.models import Max, Min, OuterRef, Q, Subquery, When
+from django.utils import timezone
+
+from postapi.models import (
+    Box,
+    DeliveredPost,
+    DeliveryJob,
+    DeliveryJobRecipient,
+    DeliveryRetry,
+    Subscription,
+)
+
+logger = logging.getLogger(__name__)
+
+# Copies the delivered posts in a source box whose IDs fall in (low, high]
+# into a target box. The denormalized post fields are copied along from
+# the source rows, so the underlying posts never need to be read. Rows are
+# inserted in post order, so that concurrent copies of overlapping posts
+# into the same box take their locks in the same order and can't deadlock.
+_COPY_SQL = """
+INSERT INTO {table} (
+    box_id, post_id, created, is_read, post_sender_id, post_created, post_subject
+)
+SELECT %s, post_id, %s, %s, post_sender_id, post_created, post_subject
+FROM {table}
+WHERE box_id = %s AND id > %s AND id <= %s
+ORDER BY post_id
+ON CONFLICT (box_id, post_id) DO NOTHING
+"""
+
+
+# Copies the given delivered posts into the targets of the given
+# subscriptions, for each subscription whose source holds the post.
+_PUSH_SQL = """
+INSERT INTO {table} (
+    box_id, post_id, created, is_read, post_sender_id, post_created, post_subject
+)
+SELECT s.target_id, d.post_id, %s, %s, d.post_sender_id, d.post_created, d.post_subject
+FROM {subscriptions} s JOIN {table} d ON d.box_id = s.source_id
+WHERE s.id IN ({sub_ids}) AND d.id IN ({dpost_ids})
+ORDER BY s.target_id, d.post_id
+ON CONFLICT (box_id, post_id) DO NOTHING
+"""
+
+
+def _latest_post_id(box_field):
+    """A subquery for the ID of the newest post delivered to the box in the given field."""
+
+    return Subquery(
+        DeliveredPost.objects.filter(box=OuterRef(box_field))
+        .order_by("-id")
+        .values("id")[:1]
+    )
+
+
+def copy_posts(source_id, target_id, low, high):
+    """Copy the source box's delivered posts with IDs in (low, high] to the target box.
+
+    Returns the number of posts actually delivered to the target.
+    """
+
+    sql = _COPY_SQL.format(table=DeliveredPost._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [target_id, timezone.now(), False, source_id, low, high])
+        return cursor.rowcount
+
+
+def retry_delay(attempts):
+    """How long to wait for the next try at a delivery that has failed the given number of times."""
+
+    delay = settings.POSTAPI_RETRY_BASE_DELAY * 2 ** (attempts - 1)
+    return datetime.timedelta(seconds=min(delay, settings.POSTAPI_RETRY_MAX_DELAY))
+
+
+def park_deliveries(failures):
+    """Put failed deliveries in the retry table.
+
+    failures is a list of (box ID, post ID, error) triples. Deliveries that
+    are already parked are left as they are.
+    """
+
+    if not failures:
+        return
+    next_attempt = timezone.now() + retry_delay(1)
+    for box_id, post_id, err in failures:
+        logger.warning(
+            "Delivery of post %d to box %d failed, will retry: %s", post_id, box_id, err
+        )
+    DeliveryRetry.objects.bulk_create(
+        [
+            DeliveryRetry(
+                box_id=box_id,
+                post_id=post_id,
+                next_attempt=next_attempt,
+                last_error=str(err),
+            )
+            for box_id, post_id, err in failures
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def resolve_boxes(names):
+    """Look up boxes by name, all at once.
+
+    Returns a list of the boxes found, in the order given, and a list of the
+    names for which no box exists.
+    """
+
+    found = Box.objects.in_bulk(names, field_name="name")
+    boxes = [found[name] for name in names if name in found]
+    missing = [name for name in names if name not in found]
+    return boxes, missing
+
+
+def _delivered_post(post, box):
+    return DeliveredPost(
+        box=box,
+        post=post,
+        post_sender_id=post.sender_id,
+        post_created=post.created,
+        post_subject=post.subject,
+    )
+
+
+def _insert(dposts):
+    """Insert delivered posts, skipping any that the boxes already have."""
+
+    DeliveredPost.objects.bulk_create(dposts, ignore_conflicts=True)
+
+
+def deliver_posts(deliveries):
+    """Deliver posts to boxes, with a single statement.
+
+    deliveries is a list of (post, boxes) pairs. Boxes that already have the
+    post are skipped. If the statement fails, the deliveries are made one at
+    a time instead, and any that still fail are parked to be retried.
+    Returns the parked deliveries as (post, box) pairs.
+    """
+
+    dposts = [_delivered_post(post, box) for post, boxes in deliveries for box in boxes]
+    failures = []
+    try:
+        with transaction.atomic():
+            _insert(dposts)
+    except DatabaseError as err:
+        logger.warning("Bulk delivery failed, delivering one at a time: %s", err)
+        for dpost in dposts:
+            try:
+                with transaction.atomic():
+                    _insert([dpost])
+            except DatabaseError as err:
+                failures.append((dpost, err))
+        park_deliveries([(dpost.box_id, dpost.post_id, err) for dpost, err in failures])
+
+    # Pushing is only a head start on pulling, so a failure here can wait
+    # for the pull.
+    if settings.POSTAPI_PUSH_ACTIVE_WITHIN is not None:
+        try:
+            with transaction.atomic():
+                push_posts(
+                    [post for post, _ in deliveries],
+                    {dpost.box_id for dpost in dposts},
+                )
+        except DatabaseError as err:
+            logger.warning("Push to subscribers failed, leaving it to sync: %s", err)
+    return [(dpost.post, dpost.box) for dpost, _ in failures]
+
+
+def push_posts(posts, box_ids):
+    """Push posts just delivered to the given boxes on to subscribers that have been active lately.
+
+    Only the targets of subscriptions that were active within
+    POSTAPI_PUSH_ACTIVE_WITHIN get the posts now; the rest pull them when
+    they sync, as usual. A subscription that was caught up has its watermark
+    moved past the pushed posts; otherwise the posts are copied ahead of the
+    watermark, and skipped when the sync reaches them. Subscriptions being
+    synced at the moment are left to the sync. Returns the number of posts
+    delivered.
+    """
+
+    window = settings.POSTAPI_PUSH_ACTIVE_WITHIN
+    if window is None or not posts or not box_ids:
+        return 0
+    since = timezone.now() - datetime.timedelta(seconds=window)
+    subs = list(
+        Subscription.objects.select_for_update(skip_locked=True, of=("self",))
+        .filter(source_id__in=box_ids, target__last_active__gte=since)
+        .values_list("id", "source_id", "watermark")
+    )
+    if not subs:
+        return 0
+
+    # The pushed posts, as delivered to each source box.
+    sources = {source_id for _, source_id, _ in subs}
+    new = {}
+    for box_id, dpost_id in DeliveredPost.objects.filter(
+        box_id__in=sources, post__in=posts
+    ).values_list("box_id", "id"):
+        new.setdefault(box_id, []).append(dpost_id)
+    new_ids = [dpost_id for ids in new.values() for dpost_id in ids]
+
+    # The newest post in each source box before the pushed ones; a
+    # subscription with its watermark there is caught up.
+    previous = dict(
+        Box.objects.filter(id__in=sources)
+        .annotate(
+            previous=Subquery(
+                DeliveredPost.objects.filter(box=OuterRef("id"))
+                .exclude(id__in=new_ids)
+                .order_by("-id")
+                .values("id")[:1]
+            )
+        )
+        .values_list("id", "previous")
+    )
+
+    sql = _PUSH_SQL.format(
+        table=DeliveredPost._meta.db_table,
+        subscriptions=Subscription._meta.db_table,
+        sub_ids=", ".join(["%s"] * len(subs)),
+        dpost_ids=", ".join(["%s"] * len(new_ids)),
+    )
+    params = [timezone.now(), False] + [sub_id for sub_id, _, _ in subs] + new_ids
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        delivered = cursor.rowcount
+
+    caught_up = [
+        (sub_id, source_id)
+        for sub_id, source_id, watermark in subs
+        if source_id in new
+        and (previous[source_id] or 0) <= watermark < max(new[source_id])
+    ]
+    if caught_up:
+        Subscription.objects.filter(id__in=[sub_id for sub_id, _ in caught_up]).update(
+            watermark=Case(
+                *[
+                    When(source_id=source_id, then=max(ids))
+                    for source_id, ids in new.items()
+                ]
+            )
+        )
+    return delivered
+
+
+def deliver_post(post, boxes):
+    """Deliver a post to each of the given boxes, with a single statement.
+
+    Boxes that already have the post are skipped. Returns the post's
+    deliveries to the given boxes.
+    """
+
+    deliver_posts([(post, boxes)])
+    # Deliveries that were parked for a retry are missing from the result.
+    return DeliveredPost.objects.filter(post=post, box__in=boxes).select_related(
+        "box", "post_sender"
+    )
+
+
+def enqueue_posts(deliveries):
+    """Queue posts for delivery to boxes, without looking the boxes up.
+
+    deliveries is a list of (post, box names) pairs. Returns the new jobs, in
+    the same order.
+    """
+
+    jobs = DeliveryJob.objects.bulk_create(
+        [DeliveryJob(post=post) for post, _ in deliveries]
+    )
+    DeliveryJobRecipient.objects.bulk_create(
+        [
+            DeliveryJobRecipient(job=job, box_name=name)
+            for job, (_, names) in zip(jobs, deliveries)
+            for name in names
+        ]
+    )
+    return jobs
+
+
+def enqueue_post(post, names):
+    """Queue a post for delivery to the named boxes. Returns the job."""
+
+    return enqueue_posts([(post, names)])[0]
+
+
+def pending_jobs(limit=None):
+    """Delivery jobs the queue hasn't finished yet, oldest first."""
+
+    jobs = DeliveryJob.objects.filter(completed__isnull=True).order_by("id")
+    return jobs[:limit] if limit else jobs
+
+
+def run_job(job_id):
+    """Deliver a queued post to the boxes it's addressed to, and record the outcome.
+
+    The job is locked while it runs; a job that another queue processor is
+    already running, or that is finished, is skipped. Returns whether the job
+    was run.
+    """
+
+    with transaction.atomic():
+        job = (
+            DeliveryJob.objects.select_for_update(skip_locked=True, of=("self",))
+            .select_related("post")
+            .filter(id=job_id, completed__isnull=True)
+            .first()
+        )
+        if job is None:
+            return False
+        recipients = job.recipients.filter(status=DeliveryJobRecipient.QUEUED)
+        boxes, missing = resolve_boxes(
+            list(recipients.values_list("box_name", flat=True))
+        )
+        parked = deliver_posts([(job.post, boxes)])
+        now = timezone.now()
+        recipients.filter(box_name__in=missing).update(
+            status=DeliveryJobRecipient.FAILED,
+            error="Box does not exist.",
+            updated=now,
+        )
+        if parked:
+            recipients.filter(box_name__in=[box.name for _, box in parked]).update(
+                status=DeliveryJobRecipient.RETRYING,
+                error="Delivery failed, and will be retried.",
+                updated=now,
+            )
+        recipients.update(status=DeliveryJobRecipient.DELIVERED, updated=now)
+        job.completed = now
+        job.save(update_fields=["completed"])
+    return True
+
+
+def due_retries(limit=None):
+    """Parked deliveries that are due to be tried again, longest due first."""
+
+    retries = DeliveryRetry.objects.filter(
+        status=DeliveryRetry.PENDING, next_attempt__lte=timezone.now()
+    ).order_by("next_attempt")
+    return retries[:limit] if limit else retries
+
+
+def retry_delivery(retry_id):
+    """Try a parked delivery again.
+
+    If it fails again, the next try is scheduled further out, until the
+    attempts run out and the delivery is given up on. Like jobs, a retry that
+    someone else is already running is skipped. Returns whether the retry
+    was attempted.
+    """
+
+    with transaction.atomic():
+        retry = (
+            DeliveryRetry.objects.select_for_update(skip_locked=True, of=("self",))
+            .select_related("box", "post")
+            .filter(id=retry_id, status=DeliveryRetry.PENDING)
+            .first()
+        )
+        if retry is None:
+            return False
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                _insert([_delivered_post(retry.post, retry.box)])
+        except DatabaseError as err:
+            retry.attempts += 1
+            retry.last_error = str(err)
+            if retry.attempts >= settings.POSTAPI_RETRY_MAX_ATTEMPTS:
+                logger.error(
+                    "Giving up on delivery of post %d to %s after %d attempts: %s",
+                    retry.post_id,
+                    retry.box.name,
+                    retry.attempts,
+                    err,
+                )
+                retry.status = DeliveryRetry.DEAD
+                retry.resolved = now
+            else:
+                retry.next_attempt = now + retry_delay(retry.attempts)
+        else:
+            retry.status = DeliveryRetry.DELIVERED
+            retry.resolved = now
+        retry.save()
+
+        # Keep the receipts of queued deliveries up to date.
+        if retry.status == DeliveryRetry.DELIVERED:
+            receipt = {"status": DeliveryJobRecipient.DELIVERED, "error": ""}
+        elif retry.status == DeliveryRetry.DEAD:
+            receipt = {
+                "status": DeliveryJobRecipient.FAILED,
+                "error": "Delivery failed.",
+            }
+        else:
+            return True
+        DeliveryJobRecipient.objects.filter(
+            job__post_id=retry.post_id,
+            box_name=retry.box.name,
+            status=DeliveryJobRecipient.RETRYING,
+        ).update(updated=now, **receipt)
+    return True
+
+
+def _seconds(delta):
+    return None if delta is None else delta.total_seconds()
+
+
+def queue_metrics(since=None):
+    """Numbers describing the delivery queue and the retry queue.
+
+    Retry latency (how long a parked delivery took to get through) is
+    measured over the deliveries resolved since the given time, by default
+    the last day.
+    """
+
+    now = timezone.now()
+    if since is None:
+        since = now - datetime.timedelta(days=1)
+
+    jobs = DeliveryJob.objects.filter(completed__isnull=True).aggregate(
+        pending=Count("id"), oldest=Min("created")
+    )
+    retries = DeliveryRetry.objects.aggregate(
+        pending=Count("id", filter=Q(status=DeliveryRetry.PENDING)),
+        due=Count("id", filter=Q(status=DeliveryRetry.PENDING, next_attempt__lte=now)),
+        dead=Count("id", filter=Q(status=DeliveryRetry.DEAD)),
+        oldest=Min("created", filter=Q(status=DeliveryRetry.PENDING)),
+    )
+    latency = ExpressionWrapper(
+        F("resolved") - F("created"), output_field=DurationField()
+    )
+    delivered = DeliveryRetry.objects.filter(
+        status=DeliveryRetry.DELIVERED, resolved__gte=since
+    ).aggregate(count=Count("id"), mean=Avg(latency), max=Max(latency))
+
+    return {
+        "delivery_jobs": {
+            "pending": jobs["pending"],
+            "oldest_pending_age": _seconds(jobs["oldest"] and now - jobs["oldest"]),
+        },
+        "retries": {
+            "pending": retries["pending"],
+            "due": retries["due"],
+            "dead": retries["dead"],
+            "oldest_pending_age": _seconds(
+                retries["oldest"] and now - retries["oldest"]
+            ),
+            "delivered": delivered["count"],
+            "mean_latency": _seconds(delivered["mean"]),
+            "max_latency": _seconds(delivered["max"]),
+        },
+    }
+
+
+# The outcome of a sync:
+# - delivered: the number of posts newly delivered to the target box
+# - scanned: the number of source posts the watermarks were advanced past
+# - more_pending: whether the sync stopped with posts still left to deliver
+SyncResult = collections.namedtuple(
+    "SyncResult", ["delivered", "scanned", "more_pending"]
+)
+
+# The outcome of syncing one chunk. In addition to the above:
+# - busy: whether some subscriptions were skipped because another sync
+#   is working on them
+_ChunkResult = collections.namedtuple(
+    "_ChunkResult", ["delivered", "scanned", "more_pending", "busy"]
+)
+
+
+def _copy_each(source_id, target_id, low, high):
+    """Like copy_posts, but a post at a time, parking the posts that fail to copy."""
+
+    rows = (
+        DeliveredPost.objects.filter(box_id=source_id, id__gt=low, id__lte=high)
+        .order_by("id")
+        .values_list("id", "post_id")
+    )
+    delivered = 0
+    failures = []
+    for dpost_id, post_id in rows:
+        try:
+            with transaction.atomic():
+                delivered += copy_posts(source_id, target_id, dpost_id - 1, dpost_id)
+        except DatabaseError as err:
+            failures.append((target_id, post_id, err))
+    park_deliveries(failures)
+    return delivered
+
+
+def _expired(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _sync_chunk(box, row_limit, deadline):
+    """Advance the box's subscriptions past at most row_limit source posts, in one transaction.
+
+    Subscriptions are locked for the duration of the chunk. Subscriptions that
+    are already locked by a concurrent sync are skipped rather than waited
+    on, so concurrent syncs split the work between them instead of
+    duplicating it.
+    """
+
+    delivered = scanned = 0
+    more_pending = False
+    with transaction.atomic():
+        subs = list(
+            Subscription.objects.select_for_update(skip_locked=True, of=("self",))
+            .filter(target=box)
+            .annotate(latest=_latest_post_id("source"))
+        )
+        busy = (
+            Subscription.objects.filter(target=box)
+            .exclude(id__in=[sub.id for sub in subs])
+            .exists()
+        )
+        for sub in subs:
+            low = sub.watermark
+            if sub.latest is None or sub.latest <= low:
+                continue
+            # Always make some progress, even if the budget is already spent.
+            if scanned >= row_limit or (scanned > 0 and _expired(deadline)):
+                more_pending = True
+                continue
+            ids = list(
+                DeliveredPost.objects.filter(
+                    box_id=sub.source_id, id__gt=low, id__lte=sub.latest
+                )
+                .order_by("id")
+                .values_list("id", flat=True)[: row_limit - scanned]
+            )
+            high = ids[-1] if ids else sub.latest
+            try:
+                with transaction.atomic():
+                    delivered += copy_posts(sub.source_id, box.id, low, high)
+            except DatabaseError as err:
+                logger.warning("Bulk copy failed, copying one at a time: %s", err)
+                delivered += _copy_each(sub.source_id, box.id, low, high)
+            scanned += len(ids)
+            Subscription.objects.filter(id=sub.id).update(watermark=high)
+            if high < sub.latest:
+                more_pending = True
+    return _ChunkResult(delivered, scanned, more_pending, busy)
+
+
+def sync_box(box, max_rows=None, max_seconds=None, chunk_size=None):
+    """Bring a box up to date with content from all of its subscriptions.
+
+    Each subscription's backlog is copied in chunks of at most chunk_size
+    source posts, and the watermarks are advanced in the same transaction
+    as each chunk. If max_rows or max_seconds is given, the sync stops once
+    that many source posts have been processed or that much time has
+    passed; the committed watermarks let a later sync pick up where this one
+    left off.
+
+    Subscriptions being synced concurrently by someone else are left to
+    them; in that case the result reports more_pending, since those
+    subscriptions may not be done yet. Returns a SyncResult.
+    """
+
+    if chunk_size is None:
+        chunk_size = settings.POSTAPI_SYNC_CHUNK_SIZE
+    deadline = None if max_seconds is None else time.monotonic() + max_seconds
+    delivered = scanned = 0
+    while True:
+        row_limit = chunk_size
+        if max_rows is not None:
+            row_limit = min(row_limit, max_rows - scanned)
+        chunk = _sync_chunk(box, row_limit, deadline)
+        delivered += chunk.delivered
+        scanned += chunk.scanned
+        if not chunk.more_pending:
+            return SyncResult(delivered, scanned, chunk.busy)
+        if (max_rows is not None and scanned >= max_rows) or _expired(deadline):
+            return SyncResult(delivered, scanned, True)
+
+
+def pending_boxes(limit=None, active_since=None):
+    """Boxes with subscriptions that have posts waiting to be delivered.
+
+    The most recently active boxes come first; boxes that have never been
+    read come last. If active_since is given, only boxes active since then
+    are included.
+    """
+
+    pending = Subscription.objects.annotate(latest=_latest_post_id("source")).filter(
+        latest__gt=F("watermark")
+    )
+    boxes = Box.objects.filter(id__in=pending.values("target_id"))
+    if active_since is not None:
+        boxes = boxes.filter(last_active__gte=active_since)
+    boxes = boxes.order_by(F("last_active").desc(nulls_last=True), "id")
+    return boxes[:limit] if limit else boxes
@@ -0,0 +1,130 @@
+"""Exports the message store, or a single box, as newline-delimited JSON.
+
+Each line is one object, with a "type" of box, post, deliveredpost, or
+subscription, and is written in that order of types, each in ID order, so
+that everything a line refers to comes before it. Rows are read with
+QuerySet.iterator, which uses a server-side cursor where the database has
+them, and fetched a chunk at a time, so an export of any size runs in
+constant memory.
+
+An interrupted export can be resumed after the last line it wrote: pass
+that line's type and ID as the after position, e.g. "post:1234".
+"""
+from django.conf import settings
+
+from postapi import bodystore
+from postapi.models import Box, DeliveredPost, Post, Subscription
+from postapi.renderers import ORJSONRenderer
+
+EXPORT_TYPES = ("box", "post", "deliveredpost", "subscription")
+
+
+def parse_position(value):
+    """Parse a resume position, "<type>:<id>". Raises ValueError if it's invalid."""
+
+    type_, _, id_ = value.partition(":")
+    if type_ not in EXPORT_TYPES:
+        raise ValueError(f"Unknown type {type_!r}; expected one of {EXPORT_TYPES}")
+    return type_, int(id_)
+
+
+def _sections(box):
+    """For each type: the rows to export, the values() fields, and the output keys."""
+
+    boxes = Box.objects.all()
+    posts = Post.objects.all()
+    dposts = DeliveredPost.objects.all()
+    subs = Subscription.objects.all()
+    if box is not None:
+        boxes = boxes.filter(id=box.id)
+        posts = posts.filter(delivered_posts__box=box)
+        dposts = dposts.filter(box=box)
+        subs = subs.filter(target=box)
+    return [
+        (
+            "box",
+            boxes,
+            ("id", "name", "created", "last_active"),
+            ("id", "name", "created", "last_active"),
+        ),
+        (
+            "post",
+            posts,
+            (
+                "id",
+                "sender__username",
+                "created",
+                "subject",
+                "content_type",
+                "body_text",
+                "stored_body__compression",
+                "stored_body__data",
+            ),
+            (
+                "id",
+                "sender",
+                "created",
+                "subject",
+                "content_type",
+                "body",
+                "body_compression",
+                "body_data",
+            ),
+        ),
+        (
+            "deliveredpost",
+            dposts,
+            ("id", "box__name", "post_id", "created", "is_read"),
+            ("id", "box", "post", "created", "is_read"),
+        ),
+        (
+            "subscription",
+            subs,
+            ("id", "source__name", "target__name", "created", "watermark"),
+            ("id", "source", "target", "created", "watermark"),
+        ),
+    ]
+
+
+def _load_body(row):
+    """Fill in a post row's body from the body store, if it's there."""
+
+    compression, data = row.pop("body_compression"), row.pop("body_data")
+    if data is not None:
+        row["body"] = bodystore.decompress(compression, data)
+
+
+def export_rows(box=None, after=None, chunk_size=None):
+    """Yield the rows of the export, as dicts, starting after the given position.
+
+    If a box is given, only the box, the posts in it, and its subscriptions
+    are exported.
+    """
+
+    chunk_size = chunk_size or settings.POSTAPI_EXPORT_CHUNK_SIZE
+    after_type, after_id = after or (EXPORT_TYPES[0], 0)
+    skipping = True
+    for type_, queryset, fields, keys in _sections(box):
+        if skipping and type_ != after_type:
+            continue
+        low = after_id if skipping else 0
+        skipping = False
+        rows = (
+            queryset.filter(id__gt=low)
+            .order_by("id")
+            .values_list(*fields)
+            .iterator(chunk_size=chunk_size)
+        )
+        for row in rows:
+            row = {"type": type_, **dict(zip(keys, row))}
+            if type_ == "post":
+                _load_body(row)
+            yield row
+
+
+def export_lines(box=None, after=None, chunk_size=None):
+    """Yield the lines of the export, as bytes."""
+
+    renderer = ORJSONRenderer()
+    for row in export_rows(box, after, chunk_size):
+        yield renderer.render(row) + b"\n"
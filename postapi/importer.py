@@ -0,0 +1,447 @@
+"""Bulk import of mail, from an export (see postapi.export) or an mbox file.
+
+Rows are read as a stream and buffered a chunk at a time. Each chunk is
+loaded into temporary staging tables, with COPY on PostgreSQL, and then
+merged into the real tables with set-based INSERT ... SELECT statements, in
+its own transaction. The merge looks up boxes and senders by name, creating
+senders that don't exist yet, and fills in the delivered posts' copies of
+their posts' sender, time, and subject.
+
+Imported rows get new IDs. They are allocated in the order of the old ones,
+so that delivered posts keep their order, and the old-to-new mapping is
+kept in the staging tables for the rest of the import. That lets
+subscription watermarks, which are delivered post IDs, be translated too.
+A watermark none of whose source box's posts were imported, as when only
+boxes and subscriptions are, can't be translated; it's set to the newest
+post the source box already had, as for a new subscription.
+"""
+import collections
+import email.header
+import email.utils
+import io
+import json
+import mailbox
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from postapi.models import Box, DeliveredPost, Post, Subscription
+
+IMPORT_TYPES = ("box", "post", "deliveredpost", "subscription")
+
+# The keys each type of row must have a value for.
+_REQUIRED_KEYS = {
+    "box": ("name",),
+    "post": ("id", "sender", "created", "subject", "content_type", "body"),
+    "deliveredpost": ("id", "box", "post", "created", "is_read"),
+    "subscription": ("source", "target"),
+}
+
+_STAGING_TABLES = {
+    "import_box": "name varchar(50), created {datetime}, last_active {datetime}",
+    "import_post": (
+        "old_id bigint, sender varchar(150), created {datetime}, "
+        "subject varchar(255), content_type varchar(63), body text, new_id bigint"
+    ),
+    "import_deliveredpost": (
+        "old_id bigint, box varchar(50), old_post_id bigint, created {datetime}, "
+        "is_read boolean, new_id bigint"
+    ),
+    "import_subscription": (
+        "source varchar(50), target varchar(50), created {datetime}, watermark bigint"
+    ),
+    # The mappings from old IDs to new ones, kept for the whole import.
+    "import_post_map": (
+        "old_id bigint PRIMARY KEY, new_id bigint, sender_id bigint, "
+        "created {datetime}, subject varchar(255)"
+    ),
+    "import_deliveredpost_map": "old_id bigint PRIMARY KEY, new_id bigint, box_id bigint",
+}
+
+# The columns of each chunk table that are loaded from the input, and the
+# keys of the input rows they're loaded from.
+_STAGING_COLUMNS = {
+    "box": (("name", "name"), ("created", "created"), ("last_active", "last_active")),
+    "post": (
+        ("old_id", "id"),
+        ("sender", "sender"),
+        ("created", "created"),
+        ("subject", "subject"),
+        ("content_type", "content_type"),
+        ("body", "body"),
+    ),
+    "deliveredpost": (
+        ("old_id", "id"),
+        ("box", "box"),
+        ("old_post_id", "post"),
+        ("created", "created"),
+        ("is_read", "is_read"),
+    ),
+    "subscription": (
+        ("source", "source"),
+        ("target", "target"),
+        ("created", "created"),
+        ("watermark", "watermark"),
+    ),
+}
+
+_DATETIME_COLUMNS = {"created", "last_active"}
+
+# Allocates new IDs for a chunk from the real table's sequence, in the order
+# of the old IDs.
+_ALLOCATE_SQL = {
+    "postgresql": """
+UPDATE {chunk} c SET new_id = a.new_id
+FROM (
+    SELECT old_id, nextval(pg_get_serial_sequence('{table}', 'id')) AS new_id
+    FROM (SELECT old_id FROM {chunk} ORDER BY old_id) o
+) a
+WHERE c.old_id = a.old_id
+""",
+    "sqlite": """
+UPDATE {chunk} SET new_id = a.new_id
+FROM (
+    SELECT old_id,
+        (SELECT coalesce(max(id), 0) FROM {table}) + row_number() OVER (ORDER BY old_id)
+        AS new_id
+    FROM {chunk}
+) a
+WHERE {chunk}.old_id = a.old_id
+""",
+}
+
+_CREATE_SENDERS_SQL = """
+INSERT INTO {users} (
+    password, is_superuser, username, first_name, last_name, email,
+    is_staff, is_active, date_joined
+)
+SELECT DISTINCT '!', %s, c.sender, '', '', '', %s, %s, %s
+FROM import_post c
+WHERE NOT EXISTS (SELECT 1 FROM {users} u WHERE u.username = c.sender)
+"""
+
+_MERGE_BOXES_SQL = """
+INSERT INTO {boxes} (name, created, last_active)
+SELECT name, coalesce(created, %s), last_active FROM import_box
+WHERE true
+ON CONFLICT (name) DO NOTHING
+"""
+
+_MERGE_POSTS_SQL = """
+INSERT INTO {posts} (id, sender_id, created, subject, content_type, body)
+SELECT c.new_id, u.id, c.created, c.subject, c.content_type, c.body
+FROM import_post c JOIN {users} u ON u.username = c.sender
+ORDER BY c.new_id
+"""
+
+_MAP_POSTS_SQL = """
+INSERT INTO import_post_map (old_id, new_id, sender_id, created, subject)
+SELECT c.old_id, c.new_id, u.id, c.created, c.subject
+FROM import_post c JOIN {users} u ON u.username = c.sender
+"""
+
+_MERGE_DELIVERED_POSTS_SQL = """
+INSERT INTO {dposts} (
+    id, box_id, post_id, created, is_read, post_sender_id, post_created, post_subject
+)
+SELECT c.new_id, b.id, m.new_id, c.created, c.is_read, m.sender_id, m.created, m.subject
+FROM import_deliveredpost c
+JOIN {boxes} b ON b.name = c.box
+JOIN import_post_map m ON m.old_id = c.old_post_id
+WHERE true
+ORDER BY c.new_id
+ON CONFLICT (box_id, post_id) DO NOTHING
+"""
+
+_MAP_DELIVERED_POSTS_SQL = """
+INSERT INTO import_deliveredpost_map (old_id, new_id, box_id)
+SELECT c.old_id, c.new_id, b.id
+FROM import_deliveredpost c JOIN {boxes} b ON b.name = c.box
+"""
+
+# (The merges that upsert have a WHERE clause so that SQLite can tell the
+# upsert's ON CONFLICT from a join's ON.)
+#
+# A watermark is translated to the new ID of the last imported delivered
+# post in the source box at or before the old watermark. If there's none,
+# a watermark past the start is set to the newest delivered post the source
+# box had before the import; imported ones all have higher IDs.
+_MERGE_SUBSCRIPTIONS_SQL = """
+INSERT INTO {subs} (source_id, target_id, created, watermark)
+SELECT s.id, t.id, coalesce(c.created, %s), coalesce((
+    SELECT max(m.new_id) FROM import_deliveredpost_map m
+    WHERE m.box_id = s.id AND m.old_id <= c.watermark
+), CASE WHEN c.watermark > 0 THEN (
+    SELECT max(d.id) FROM {dposts} d
+    WHERE d.box_id = s.id AND d.id < coalesce((
+        SELECT min(m.new_id) FROM import_deliveredpost_map m WHERE m.box_id = s.id
+    ), d.id + 1)
+) END, 0)
+FROM import_subscription c
+JOIN {boxes} s ON s.name = c.source
+JOIN {boxes} t ON t.name = c.target
+WHERE true
+ON CONFLICT (source_id, target_id) DO NOTHING
+"""
+
+
+def _copy_value(value):
+    """A value in COPY's text format."""
+
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace("\x00", "")
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class ImportFailed(Exception):
+    """A chunk of rows couldn't be merged, e.g. because a row broke a constraint."""
+
+
+def _datetime(value):
+    if value is None or hasattr(value, "isoformat"):
+        return value
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"Invalid time: {value!r}")
+    return parsed
+
+
+class Importer(object):
+    """Imports a stream of export rows, a chunk at a time.
+
+    progress, if given, is called after each chunk with the counts of rows
+    imported so far by type, the number of input rows read, and the seconds
+    elapsed.
+    """
+
+    def __init__(self, chunk_size=None, progress=None):
+        self.chunk_size = chunk_size or settings.POSTAPI_IMPORT_CHUNK_SIZE
+        self.progress = progress
+        self.vendor = connection.vendor
+        self.tables = {
+            "users": User._meta.db_table,
+            "boxes": Box._meta.db_table,
+            "posts": Post._meta.db_table,
+            "dposts": DeliveredPost._meta.db_table,
+            "subs": Subscription._meta.db_table,
+        }
+        self.imported = collections.Counter()
+        self.read = 0
+        self.flushed = 0
+
+    def run(self, rows):
+        """Import the rows. Returns the counts of rows imported, by type."""
+
+        self.start = time.perf_counter()
+        self._create_staging_tables()
+        try:
+            buffers = {type_: [] for type_ in IMPORT_TYPES}
+            buffered = 0
+            for row in rows:
+                type_ = row.get("type")
+                if type_ not in buffers:
+                    raise ValueError(f"Row {self.read + 1}: unknown type {type_!r}")
+                for key in _REQUIRED_KEYS[type_]:
+                    if row.get(key) is None:
+                        raise ValueError(f"Row {self.read + 1}: {type_} has no {key}")
+                buffers[type_].append(row)
+                self.read += 1
+                buffered += 1
+                if buffered >= self.chunk_size:
+                    self._flush(buffers)
+                    buffered = 0
+            self._flush(buffers)
+        finally:
+            self._drop_staging_tables()
+        return self.imported
+
+    def _execute(self, sql, params=None):
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(**self.tables), params)
+            return cursor.rowcount
+
+    def _create_staging_tables(self):
+        datetime_type = (
+            "timestamp with time zone" if self.vendor == "postgresql" else "datetime"
+        )
+        for table, columns in _STAGING_TABLES.items():
+            self._execute(
+                f"CREATE TEMPORARY TABLE {table} ({columns})".replace(
+                    "{datetime}", datetime_type
+                )
+            )
+        self._execute(
+            "CREATE INDEX import_deliveredpost_map_box_idx "
+            "ON import_deliveredpost_map (box_id, old_id)"
+        )
+
+    def _drop_staging_tables(self):
+        for table in _STAGING_TABLES:
+            self._execute(f"DROP TABLE IF EXISTS {table}")
+
+    def _stage(self, type_, rows):
+        """Load the rows into the type's staging table, replacing what was there."""
+
+        table = f"import_{type_}"
+        columns = [column for column, _ in _STAGING_COLUMNS[type_]]
+        self._execute(f"DELETE FROM {table}")
+        adapt = connection.ops.adapt_datetimefield_value
+        values = [
+            [
+                adapt(_datetime(row.get(key)))
+                if column in _DATETIME_COLUMNS
+                else row.get(key)
+                for column, key in _STAGING_COLUMNS[type_]
+            ]
+            for row in rows
+        ]
+        with connection.cursor() as cursor:
+            if self.vendor == "postgresql":
+                data = io.StringIO()
+                for value in values:
+                    data.write("\t".join(_copy_value(v) for v in value) + "\n")
+                data.seek(0)
+                cursor.copy_expert(
+                    f"COPY {table} ({', '.join(columns)}) FROM STDIN", data
+                )
+            else:
+                cursor.executemany(
+                    f"INSERT INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join(['%s'] * len(columns))})",
+                    values,
+                )
+
+    def _allocate_ids(self, type_, table):
+        sql = _ALLOCATE_SQL[self.vendor].format(chunk=f"import_{type_}", table=table)
+        self._execute(sql)
+
+    def _flush(self, buffers):
+        """Import the buffered rows, in dependency order, in one transaction.
+
+        Raises ImportFailed, naming the rows, if the database rejects them.
+        """
+
+        try:
+            self._merge(buffers)
+        except DatabaseError as exc:
+            raise ImportFailed(
+                f"Rows {self.flushed + 1}-{self.read} couldn't be imported "
+                f"(the rows before them were): {str(exc).strip()}"
+            ) from exc
+        self.flushed = self.read
+        for rows in buffers.values():
+            rows.clear()
+        if self.progress is not None:
+            self.progress(self.imported, self.read, time.perf_counter() - self.start)
+
+    def _merge(self, buffers):
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        with transaction.atomic():
+            if buffers["box"]:
+                self._stage("box", buffers["box"])
+                self.imported["box"] += self._execute(_MERGE_BOXES_SQL, [now])
+            if buffers["post"]:
+                self._stage("post", buffers["post"])
+                self._execute(_CREATE_SENDERS_SQL, [False, False, True, now])
+                self._allocate_ids("post", self.tables["posts"])
+                self.imported["post"] += self._execute(_MERGE_POSTS_SQL)
+                self._execute(_MAP_POSTS_SQL)
+            if buffers["deliveredpost"]:
+                self._stage("deliveredpost", buffers["deliveredpost"])
+                self._allocate_ids("deliveredpost", self.tables["dposts"])
+                self.imported["deliveredpost"] += self._execute(
+                    _MERGE_DELIVERED_POSTS_SQL
+                )
+                self._execute(_MAP_DELIVERED_POSTS_SQL)
+            if buffers["subscription"]:
+                self._stage("subscription", buffers["subscription"])
+                self.imported["subscription"] += self._execute(
+                    _MERGE_SUBSCRIPTIONS_SQL, [now]
+                )
+
+
+def read_ndjson(stream):
+    """Yield the rows of an export, from a binary stream of newline-delimited JSON."""
+
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            raise ValueError(f"Line {number}: JSON parse error - {exc}")
+
+
+def _header(message, name):
+    value = message.get(name)
+    if value is None:
+        return ""
+    return str(email.header.make_header(email.header.decode_header(value)))
+
+
+def _body(message):
+    """The message's plain text, or its first plain text part."""
+
+    part = next(
+        (
+            part
+            for part in message.walk()
+            if part.get_content_type() == "text/plain" and not part.is_multipart()
+        ),
+        None,
+    )
+    if part is None:
+        return ""
+    payload = part.get_payload(decode=True) or b""
+    return payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+
+
+def read_mbox(path, box_name):
+    """Yield export rows for the messages in an mbox file, delivered to the given box.
+
+    The sender is the local part of the From address. Messages with an R in
+    their Status header are marked read.
+    """
+
+    yield {"type": "box", "name": box_name}
+    for number, message in enumerate(mailbox.mbox(path, create=False), start=1):
+        _, address = email.utils.parseaddr(message.get("From", ""))
+        try:
+            created = email.utils.parsedate_to_datetime(message.get("Date"))
+        except (TypeError, ValueError):
+            created = timezone.now()
+        if timezone.is_naive(created):
+            created = timezone.make_aware(created, timezone.utc)
+        yield {
+            "type": "post",
+            "id": number,
+            "sender": (address.partition("@")[0] or "unknown")[:150],
+            "created": created,
+            "subject": _header(message, "Subject")[:255],
+            "content_type": "text/x-markdown",
+            "body": _body(message),
+        }
+        yield {
+            "type": "deliveredpost",
+            "id": number,
+            "box": box_name,
+            "post": number,
+            "created": created,
+            "is_read": "R" in message.get("Status", ""),
+        }
@@ -0,0 +1,59 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+
+class AgentCommand(BaseCommand):
+    """Base class for commands that run an agent until it's told to stop.
+
+    Subclasses implement create_agent, and may add arguments of their own.
+    """
+
+    # What the agent is called in the command's output.
+    agent_name = "Agent"
+
+    # The default number of seconds to wait when there's nothing to do.
+    default_interval = 5.0
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=4, help="Number of worker threads."
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Maximum number of jobs to run per pass.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=self.default_interval,
+            help="Seconds to wait before looking again when there's nothing to do.",
+        )
+        parser.add_argument(
+            "--once", action="store_true", help="Run a single pass, then exit."
+        )
+
+    def create_agent(self, options):
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        agent = self.create_agent(options)
+
+        def stop(signum, frame):
+            self.stdout.write("Shutting down after in-flight deliveries finish...")
+            agent.stop()
+
+        handlers = {
+            sig: signal.signal(sig, stop) for sig in (signal.SIGINT, signal.SIGTERM)
+        }
+        try:
+            self.stdout.write(
+                f"{self.agent_name} running with {agent.workers} workers."
+            )
+            agent.run(once=options["once"])
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+        self.stdout.write(f"{self.agent_name} stopped.")
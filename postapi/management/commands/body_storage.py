@@ -0,0 +1,146 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+from django.db.models.functions import Length
+from django.utils import timezone
+
+from postapi import bodystore
+from postapi.models import Post, PostBody
+
+# Stored bodies younger than this are never pruned, in case the post that
+# stored one is still being created.
+PRUNE_MIN_AGE = datetime.timedelta(hours=1)
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports how much space post bodies take, and how much the body store "
+        "saves or would save. Optionally moves inline bodies into the store "
+        "first, and removes stored bodies that no post uses any more. "
+        "On PostgreSQL, VACUUM FULL the post table afterwards to give the space "
+        "back to the system."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--compact",
+            action="store_true",
+            help="Move the bodies of existing posts into the body store.",
+        )
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            help="Delete stored bodies that no post refers to.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of posts to compact per transaction.",
+        )
+        parser.add_argument(
+            "--sample",
+            type=int,
+            default=1000,
+            help="Number of distinct inline bodies to compress to estimate "
+            "what the body store would save.",
+        )
+
+    def handle(self, *args, **options):
+        if options["sample"] < 1:
+            raise CommandError("--sample must be at least 1.")
+        if options["compact"]:
+            moved = self.compact(options["batch_size"])
+            self.stdout.write(f"Moved {moved} bodies into the body store.")
+        if options["prune"]:
+            unused = Post.objects.filter(stored_body=OuterRef("pk"))
+            pruned, _ = (
+                PostBody.objects.filter(created__lt=timezone.now() - PRUNE_MIN_AGE)
+                .exclude(Exists(unused))
+                .delete()
+            )
+            self.stdout.write(f"Pruned {pruned} unused bodies.")
+        self.report(options["sample"])
+
+    def compact(self, batch_size):
+        moved, last = 0, 0
+        while True:
+            with transaction.atomic():
+                posts = list(
+                    Post.objects.filter(id__gt=last, stored_body__isnull=True)
+                    .exclude(body_text="")
+                    .order_by("id")
+                    .only("id", "body_text", "stored_body")[:batch_size]
+                )
+                if not posts:
+                    return moved
+                PostBody.objects.store(posts)
+                Post.objects.bulk_update(posts, ["body_text", "stored_body"])
+            moved += len(posts)
+            last = posts[-1].id
+
+    def report(self, sample_size):
+        posts = Post.objects.aggregate(
+            total=Count("id"),
+            stored=Count("id", filter=Q(stored_body__isnull=False)),
+            stored_size=Sum("stored_body__size"),
+        )
+        store = PostBody.objects.aggregate(
+            bodies=Count("digest"), size=Sum("size"), data=Sum(Length("data"))
+        )
+
+        # What the inline bodies take now, and would take in the store. The
+        # database groups identical bodies, and a sample of the distinct ones
+        # is compressed to estimate the rest.
+        distinct = (
+            Post.objects.filter(stored_body__isnull=True)
+            .exclude(body_text="")
+            .aggregate(n=Count("body_text", distinct=True))["n"]
+        )
+        step = max(1, distinct // sample_size)
+        inline, inline_size, bodies, distinct_size = 0, 0, 0, 0
+        sampled, sampled_size, estimate = 0, 0, 0
+        rows = (
+            Post.objects.filter(stored_body__isnull=True)
+            .values_list("body_text")
+            .annotate(n=Count("id"))
+            .order_by()
+            .iterator(chunk_size=1000)
+        )
+        for text, n in rows:
+            size = len(text.encode())
+            inline += n
+            inline_size += size * n
+            if not text:
+                continue
+            if bodies % step == 0 and sampled < sample_size:
+                sampled += 1
+                sampled_size += size
+                estimate += len(bodystore.compress(text)[1])
+            bodies += 1
+            distinct_size += size
+        if sampled_size:
+            estimate = round(estimate * distinct_size / sampled_size)
+
+        stored_size = posts["stored_size"] or 0
+        store_data = store["data"] or 0
+        self.stdout.write(
+            f"Posts: {posts['total']} ({inline} inline, {posts['stored']} in the "
+            "body store)"
+        )
+        self.stdout.write(
+            f"Inline bodies: {inline_size:,} bytes, {distinct} distinct; "
+            f"about {estimate:,} bytes in the body store"
+        )
+        self.stdout.write(
+            f"Body store: {store['bodies']} bodies, {store['size'] or 0:,} bytes "
+            f"stored in {store_data:,}, for {stored_size:,} bytes of post bodies"
+        )
+        used = inline_size + store_data
+        bodies = inline_size + stored_size
+        ratio = f" ({bodies / used:.1f}x smaller)" if used else ""
+        self.stdout.write(
+            f"Total: {used:,} bytes for {bodies:,} bytes of post bodies{ratio}"
+        )
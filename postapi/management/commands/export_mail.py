@@ -0,0 +1,74 @@
+import gzip
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from postapi.export import export_lines, parse_position
+from postapi.models import Box
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports the message store, or a single box, as newline-delimited JSON, "
+        "for backup or migration. Runs in constant memory, however large the store."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--box", help="Export only this box.")
+        parser.add_argument(
+            "--output",
+            help="File to write to; stdout by default. Gzipped if it ends in .gz.",
+        )
+        parser.add_argument(
+            "--gzip", action="store_true", help="Gzip the output, even to stdout."
+        )
+        parser.add_argument(
+            "--after",
+            help='Resume after this position, e.g. "post:1234": the type and ID '
+            "of the last line written.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=None,
+            help="Number of rows to fetch from the database at a time.",
+        )
+
+    def handle(self, *args, **options):
+        box = None
+        if options["box"]:
+            try:
+                box = Box.objects.get(name=options["box"])
+            except Box.DoesNotExist:
+                raise CommandError(f'No box named "{options["box"]}".')
+        try:
+            after = parse_position(options["after"]) if options["after"] else None
+        except ValueError as exc:
+            raise CommandError(f"Invalid --after: {exc}")
+
+        lines = export_lines(box, after, options["chunk_size"])
+        output = options["output"]
+        compress = options["gzip"] or (output or "").endswith(".gz")
+        if output:
+            with open(output, "wb") as out:
+                count = self.write_lines(lines, out, compress)
+        elif compress:
+            count = self.write_lines(lines, sys.stdout.buffer, compress)
+        else:
+            count = 0
+            for line in lines:
+                self.stdout.write(line.decode(), ending="")
+                count += 1
+        self.stderr.write(f"Exported {count} objects.")
+
+    def write_lines(self, lines, out, compress):
+        """Write the lines to a binary file, returning how many were written."""
+
+        if compress:
+            with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+                return self.write_lines(lines, gz, False)
+        count = 0
+        for line in lines:
+            out.write(line)
+            count += 1
+        return count
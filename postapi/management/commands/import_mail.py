@@ -0,0 +1,64 @@
+import gzip
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from postapi.importer import ImportFailed, Importer, read_mbox, read_ndjson
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports mail in bulk from an export (newline-delimited JSON, as written "
+        "by export_mail) or an mbox file. Rows are loaded into staging tables "
+        "(with COPY on PostgreSQL) and merged a chunk at a time, each chunk in "
+        "its own transaction."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "input",
+            help='The file to import, which may be gzipped, or "-" to read an '
+            "export from stdin.",
+        )
+        parser.add_argument(
+            "--format",
+            choices=("ndjson", "mbox"),
+            help="The input format. By default, mbox if the file name ends in "
+            ".mbox, and ndjson otherwise.",
+        )
+        parser.add_argument(
+            "--box", help="The box to deliver the messages in an mbox file to."
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=None,
+            help="Number of input rows to load and merge per transaction.",
+        )
+
+    def progress(self, imported, read, elapsed):
+        counts = ", ".join(f"{count} {type_}s" for type_, count in imported.items())
+        rate = read / elapsed if elapsed else 0
+        self.stderr.write(
+            f"Read {read} rows in {elapsed:.1f}s ({rate:.0f} rows/s); "
+            f"imported {counts or 'nothing'}."
+        )
+
+    def handle(self, *args, **options):
+        path = options["input"]
+        format = options["format"] or ("mbox" if path.endswith(".mbox") else "ndjson")
+        importer = Importer(chunk_size=options["chunk_size"], progress=self.progress)
+        try:
+            if format == "mbox":
+                if not options["box"]:
+                    raise CommandError("Importing an mbox file requires --box.")
+                importer.run(read_mbox(path, options["box"]))
+            elif path == "-":
+                importer.run(read_ndjson(sys.stdin.buffer))
+            else:
+                opener = gzip.open if path.endswith(".gz") else open
+                with opener(path, "rb") as stream:
+                    importer.run(read_ndjson(stream))
+        except (OSError, ValueError, ImportFailed) as exc:
+            raise CommandError(str(exc))
+        self.stdout.write("Import complete.")
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from postapi.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the posts in every box and repairs the box counters that have "
+        "drifted. Safe to run while the API is serving; run it periodically, "
+        "e.g. nightly from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of boxes to recount per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        checked, repaired = reconcile_counters(batch_size=options["batch_size"])
+        self.stdout.write(f"Checked {checked} boxes, repaired {repaired} counters.")
@@ -0,0 +1,32 @@
+import datetime
+
+from postapi.agents import DeliveryAgent
+from postapi.management.base import AgentCommand
+
+
+class Command(AgentCommand):
+    help = (
+        "Runs a pool of workers that deliver subscription posts in the background, "
+        "most recently active boxes first. Stops cleanly on SIGINT or SIGTERM."
+    )
+    agent_name = "Delivery agent"
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--active-within",
+            type=float,
+            metavar="HOURS",
+            help="Only sync boxes that have been read within this many hours.",
+        )
+
+    def create_agent(self, options):
+        active_within = None
+        if options["active_within"] is not None:
+            active_within = datetime.timedelta(hours=options["active_within"])
+        return DeliveryAgent(
+            workers=options["workers"],
+            interval=options["interval"],
+            batch_size=options["batch_size"],
+            active_within=active_within,
+        )
@@ -0,0 +1,18 @@
+from postapi.agents import DeliveryQueueAgent
+from postapi.management.base import AgentCommand
+
+
+class Command(AgentCommand):
+    help = (
+        "Runs a pool of workers that deliver queued (deferred) posts, oldest first. "
+        "Several of these may run at once. Stops cleanly on SIGINT or SIGTERM."
+    )
+    agent_name = "Delivery queue"
+    default_interval = 1.0
+
+    def create_agent(self, options):
+        return DeliveryQueueAgent(
+            workers=options["workers"],
+            interval=options["interval"],
+            batch_size=options["batch_size"],
+        )
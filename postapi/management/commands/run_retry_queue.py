@@ -0,0 +1,17 @@
+from postapi.agents import DeliveryRetryAgent
+from postapi.management.base import AgentCommand
+
+
+class Command(AgentCommand):
+    help = (
+        "Runs a pool of workers that retry failed deliveries as they come due, "
+        "backing off further after each failure. Stops cleanly on SIGINT or SIGTERM."
+    )
+    agent_name = "Retry queue"
+
+    def create_agent(self, options):
+        return DeliveryRetryAgent(
+            workers=options["workers"],
+            interval=options["interval"],
+            batch_size=options["batch_size"],
+        )
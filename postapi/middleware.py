@@ -0,0 +1,52 @@
+import re
+
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_accepts_br = re.compile(r"\bbr\b").search
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """Compresses API responses with brotli or gzip, if the client accepts it.
+
+    Brotli is preferred when the client accepts it and the brotli package is
+    installed; otherwise gzip is used, as by Django's GZipMiddleware.
+    Streaming responses are always gzipped.
+
+    HTML pages are left alone: they carry CSRF tokens, which compression
+    would expose to the BREACH attack.
+    """
+
+    min_length = 200
+
+    def process_response(self, request, response):
+        if response.get("Content-Type", "").startswith("text/html"):
+            return response
+        if (
+            brotli is None
+            or response.streaming
+            or response.has_header("Content-Encoding")
+            or len(response.content) < self.min_length
+            or not _accepts_br(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        ):
+            return super(CompressionMiddleware, self).process_response(
+                request, response
+            )
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        compressed = brotli.compress(response.content)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response.headers["Content-Length"] = str(len(response.content))
+        # The compressed body is no longer byte-for-byte what a strong ETag promises.
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = "br"
+        return response
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.5 on 2026-10-16 22:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="deliveredpost",
+            index=models.Index(fields=["box", "id"], name="deliveredpost_box_id_idx"),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-16 22:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0002_deliveredpost_box_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="box",
+            name="last_active",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,58 @@
+import django.core.validators
+from django.db import migrations, models
+
+
+def copy_watermarks(apps, schema_editor):
+    """Carry each subscription's watermark over as a plain position.
+
+    Subscriptions without a watermark start from the beginning of the source
+    box, which is what position 0 means.
+    """
+
+    Subscription = apps.get_model("postapi", "Subscription")
+    Subscription.objects.filter(watermark__isnull=False).update(
+        watermark_position=models.F("watermark")
+    )
+
+
+def restore_watermarks(apps, schema_editor):
+    """Point each watermark back at its DeliveredPost, if that post still exists."""
+
+    DeliveredPost = apps.get_model("postapi", "DeliveredPost")
+    Subscription = apps.get_model("postapi", "Subscription")
+    Subscription.objects.filter(
+        watermark_position__in=DeliveredPost.objects.values("id")
+    ).update(watermark=models.F("watermark_position"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0003_box_last_active"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="subscription",
+            name="watermark_position",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(copy_watermarks, restore_watermarks),
+        migrations.RemoveField(
+            model_name="subscription",
+            name="watermark",
+        ),
+        migrations.RenameField(
+            model_name="subscription",
+            old_name="watermark_position",
+            new_name="watermark",
+        ),
+        migrations.AlterField(
+            model_name="subscription",
+            name="watermark",
+            field=models.BigIntegerField(
+                default=0,
+                validators=[django.core.validators.MinValueValidator(0)],
+            ),
+        ),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 4.0.5 on 2026-10-16 22:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0004_subscription_watermark_position"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DeliveryJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("completed", models.DateTimeField(blank=True, null=True)),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="delivery_jobs",
+                        to="postapi.post",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("id",),
+            },
+        ),
+        migrations.CreateModel(
+            name="DeliveryJobRecipient",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("box_name", models.CharField(max_length=50)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("queued", "Queued"),
+                            ("delivered", "Delivered"),
+                            ("failed", "Failed"),
+                        ],
+                        default="queued",
+                        max_length=15,
+                    ),
+                ),
+                ("error", models.CharField(blank=True, max_length=255)),
+                ("updated", models.DateTimeField(auto_now=True)),
+                (
+                    "job",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="recipients",
+                        to="postapi.deliveryjob",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("id",),
+                "unique_together": {("job", "box_name")},
+            },
+        ),
+        migrations.AddIndex(
+            model_name="deliveryjob",
+            index=models.Index(
+                condition=models.Q(("completed__isnull", True)),
+                fields=["id"],
+                name="deliveryjob_pending_idx",
+            ),
+        ),
+    ]
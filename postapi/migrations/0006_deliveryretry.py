@@ -0,0 +1,91 @@
+# Generated by Django 4.0.5 on 2026-10-16 22:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0005_deliveryjob"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="deliveryjobrecipient",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("queued", "Queued"),
+                    ("delivered", "Delivered"),
+                    ("retrying", "Retrying"),
+                    ("failed", "Failed"),
+                ],
+                default="queued",
+                max_length=15,
+            ),
+        ),
+        migrations.CreateModel(
+            name="DeliveryRetry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("delivered", "Delivered"),
+                            ("dead", "Dead"),
+                        ],
+                        default="pending",
+                        max_length=15,
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField(default=1)),
+                ("next_attempt", models.DateTimeField()),
+                ("last_error", models.TextField(blank=True)),
+                ("resolved", models.DateTimeField(blank=True, null=True)),
+                (
+                    "box",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="postapi.box",
+                    ),
+                ),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="postapi.post",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "delivery retries",
+                "ordering": ("next_attempt",),
+            },
+        ),
+        migrations.AddIndex(
+            model_name="deliveryretry",
+            index=models.Index(
+                condition=models.Q(("status", "pending")),
+                fields=["next_attempt"],
+                name="deliveryretry_due_idx",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="deliveryretry",
+            unique_together={("box", "post")},
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.0.5 on 2026-10-16 23:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0006_deliveryretry"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="deliveredpost",
+            index=models.Index(
+                fields=["post_created", "id"], name="deliveredpost_created_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="deliveredpost",
+            index=models.Index(
+                fields=["box", "post_created", "id"],
+                name="deliveredpost_box_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="post",
+            index=models.Index(fields=["created", "id"], name="post_created_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="subscription",
+            index=models.Index(
+                fields=["created", "id"], name="subscription_created_id_idx"
+            ),
+        ),
+    ]
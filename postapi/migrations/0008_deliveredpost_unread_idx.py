@@ -0,0 +1,21 @@
+# Generated by Django 4.0.5 on 2026-10-16 23:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0007_keyset_pagination_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="deliveredpost",
+            index=models.Index(
+                condition=models.Q(("is_read", False)),
+                fields=["box"],
+                name="deliveredpost_unread_idx",
+            ),
+        ),
+    ]
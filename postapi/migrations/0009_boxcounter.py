@@ -0,0 +1,190 @@
+# Generated by Django 4.0.5 on 2026-10-16 23:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Each trigger folds the posts added to, removed from, or changed in a box
+# into the box's counter, and bumps its version.
+#
+# On PostgreSQL, the triggers run once per statement and see all the
+# affected rows at once, so a sync that copies thousands of posts into a box
+# updates its counter once. Counters are upserted in box order, so that
+# concurrent statements lock them in the same order.
+POSTGRESQL_TRIGGERS = """
+CREATE FUNCTION postapi_count_inserted_posts() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO postapi_boxcounter (box_id, total, unread, version)
+    SELECT box_id, count(*), count(*) FILTER (WHERE NOT is_read), 1
+    FROM new_posts
+    GROUP BY box_id
+    ORDER BY box_id
+    ON CONFLICT (box_id) DO UPDATE SET
+        total = postapi_boxcounter.total + EXCLUDED.total,
+        unread = postapi_boxcounter.unread + EXCLUDED.unread,
+        version = postapi_boxcounter.version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION postapi_count_deleted_posts() RETURNS trigger AS $$
+BEGIN
+    UPDATE postapi_boxcounter c SET
+        total = c.total - d.total,
+        unread = c.unread - d.unread,
+        version = c.version + 1
+    FROM (
+        SELECT box_id, count(*) AS total, count(*) FILTER (WHERE NOT is_read) AS unread
+        FROM old_posts
+        GROUP BY box_id
+    ) d
+    WHERE c.box_id = d.box_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION postapi_count_updated_posts() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO postapi_boxcounter (box_id, total, unread, version)
+    SELECT box_id, sum(total), sum(unread), 1
+    FROM (
+        SELECT box_id, 1 AS total, CASE WHEN is_read THEN 0 ELSE 1 END AS unread
+        FROM new_posts
+        UNION ALL
+        SELECT box_id, -1, CASE WHEN is_read THEN 0 ELSE -1 END
+        FROM old_posts
+    ) changes
+    GROUP BY box_id
+    ORDER BY box_id
+    ON CONFLICT (box_id) DO UPDATE SET
+        total = postapi_boxcounter.total + EXCLUDED.total,
+        unread = postapi_boxcounter.unread + EXCLUDED.unread,
+        version = postapi_boxcounter.version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER postapi_deliveredpost_count_insert
+    AFTER INSERT ON postapi_deliveredpost
+    REFERENCING NEW TABLE AS new_posts
+    FOR EACH STATEMENT EXECUTE PROCEDURE postapi_count_inserted_posts();
+
+CREATE TRIGGER postapi_deliveredpost_count_delete
+    AFTER DELETE ON postapi_deliveredpost
+    REFERENCING OLD TABLE AS old_posts
+    FOR EACH STATEMENT EXECUTE PROCEDURE postapi_count_deleted_posts();
+
+CREATE TRIGGER postapi_deliveredpost_count_update
+    AFTER UPDATE ON postapi_deliveredpost
+    REFERENCING OLD TABLE AS old_posts NEW TABLE AS new_posts
+    FOR EACH STATEMENT EXECUTE PROCEDURE postapi_count_updated_posts();
+"""
+
+POSTGRESQL_DROP_TRIGGERS = """
+DROP TRIGGER postapi_deliveredpost_count_insert ON postapi_deliveredpost;
+DROP TRIGGER postapi_deliveredpost_count_delete ON postapi_deliveredpost;
+DROP TRIGGER postapi_deliveredpost_count_update ON postapi_deliveredpost;
+DROP FUNCTION postapi_count_inserted_posts();
+DROP FUNCTION postapi_count_deleted_posts();
+DROP FUNCTION postapi_count_updated_posts();
+"""
+
+# SQLite only has row-level triggers.
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER postapi_deliveredpost_count_insert
+    AFTER INSERT ON postapi_deliveredpost
+    BEGIN
+        INSERT INTO postapi_boxcounter (box_id, total, unread, version)
+        VALUES (NEW.box_id, 1, NOT NEW.is_read, 1)
+        ON CONFLICT (box_id) DO UPDATE SET
+            total = total + 1, unread = unread + excluded.unread, version = version + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER postapi_deliveredpost_count_delete
+    AFTER DELETE ON postapi_deliveredpost
+    BEGIN
+        UPDATE postapi_boxcounter SET
+            total = total - 1, unread = unread - (NOT OLD.is_read), version = version + 1
+        WHERE box_id = OLD.box_id;
+    END
+    """,
+    """
+    CREATE TRIGGER postapi_deliveredpost_count_update
+    AFTER UPDATE ON postapi_deliveredpost
+    BEGIN
+        UPDATE postapi_boxcounter SET
+            total = total - 1, unread = unread - (NOT OLD.is_read), version = version + 1
+        WHERE box_id = OLD.box_id;
+        INSERT INTO postapi_boxcounter (box_id, total, unread, version)
+        VALUES (NEW.box_id, 1, NOT NEW.is_read, 1)
+        ON CONFLICT (box_id) DO UPDATE SET
+            total = total + 1, unread = unread + excluded.unread, version = version + 1;
+    END
+    """,
+]
+
+SQLITE_DROP_TRIGGERS = [
+    "DROP TRIGGER postapi_deliveredpost_count_insert",
+    "DROP TRIGGER postapi_deliveredpost_count_delete",
+    "DROP TRIGGER postapi_deliveredpost_count_update",
+]
+
+COUNT_EXISTING_POSTS = """
+INSERT INTO postapi_boxcounter (box_id, total, unread, version)
+SELECT box_id, count(*), sum(CASE WHEN is_read THEN 0 ELSE 1 END), 1
+FROM postapi_deliveredpost
+GROUP BY box_id
+"""
+
+
+def create_triggers(apps, schema_editor):
+    """Count the posts already delivered, then keep counting with triggers."""
+
+    vendor = schema_editor.connection.vendor
+    schema_editor.execute(COUNT_EXISTING_POSTS)
+    if vendor == "postgresql":
+        schema_editor.execute(POSTGRESQL_TRIGGERS)
+    elif vendor == "sqlite":
+        for sql in SQLITE_TRIGGERS:
+            schema_editor.execute(sql)
+    else:
+        raise NotImplementedError(f"No box counter triggers for {vendor}")
+
+
+def drop_triggers(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute(POSTGRESQL_DROP_TRIGGERS)
+    elif vendor == "sqlite":
+        for sql in SQLITE_DROP_TRIGGERS:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0008_deliveredpost_unread_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BoxCounter",
+            fields=[
+                (
+                    "box",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="counter",
+                        serialize=False,
+                        to="postapi.box",
+                    ),
+                ),
+                ("total", models.BigIntegerField(default=0)),
+                ("unread", models.BigIntegerField(default=0)),
+                ("version", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
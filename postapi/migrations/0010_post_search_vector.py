@@ -0,0 +1,45 @@
+from django.db import migrations
+
+# Posts are searched through a tsvector of their subject and body, weighted
+# so that a match in the subject ranks above one in the body. It's a
+# generated column, so PostgreSQL maintains it on every insert and update,
+# however the post was written, and a GIN index serves the @@ match.
+#
+# The column isn't a model field: it only exists on PostgreSQL, and is only
+# read through postapi.search.
+POSTGRESQL_SEARCH_VECTOR = """
+ALTER TABLE postapi_post ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', subject), 'A')
+        || setweight(to_tsvector('english', body), 'B')
+    ) STORED;
+CREATE INDEX postapi_post_search_idx ON postapi_post USING gin (search_vector);
+"""
+
+POSTGRESQL_DROP_SEARCH_VECTOR = """
+DROP INDEX postapi_post_search_idx;
+ALTER TABLE postapi_post DROP COLUMN search_vector;
+"""
+
+
+def create_search_vector(apps, schema_editor):
+    """Index posts for full-text search. Other databases search without an index."""
+
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(POSTGRESQL_SEARCH_VECTOR)
+
+
+def drop_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(POSTGRESQL_DROP_SEARCH_VECTOR)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0009_boxcounter"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_vector, drop_search_vector),
+    ]
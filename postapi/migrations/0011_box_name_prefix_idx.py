@@ -0,0 +1,37 @@
+from django.db import migrations
+
+# Box names are autocompleted by case-insensitive prefix, which an index on
+# the name itself can't serve. On PostgreSQL, text_pattern_ops lets the
+# index serve LIKE 'prefix%' whatever the database's collation. SQLite
+# can't use an index for a case-insensitive LIKE, so there the prefix is
+# searched as a range of lower(name) instead (see BoxQuerySet.name_prefix).
+CREATE_INDEX = {
+    "postgresql": (
+        "CREATE INDEX box_name_prefix_idx ON postapi_box (lower(name) text_pattern_ops)"
+    ),
+    "sqlite": "CREATE INDEX box_name_prefix_idx ON postapi_box (lower(name))",
+}
+
+DROP_INDEX = "DROP INDEX box_name_prefix_idx"
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in CREATE_INDEX:
+        raise NotImplementedError(f"No box name prefix index for {vendor}")
+    schema_editor.execute(CREATE_INDEX[vendor])
+
+
+def drop_index(apps, schema_editor):
+    schema_editor.execute(DROP_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0010_post_search_vector"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
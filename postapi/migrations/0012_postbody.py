@@ -0,0 +1,122 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+# A post in the body store has an empty body column, so its search vector
+# can't be generated from the post row alone any more. Each stored body
+# gets its own vector, computed from its text when it's stored (see
+# PostBodyQuerySet.store), and the post's vector becomes a plain column
+# that a trigger fills from the subject and either the body column or the
+# stored body's vector.
+POSTGRESQL_SEARCH_TRIGGER = """
+ALTER TABLE postapi_post ALTER COLUMN search_vector DROP EXPRESSION;
+ALTER TABLE postapi_postbody ADD COLUMN search_vector tsvector;
+
+CREATE FUNCTION postapi_post_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := setweight(to_tsvector('english', NEW.subject), 'A')
+        || setweight(
+            CASE WHEN NEW.stored_body_id IS NULL
+                THEN to_tsvector('english', NEW.body)
+                ELSE coalesce(
+                    (SELECT search_vector FROM postapi_postbody
+                     WHERE digest = NEW.stored_body_id),
+                    ''::tsvector
+                )
+            END,
+            'B'
+        );
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER postapi_post_search_vector
+    BEFORE INSERT OR UPDATE OF subject, body, stored_body_id ON postapi_post
+    FOR EACH ROW EXECUTE PROCEDURE postapi_post_search_vector();
+"""
+
+# Going back, the generated column is restored, so every body must be
+# inline again.
+POSTGRESQL_DROP_SEARCH_TRIGGER = """
+DROP TRIGGER postapi_post_search_vector ON postapi_post;
+DROP FUNCTION postapi_post_search_vector();
+ALTER TABLE postapi_postbody DROP COLUMN search_vector;
+ALTER TABLE postapi_post DROP COLUMN search_vector;
+ALTER TABLE postapi_post ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', subject), 'A')
+        || setweight(to_tsvector('english', body), 'B')
+    ) STORED;
+CREATE INDEX postapi_post_search_idx ON postapi_post USING gin (search_vector);
+"""
+
+
+def create_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(POSTGRESQL_SEARCH_TRIGGER)
+
+
+def drop_search_trigger(apps, schema_editor):
+    Post = apps.get_model("postapi", "Post")
+    if Post.objects.filter(stored_body__isnull=False).exists():
+        raise RuntimeError("Move stored bodies back into posts before unapplying")
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(POSTGRESQL_DROP_SEARCH_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0011_box_name_prefix_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PostBody",
+            fields=[
+                (
+                    "digest",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                (
+                    "compression",
+                    models.CharField(
+                        blank=True,
+                        choices=[("", "None"), ("zlib", "zlib"), ("zstd", "zstd")],
+                        max_length=8,
+                    ),
+                ),
+                ("data", models.BinaryField()),
+                ("size", models.PositiveIntegerField()),
+                ("created", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name_plural": "post bodies",
+            },
+        ),
+        # The body column stays as it is; only the field's name changes, to
+        # make way for the Post.body property.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name="post", old_name="body", new_name="body_text"
+                ),
+                migrations.AlterField(
+                    model_name="post",
+                    name="body_text",
+                    field=models.TextField(blank=True, db_column="body"),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="stored_body",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="postapi.postbody",
+            ),
+        ),
+        migrations.RunPython(create_search_trigger, drop_search_trigger),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.5 on 2026-10-17 00:19
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("postapi", "0012_postbody"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="box",
+            options={"verbose_name_plural": "boxes"},
+        ),
+    ]
@@ -1,4 +1,52 @@
-from django.db import models
+import datetime
+
+from django.conf import settings
+from django.core.validators import MinValueValidator
+from django.db import connections, models
+from django.db.models import Exists, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce, Lower
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from postapi import bodystore
+
+# How often a box's activity timestamp is refreshed while it's in use.
+ACTIVITY_RESOLUTION = datetime.timedelta(minutes=1)
+
+
+class BoxQuerySet(models.QuerySet):
+    def with_summary(self):
+        """Annotate each box with a summary of its contents: total, unread, and newest.
+
+        The counts come from the box's counter, and the newest post is found
+        with an index, so the boxes are still fetched with a single query,
+        however many posts they hold.
+        """
+
+        posts = DeliveredPost.objects.filter(box=OuterRef("pk"))
+        return self.annotate(
+            total=Coalesce(F("counter__total"), 0),
+            unread=Coalesce(F("counter__unread"), 0),
+            newest=Subquery(posts.order_by("-post_created").values("post_created")[:1]),
+        )
+
+    def name_prefix(self, prefix):
+        """Filter for boxes whose name starts with the prefix, ignoring case.
+
+        The match is on lower(name), so it's served by box_name_prefix_idx
+        (see migration 0011).
+        """
+
+        prefix = prefix.lower()
+        boxes = self.alias(lower_name=Lower("name"))
+        if not prefix:
+            return boxes
+        if connections[self.db].vendor == "postgresql":
+            return boxes.filter(lower_name__startswith=prefix)
+        # Everything starting with the prefix sorts between it and the
+        # prefix with its last character incremented.
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return boxes.filter(lower_name__gte=prefix, lower_name__lt=end)
 
 
 class Box(models.Model):
@@ -7,6 +55,28 @@ class Box(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     name = models.SlugField(unique=True)
 
+    # When the box's mail was last retrieved. Background delivery favors
+    # recently active boxes; null means the box has never been read.
+    last_active = models.DateTimeField(blank=True, null=True)
+
+    objects = BoxQuerySet.as_manager()
+
+    def mark_active(self):
+        """Record that the box's mail is being read right now."""
+
+        now = timezone.now()
+        # Only write if the timestamp is stale, so busy boxes don't cost a write per read.
+        updated = (
+            Box.objects.filter(id=self.id)
+            .filter(
+                Q(last_active__isnull=True)
+                | Q(last_active__lt=now - ACTIVITY_RESOLUTION)
+            )
+            .update(last_active=now)
+        )
+        if updated:
+            self.last_active = now
+
     def __str__(self):
         return self.name
 
@@ -17,6 +87,107 @@ class Box(models.Model):
 POST_CONTENT_TYPE_CHOICES = (("text/x-markdown", "Markdown"),)
 
 
+class BoxCounter(models.Model):
+    """Running counts of the posts in a box.
+
+    These are kept up to date by database triggers on DeliveredPost (see
+    migration 0009), so every way of adding, removing, or marking posts is
+    counted in the same transaction. A box with no posts may have no counter.
+    The reconcile_counters command repairs any drift.
+    """
+
+    box = models.OneToOneField(
+        "Box", primary_key=True, related_name="counter", on_delete=models.CASCADE
+    )
+    total = models.BigIntegerField(default=0)
+    unread = models.BigIntegerField(default=0)
+
+    # Bumped whenever the box's posts change.
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.box_id}: {self.unread}/{self.total}"
+
+
+class PostBodyQuerySet(models.QuerySet):
+    def store(self, posts):
+        """Move the posts' bodies into the store. The posts themselves aren't saved.
+
+        Each distinct body is digested, and those not stored yet are
+        compressed and inserted in one statement. Empty bodies stay inline.
+        """
+
+        keyed = [
+            (post, bodystore.digest(post.body_text))
+            for post in posts
+            if post.stored_body_id is None and post.body_text
+        ]
+        texts = {key: post.body_text for post, key in keyed}
+        if not texts:
+            return
+        existing = set(self.filter(digest__in=texts).values_list("digest", flat=True))
+        bodies = {}
+        for key, text in texts.items():
+            if key in existing:
+                bodies[key] = PostBody(digest=key, size=len(text.encode()))
+            else:
+                compression, data = bodystore.compress(text)
+                bodies[key] = PostBody(
+                    digest=key,
+                    compression=compression,
+                    data=data,
+                    size=len(text.encode()),
+                )
+            # Save reading back what was just written.
+            bodies[key].text = text
+        new = [key for key in texts if key not in existing]
+        self.bulk_create([bodies[key] for key in new], ignore_conflicts=True)
+        if new and connections[self.db].vendor == "postgresql":
+            # Posts' search vectors include their bodies' (see migration 0012).
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE {PostBody._meta.db_table} b
+                    SET search_vector = to_tsvector('english', v.text)
+                    FROM unnest(%s::text[], %s::text[]) AS v(digest, text)
+                    WHERE b.digest = v.digest AND b.search_vector IS NULL
+                    """,
+                    [new, [texts[key] for key in new]],
+                )
+        for post, key in keyed:
+            post.stored_body, post.body_text = bodies[key], ""
+
+
+class PostBody(models.Model):
+    """A post body in the body store, shared by every post with the same body.
+
+    See postapi.bodystore. Bodies are never changed, and are only removed
+    by the body_storage command once no post refers to them.
+    """
+
+    # The SHA-256 digest of the text, in hex.
+    digest = models.CharField(max_length=64, primary_key=True)
+    compression = models.CharField(
+        choices=bodystore.COMPRESSION_CHOICES, blank=True, max_length=8
+    )
+    data = models.BinaryField()
+    # The length of the text, in bytes, before compression.
+    size = models.PositiveIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = PostBodyQuerySet.as_manager()
+
+    @cached_property
+    def text(self):
+        return bodystore.decompress(self.compression, self.data)
+
+    def __str__(self):
+        return f"{self.digest[:12]} ({self.size} bytes, {self.compression or 'raw'})"
+
+    class Meta:
+        verbose_name_plural = "post bodies"
+
+
 class Post(models.Model):
     """A document to be posted to one or more boxes."""
 
@@ -28,7 +199,32 @@ class Post(models.Model):
     content_type = models.CharField(
         choices=POST_CONTENT_TYPE_CHOICES, default="text/x-markdown", max_length=63
     )
-    body = models.TextField()
+    # The body, unless it's in the body store, in which case this is empty
+    # and stored_body has it. Read and write the body as post.body.
+    body_text = models.TextField(db_column="body", blank=True)
+    stored_body = models.ForeignKey(
+        "PostBody",
+        related_name="+",
+        on_delete=models.PROTECT,
+        blank=True,
+        null=True,
+    )
+
+    @property
+    def body(self):
+        if self.stored_body_id is None:
+            return self.body_text
+        return self.stored_body.text
+
+    @body.setter
+    def body(self, value):
+        self.body_text = value
+        self.stored_body = None
+
+    def save(self, *args, **kwargs):
+        if settings.POSTAPI_BODY_STORE:
+            PostBody.objects.store([self])
+        super(Post, self).save(*args, **kwargs)
 
     @property
     def subject_short(self):
@@ -43,6 +239,29 @@ class Post(models.Model):
 
     class Meta:
         ordering = ("created",)
+        indexes = [
+            # Backs paging through posts in order.
+            models.Index(fields=["created", "id"], name="post_created_id_idx"),
+        ]
+
+
+class DeliveredPostQuerySet(models.QuerySet):
+    def move_to(self, box):
+        """Move these delivered posts to another box, returning how many were moved.
+
+        A post can only be delivered to a box once, so where the box already
+        has the post, the copy being moved is deleted instead. Likewise, where
+        these hold the same post from several boxes, only the earliest copy is
+        moved and the others are deleted. Each step is a single statement; run
+        this in a transaction.
+        """
+
+        moving = self.exclude(box=box)
+        present = DeliveredPost.objects.filter(box=box, post=OuterRef("post"))
+        merged, _ = moving.filter(Exists(present)).delete()
+        earlier = moving.filter(post=OuterRef("post"), pk__lt=OuterRef("pk"))
+        collapsed, _ = moving.filter(Exists(earlier)).delete()
+        return merged + collapsed + moving.update(box=box)
 
 
 class DeliveredPost(models.Model):
@@ -68,6 +287,8 @@ class DeliveredPost(models.Model):
     post_created = models.DateTimeField()
     post_subject = models.CharField(max_length=255)
 
+    objects = DeliveredPostQuerySet.as_manager()
+
     def __str__(self):
         created_str = self.created.isoformat() if self.created else "???"
         return f"{self.post_sender} \u2192 {self.box.name} @ {created_str}"
@@ -76,6 +297,135 @@ class DeliveredPost(models.Model):
         # Make sure each message is delivered to the target box at most once!
         unique_together = ("box", "post")
         ordering = ("post_created",)
+        indexes = [
+            # Subscription processing scans source boxes in ID order.
+            models.Index(fields=["box", "id"], name="deliveredpost_box_id_idx"),
+            # Back paging through delivered posts in order, in all boxes or one.
+            models.Index(
+                fields=["post_created", "id"], name="deliveredpost_created_id_idx"
+            ),
+            models.Index(
+                fields=["box", "post_created", "id"],
+                name="deliveredpost_box_created_idx",
+            ),
+            # Backs counting a box's unread posts.
+            models.Index(
+                fields=["box"],
+                condition=Q(is_read=False),
+                name="deliveredpost_unread_idx",
+            ),
+        ]
+
+
+DELIVERY_STATUS_CHOICES = (
+    ("queued", "Queued"),
+    ("delivered", "Delivered"),
+    ("retrying", "Retrying"),
+    ("failed", "Failed"),
+)
+
+
+class DeliveryJob(models.Model):
+    """A post waiting in the queue to be delivered to a list of boxes."""
+
+    post = models.ForeignKey(
+        "Post", related_name="delivery_jobs", on_delete=models.CASCADE
+    )
+    created = models.DateTimeField(auto_now_add=True)
+
+    # When the queue finished with the job; null while it's still pending.
+    completed = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Delivery of post {self.post_id}"
+
+    class Meta:
+        ordering = ("id",)
+        indexes = [
+            # Queue processors pick up pending jobs oldest first.
+            models.Index(
+                fields=["id"],
+                condition=Q(completed__isnull=True),
+                name="deliveryjob_pending_idx",
+            ),
+        ]
+
+
+class DeliveryJobRecipient(models.Model):
+    """A box that a queued post is addressed to, and what became of the delivery."""
+
+    QUEUED = "queued"
+    DELIVERED = "delivered"
+    RETRYING = "retrying"
+    FAILED = "failed"
+
+    job = models.ForeignKey(
+        "DeliveryJob", related_name="recipients", on_delete=models.CASCADE
+    )
+
+    # The box is named rather than referenced, since it's only looked up
+    # when the job runs, and may not exist.
+    box_name = models.CharField(max_length=50)
+    status = models.CharField(
+        choices=DELIVERY_STATUS_CHOICES, default=QUEUED, max_length=15
+    )
+    error = models.CharField(max_length=255, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.box_name}: {self.status}"
+
+    class Meta:
+        unique_together = ("job", "box_name")
+        ordering = ("id",)
+
+
+RETRY_STATUS_CHOICES = (
+    ("pending", "Pending"),
+    ("delivered", "Delivered"),
+    ("dead", "Dead"),
+)
+
+
+class DeliveryRetry(models.Model):
+    """A delivery of a post to a box that failed, parked to be tried again later."""
+
+    PENDING = "pending"
+    DELIVERED = "delivered"
+    DEAD = "dead"
+
+    box = models.ForeignKey("Box", related_name="+", on_delete=models.CASCADE)
+    post = models.ForeignKey("Post", related_name="+", on_delete=models.CASCADE)
+
+    # When the delivery first failed.
+    created = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(
+        choices=RETRY_STATUS_CHOICES, default=PENDING, max_length=15
+    )
+
+    # The number of failed attempts so far, including the first.
+    attempts = models.PositiveIntegerField(default=1)
+    next_attempt = models.DateTimeField()
+    last_error = models.TextField(blank=True)
+
+    # When the post was finally delivered, or given up on.
+    resolved = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Post {self.post_id} \u2192 box {self.box_id}: {self.status}"
+
+    class Meta:
+        unique_together = ("box", "post")
+        ordering = ("next_attempt",)
+        verbose_name_plural = "delivery retries"
+        indexes = [
+            # The retry scheduler picks up pending retries as they come due.
+            models.Index(
+                fields=["next_attempt"],
+                condition=Q(status="pending"),
+                name="deliveryretry_due_idx",
+            ),
+        ]
 
 
 class Subscription(models.Model):
@@ -96,21 +446,23 @@ class Subscription(models.Model):
         "Box", related_name="subscriptions_to", on_delete=models.CASCADE
     )
 
-    # The watermark tracks either the last message we've pulled from the source,
-    # OR, if this is a brand-new subscription, it tracks the last post after
-    # which our subscription takes effect. If it's null, we will start from the
-    # first message delivered to the source box.
+    # The watermark is the ID of the source DeliveredPost we've pulled up to:
+    # either the last message we've pulled from the source, OR, if this is a
+    # brand-new subscription, the last post after which our subscription takes
+    # effect. If it's 0, we will start from the first message delivered to the
+    # source box.
     #
-    # IMPORTANT: we assume the keys will be monotonically increasing with time!
+    # The watermark is a plain ID rather than a foreign key, so that it keeps
+    # its place even if the DeliveredPost it names gets deleted.
     #
-    # FIXME: do better than SET_NULL
-    # Using a SET_NULL constraint here means we restart the subscription
-    # if the latest DeliveredPost associated with the subscription ever gets deleted.
-    watermark = models.ForeignKey(
-        "DeliveredPost", blank=True, null=True, on_delete=models.SET_NULL
-    )
+    # IMPORTANT: we assume the keys will be monotonically increasing with time!
+    watermark = models.BigIntegerField(default=0, validators=[MinValueValidator(0)])
 
     class Meta:
         # Make sure there is at most one subscription between any two boxes!
         unique_together = ("source", "target")
         ordering = ("created",)
+        indexes = [
+            # Backs paging through subscriptions in order.
+            models.Index(fields=["created", "id"], name="subscription_created_id_idx"),
+        ]
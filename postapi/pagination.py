@@ -0,0 +1,145 @@
+import base64
+import binascii
+import json
+import types
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Pages through a list in the order given by the view's `ordering`.
+
+    The primary key is added to the ordering as a tie-breaker if it isn't
+    there already, so every row has a unique position. The cursor in the
+    `next` link holds the position of the last row on the page, and the next
+    page is fetched by filtering for rows after that position rather than by
+    skipping rows with OFFSET. With an index on the ordering fields, a deep
+    page costs the same as the first one.
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_ordering(self, view):
+        ordering = list(getattr(view, "ordering", None) or ["pk"])
+        if not any(field.lstrip("-") in ("pk", "id") for field in ordering):
+            ordering.append("pk")
+        return ordering
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def _field(self, model, name):
+        if name == "pk":
+            return model._meta.pk
+        return model._meta.get_field(name)
+
+    def encode_cursor(self, model, row):
+        if isinstance(row, dict):
+            # A row from .values(), keyed by the fields' attribute names.
+            row = types.SimpleNamespace(**row)
+        values = [
+            self._field(model, name.lstrip("-")).value_to_string(row)
+            for name in self.ordering
+        ]
+        cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, cursor
+        )
+
+    def decode_cursor(self, model):
+        cursor = self.request.query_params.get(self.cursor_query_param)
+        if cursor is None:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError("Cursor doesn't match the ordering")
+            return [
+                self._field(model, name.lstrip("-")).to_python(value)
+                for name, value in zip(self.ordering, values)
+            ]
+        except (TypeError, ValueError, ValidationError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+
+    def after(self, position):
+        """A filter for the rows after the given position in the ordering.
+
+        For an ordering (a, b, c), that's a > x, or a = x and b > y, or a = x
+        and b = y and c > z. The leading a >= x is redundant, but lets the
+        database start its index scan at the position.
+        """
+
+        lookups = [
+            (name.lstrip("-"), "lt" if name.startswith("-") else "gt")
+            for name in self.ordering
+        ]
+        after = Q()
+        for i, (name, op) in enumerate(lookups):
+            same = {lookups[j][0]: position[j] for j in range(i)}
+            after |= Q(**same, **{f"{name}__{op}": position[i]})
+        first, op = lookups[0]
+        return Q(**{f"{first}__{op}e": position[0]}) & after
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(view)
+        position = self.decode_cursor(queryset.model)
+
+        queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+        rows = list(queryset[: self.page_size + 1])
+        page = rows[: self.page_size]
+        self.next = None
+        if len(rows) > self.page_size:
+            self.next = self.encode_cursor(queryset.model, page[-1])
+        return page
+
+    def get_next_link(self):
+        return self.next
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([("next", self.next), ("results", data)]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True},
+                "results": schema,
+            },
+        }
+
+
+class SearchPagination(KeysetPagination):
+    """Pages through search results, best match first.
+
+    The view orders by the rank its queryset is annotated with, which isn't a
+    model field, so the cursor is read and written as a float.
+    """
+
+    def __init__(self):
+        self.rank_field = models.FloatField()
+        self.rank_field.set_attributes_from_name("rank")
+
+    def _field(self, model, name):
+        if name == "rank":
+            return self.rank_field
+        return super(SearchPagination, self)._field(model, name)
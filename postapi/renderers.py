@@ -0,0 +1,68 @@
+"""Faster renderers for the API.
+
+orjson and msgpack are optional. Without orjson, ORJSONRenderer renders
+with DRF's JSONRenderer; the MessagePack renderer is only offered (see
+REST_FRAMEWORK in the settings) when msgpack is installed.
+"""
+from rest_framework import renderers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class ORJSONRenderer(renderers.JSONRenderer):
+    """Renders JSON with orjson, several times faster than the json module.
+
+    The output is the same as DRF's JSONRenderer's. Indented output, which
+    orjson can't do to order, is left to DRF.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        renderer_context = renderer_context or {}
+        if (
+            orjson is None
+            or data is None
+            or self.get_indent(accepted_media_type, renderer_context)
+        ):
+            return super(ORJSONRenderer, self).render(
+                data, accepted_media_type, renderer_context
+            )
+
+        ret = orjson.dumps(
+            data,
+            default=self.encoder_class().default,
+            option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS,
+        )
+        # Like DRF, escape the line and paragraph separators, which are valid
+        # in JSON but not in JavaScript.
+        return ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(
+            b"\xe2\x80\xa9", b"\\u2029"
+        )
+
+
+class MessagePackRenderer(renderers.BaseRenderer):
+    """Renders MessagePack, a compact binary equivalent of JSON.
+
+    Values that JSON has no type for, such as times, are rendered as the
+    same strings as in JSON.
+    """
+
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+    encoder_class = renderers.JSONRenderer.encoder_class
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(
+            data, default=self.encoder_class().default, use_bin_type=True
+        )
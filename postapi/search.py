@@ -0,0 +1,146 @@
+"""Full-text search over the posts delivered to a box.
+
+On PostgreSQL, each post has a weighted tsvector of its subject and body in
+a column with a GIN index, kept up to date by a trigger that takes the
+body's vector from the body store for stored bodies (see migration 0012).
+Searches use web search syntax: words, "quoted phrases", OR, and -excluded
+words. Matching posts are found through the index, then the box's
+deliveries of them are ranked with ts_rank.
+
+Other databases fall back to matching each word or phrase of the search
+anywhere in the subject or body, without an index, and every match ranks the
+same.
+"""
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField, OuterRef, Q, Subquery, Value
+from django.db.models.expressions import RawSQL
+
+from postapi.models import DeliveredPost, Post, PostBody
+
+# The text search configuration the search vectors were built with.
+SEARCH_CONFIG = "english"
+
+# The column is left unqualified, since Django relabels the post table when
+# these are used in a subquery. The body store's table has a search_vector
+# too, but these are only used in queries on the post table alone.
+MATCH_SQL = "search_vector @@ websearch_to_tsquery(%s, %s)"
+# ts_rank gives a real, which is cast so that ranks round-trip exactly
+# through page cursors.
+RANK_SQL = "ts_rank(search_vector, websearch_to_tsquery(%s, %s))::float8"
+
+
+def matching_posts(query):
+    """The posts matching the search, found through the search index (PostgreSQL only)."""
+
+    return Post.objects.filter(
+        RawSQL(MATCH_SQL, [SEARCH_CONFIG, query], output_field=BooleanField())
+    )
+
+
+# A term of a web search: an optionally excluded "quoted phrase" or word.
+TERM_RE = re.compile(r'(-?)(?:"([^"]*)"?|(\S+))')
+
+
+def parse_query(query):
+    """Split a web search into clauses that must all match.
+
+    Each clause is a list of (text, excluded) terms, any one of which matches,
+    so "a b OR c -d" gives [[("a", False)], [("b", False), ("c", False)],
+    [("d", True)]]. Like websearch_to_tsquery, an OR with nothing before it
+    is ignored.
+    """
+
+    clauses, alternative = [], False
+    for match in TERM_RE.finditer(query):
+        excluded, phrase, word = match.groups()
+        if word == "OR" and not excluded:
+            alternative = bool(clauses)
+            continue
+        text = " ".join((word if phrase is None else phrase).split())
+        if not text:
+            continue
+        if alternative:
+            clauses[-1].append((text, bool(excluded)))
+        else:
+            clauses.append([(text, bool(excluded))])
+        alternative = False
+    return clauses
+
+
+def _stored_bodies_with(dposts, clauses):
+    """For each term, the digests of the stored bodies of these posts that contain it.
+
+    Stored bodies may be compressed, so they're read and searched here rather
+    than in the database. Posts whose subject matches every clause match
+    whatever their body holds, so their bodies aren't read.
+    """
+
+    terms = {text for clause in clauses for text, excluded in clause}
+    found = {text: set() for text in terms}
+    in_subject = Q()
+    for clause in clauses:
+        any_term = Q(pk__in=[])
+        for text, excluded in clause:
+            if not excluded:
+                any_term |= Q(post__subject__icontains=text)
+        in_subject &= any_term
+    candidates = dposts.filter(post__stored_body__isnull=False).exclude(in_subject)
+    bodies = PostBody.objects.filter(digest__in=candidates.values("post__stored_body"))
+    for body in bodies.only("digest", "compression", "data").iterator():
+        text = body.text.casefold()
+        for term in terms:
+            if term.casefold() in text:
+                found[term].add(body.digest)
+    return found
+
+
+def match_words(dposts, query):
+    """The delivered posts whose post matches the web search in its subject or body.
+
+    Words and phrases match anywhere, ignoring case, rather than stemmed. This
+    scans every post in the box, and decompresses the stored bodies of those
+    whose subject doesn't match, on every search, so it's only the fallback
+    where there's no index.
+    """
+
+    clauses = parse_query(query)
+    if not clauses:
+        return dposts.none()
+    stored = _stored_bodies_with(dposts, clauses)
+    for clause in clauses:
+        any_term = Q(pk__in=[])
+        for text, excluded in clause:
+            contains = (
+                Q(post__subject__icontains=text)
+                | Q(post__body_text__icontains=text)
+                | Q(post__stored_body__in=stored[text])
+            )
+            any_term |= ~contains if excluded else contains
+        dposts = dposts.filter(any_term)
+    return dposts
+
+
+def search_box(box, query):
+    """The box's delivered posts whose post matches the search, annotated with a rank.
+
+    A higher rank is a better match.
+    """
+
+    dposts = DeliveredPost.objects.filter(box=box)
+    if connection.vendor != "postgresql":
+        return match_words(dposts, query).annotate(
+            rank=Value(0.0, output_field=FloatField())
+        )
+
+    rank = (
+        Post.objects.filter(pk=OuterRef("post_id"))
+        .annotate(
+            rank=RawSQL(RANK_SQL, [SEARCH_CONFIG, query], output_field=FloatField())
+        )
+        .order_by()
+        .values("rank")
+    )
+    matches = matching_posts(query).order_by().values("pk")
+    return dposts.filter(post__in=matches).annotate(rank=Subquery(rank))
@@ -1,7 +1,68 @@
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from rest_framework import serializers
-from postapi.models import Box, DeliveredPost, Post, Subscription
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.reverse import reverse
+from postapi.models import (
+    Box,
+    DeliveredPost,
+    DeliveryJob,
+    DeliveryJobRecipient,
+    Post,
+    Subscription,
+)
+
+
+def query_param_list(request, name):
+    """The comma-separated values of a query parameter, e.g. ?fields=url,subject."""
+
+    value = request.query_params.get(name, "") if request is not None else ""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+class DynamicFieldsMixin(object):
+    """A serializer mixin for sparse fieldsets and expanded relations.
+
+    ?fields=url,subject keeps only the listed fields. ?expand=post replaces a
+    field listed in expandable_fields, normally a hyperlink, with the related
+    object serialized in full. Fields of an expanded object are selected with
+    dots, e.g. ?expand=post&fields=subject,post.body.
+
+    The query parameters are read only by the top-level serializer; the
+    nested ones are passed fields and expand as arguments instead. They only
+    shape reads: a request that writes is validated and saved with every
+    field, whatever its query says. Views are responsible for fetching the
+    expanded objects efficiently.
+    """
+
+    # Maps the name of each field that can be expanded to the serializer
+    # class that expands it.
+    expandable_fields = {}
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop("fields", None)
+        expand = kwargs.pop("expand", None)
+        super(DynamicFieldsMixin, self).__init__(*args, **kwargs)
+        request = kwargs.get("context", {}).get("request")
+        if request is not None and request.method not in SAFE_METHODS:
+            request = None
+        if fields is None:
+            fields = query_param_list(request, "fields")
+        if expand is None:
+            expand = query_param_list(request, "expand")
+
+        for name in expand:
+            if name in self.expandable_fields and name in self.fields:
+                prefix = f"{name}."
+                self.fields[name] = self.expandable_fields[name](
+                    read_only=True,
+                    fields=[f[len(prefix) :] for f in fields if f.startswith(prefix)],
+                    expand=[],
+                )
+        if fields:
+            keep = {field.partition(".")[0] for field in fields}
+            for name in set(self.fields) - keep:
+                self.fields.pop(name)
 
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
@@ -12,25 +73,63 @@ class UserSerializer(serializers.HyperlinkedModelSerializer):
         fields = ("url", "username")
 
 
-class BoxSerializer(serializers.HyperlinkedModelSerializer):
-    """Translates between the Box model and multiple serialized API document formats."""
+class BoxSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
+    """Translates between the Box model and multiple serialized API document formats.
+
+    The box is summarized rather than listing its posts; the summary fields
+    come from Box.objects.with_summary().
+    """
 
     url = serializers.HyperlinkedIdentityField(
         view_name="box-detail", lookup_field="name"
     )
+    total = serializers.IntegerField(read_only=True)
+    unread = serializers.IntegerField(read_only=True)
+    newest = serializers.DateTimeField(read_only=True)
+    inbox = serializers.SerializerMethodField()
+    counts = serializers.SerializerMethodField()
+
+    def get_inbox(self, box):
+        return reverse(
+            "box-inbox", kwargs={"name": box.name}, request=self.context.get("request")
+        )
+
+    def get_counts(self, box):
+        return reverse(
+            "box-counts", kwargs={"name": box.name}, request=self.context.get("request")
+        )
+
+    class Meta:
+        model = Box
+        fields = (
+            "url",
+            "name",
+            "created",
+            "total",
+            "unread",
+            "newest",
+            "inbox",
+            "counts",
+        )
+
+
+class BoxWithPostsSerializer(BoxSerializer):
+    """A box summary that also lists every post in the box."""
+
     posts = serializers.HyperlinkedRelatedField(
         many=True, view_name="deliveredpost-detail", read_only=True
     )
 
-    class Meta:
-        model = Box
-        fields = ("url", "name", "created", "posts")
+    class Meta(BoxSerializer.Meta):
+        fields = BoxSerializer.Meta.fields + ("posts",)
 
 
-class PostSerializer(serializers.HyperlinkedModelSerializer):
+class PostSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
     """Translates between the Post model and multiple serialized API document formats."""
 
     sender = serializers.ReadOnlyField(source="sender.username")
+    # Post.body is a property, read from the body store when it's there.
+    body = serializers.CharField()
     delivered_posts = serializers.HyperlinkedRelatedField(
         view_name="deliveredpost-detail", many=True, read_only=True
     )
@@ -48,8 +147,15 @@ class PostSerializer(serializers.HyperlinkedModelSerializer):
         )
 
 
-class DeliveredPostSerializer(serializers.HyperlinkedModelSerializer):
-    """Translates between the DeliveredPost model and multiple serialized API document formats."""
+class DeliveredPostSerializer(
+    DynamicFieldsMixin, serializers.HyperlinkedModelSerializer
+):
+    """Translates between the DeliveredPost model and multiple serialized API document formats.
+
+    The post and box may be expanded with ?expand=post,box.
+    """
+
+    expandable_fields = {"post": PostSerializer, "box": BoxSerializer}
 
     box = serializers.HyperlinkedRelatedField(
         view_name="box-detail", queryset=Box.objects.all(), lookup_field="name"
@@ -62,10 +168,20 @@ class DeliveredPostSerializer(serializers.HyperlinkedModelSerializer):
     created = serializers.ReadOnlyField(source="post_created")
     subject = serializers.ReadOnlyField(source="post_subject")
 
+    def get_unique_together_validators(self):
+        # The (box, post) check loads the instance's post, which is wasted
+        # on a partial update that changes neither.
+        if self.partial and not {"box", "post"} & set(self.initial_data):
+            return []
+        return super(DeliveredPostSerializer, self).get_unique_together_validators()
+
     def update(self, obj, validated_data):
-        obj.post_sender = obj.post.sender
-        obj.post_created = obj.post.created
-        obj.post_subject = obj.post.subject
+        post = validated_data.get("post")
+        if post is not None and post.pk != obj.post_id:
+            # Only a change of post changes the copied fields.
+            obj.post_sender = post.sender
+            obj.post_created = post.created
+            obj.post_subject = post.subject
         return super(DeliveredPostSerializer, self).update(obj, validated_data)
 
     def create(self, validated_data):
@@ -74,7 +190,7 @@ class DeliveredPostSerializer(serializers.HyperlinkedModelSerializer):
             post_sender=post.sender,
             post_created=post.created,
             post_subject=post.subject,
-            **validated_data
+            **validated_data,
         )
 
     class Meta:
@@ -92,7 +208,35 @@ class DeliveredPostSerializer(serializers.HyperlinkedModelSerializer):
         )
 
 
-class SubscriptionSerializer(serializers.HyperlinkedModelSerializer):
+class InboxHeaderSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
+    """Translates a DeliveredPost into a header row for a box's inbox.
+
+    Only the fields copied from the post onto the delivered post are used, so
+    with the sender selected along with it, a page of rows takes one query.
+    """
+
+    sender = serializers.ReadOnlyField(source="post_sender.username")
+    created = serializers.ReadOnlyField(source="post_created")
+    subject = serializers.ReadOnlyField(source="post_subject")
+
+    class Meta:
+        model = DeliveredPost
+        fields = ("id", "url", "sender", "subject", "created", "is_read")
+        read_only_fields = ("is_read",)
+
+
+class SearchResultSerializer(InboxHeaderSerializer):
+    """Translates a DeliveredPost matching a search into a header row with its rank."""
+
+    rank = serializers.FloatField(read_only=True)
+
+    class Meta(InboxHeaderSerializer.Meta):
+        fields = InboxHeaderSerializer.Meta.fields + ("rank",)
+
+
+class SubscriptionSerializer(
+    DynamicFieldsMixin, serializers.HyperlinkedModelSerializer
+):
     """Translates between the Subscription model and multiple serialized API document formats."""
 
     source = serializers.HyperlinkedRelatedField(
@@ -101,11 +245,6 @@ class SubscriptionSerializer(serializers.HyperlinkedModelSerializer):
     target = serializers.HyperlinkedRelatedField(
         view_name="box-detail", queryset=Box.objects.all(), lookup_field="name"
     )
-    watermark = serializers.HyperlinkedRelatedField(
-        view_name="deliveredpost-detail",
-        queryset=DeliveredPost.objects.all(),
-        required=False,
-    )
 
     class Meta:
         model = Subscription
@@ -113,18 +252,43 @@ class SubscriptionSerializer(serializers.HyperlinkedModelSerializer):
         read_only_fields = ("created",)
 
 
+class BoxNameField(serializers.HyperlinkedRelatedField):
+    """A mapping of box resource URL to box name.
+
+    The URL is checked, but the box is not looked up, so that a whole list of
+    boxes can be looked up at once later.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("view_name", "box-detail")
+        kwargs.setdefault("lookup_field", "name")
+        kwargs.setdefault("read_only", True)
+        super(BoxNameField, self).__init__(**kwargs)
+
+    def get_object(self, view_name, view_args, view_kwargs):
+        return view_kwargs[self.lookup_url_kwarg]
+
+    def get_url(self, obj, view_name, request, format):
+        kwargs = {self.lookup_url_kwarg: obj}
+        return self.reverse(view_name, kwargs=kwargs, request=request, format=format)
+
+
 class BoxListField(serializers.Field):
-    """A mapping of list-of-box-resources to list-of-box-names."""
+    """A mapping of list-of-box-resources to list-of-box-names.
+
+    Names are listed once each, in the order they first appear.
+    """
 
     def __init__(self, max_length=None, min_length=None):
         super(BoxListField, self).__init__()
         # a subsidiary field helps us verify and convert every item in the list
-        self.converter = serializers.HyperlinkedRelatedField(
-            view_name="box-detail", queryset=Box.objects.all(), lookup_field="name"
-        )
+        self.converter = BoxNameField()
 
     def to_internal_value(self, data):
-        return [self.converter.to_internal_value(item) for item in data]
+        if not isinstance(data, list):
+            raise serializers.ValidationError("Expected a list of box URLs.")
+        names = [self.converter.to_internal_value(item) for item in data]
+        return list(dict.fromkeys(names))
 
     def to_representation(self, value):
         """Convert from list of box URLs to list of box names.
@@ -153,6 +317,62 @@ class DeliverActionSerializer(serializers.Serializer):
     content_type = serializers.CharField(required=False)
     subject = serializers.CharField(max_length=255)
     body = serializers.CharField()
+    defer = serializers.BooleanField(required=False, allow_null=True, default=None)
+
+
+class DeliveryJobRecipientSerializer(serializers.ModelSerializer):
+    """Translates between the DeliveryJobRecipient model and multiple serialized API document formats."""
+
+    box = BoxNameField(source="box_name")
+
+    class Meta:
+        model = DeliveryJobRecipient
+        fields = ("box", "status", "error", "updated")
+
+
+class DeliveryJobSerializer(serializers.HyperlinkedModelSerializer):
+    """Translates between the DeliveryJob model and multiple serialized API document formats."""
+
+    post = serializers.HyperlinkedRelatedField(view_name="post-detail", read_only=True)
+    recipients = DeliveryJobRecipientSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = DeliveryJob
+        fields = ("url", "post", "created", "completed", "recipients")
+
+
+class BulkActionSerializer(serializers.Serializer):
+    """A serializer for the 'bulk' action on delivered posts."""
+
+    ACTIONS = ("mark-read", "mark-unread", "delete", "move")
+
+    action = serializers.ChoiceField(ACTIONS)
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), required=False
+    )
+    box = serializers.HyperlinkedRelatedField(
+        view_name="box-detail",
+        queryset=Box.objects.all(),
+        lookup_field="name",
+        required=False,
+    )
+    sender = serializers.CharField(required=False)
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+    to = serializers.HyperlinkedRelatedField(
+        view_name="box-detail",
+        queryset=Box.objects.all(),
+        lookup_field="name",
+        required=False,
+    )
+
+    def validate(self, data):
+        # Refuse to act on every delivered post in every box by accident.
+        if "ids" not in data and "box" not in data:
+            raise serializers.ValidationError("Select posts by ids, box, or both.")
+        if data["action"] == "move" and "to" not in data:
+            raise serializers.ValidationError({"to": ["Required to move posts."]})
+        return data
 
 
 class SyncActionSerializer(serializers.Serializer):
@@ -161,3 +381,5 @@ class SyncActionSerializer(serializers.Serializer):
     box = serializers.HyperlinkedRelatedField(
         view_name="box-detail", queryset=Box.objects.all(), lookup_field="name"
     )
+    max_rows = serializers.IntegerField(required=False, min_value=1)
+    max_seconds = serializers.FloatField(required=False, min_value=0.001)
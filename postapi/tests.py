@@ -1,6 +1,40 @@
-import base64, json, re
+import base64, datetime, gzip, io, json, mailbox, os, re, tempfile, threading, time
+import unittest
+from unittest import mock
 import django.test
-from postapi.models import Box, DeliveredPost, Post, Subscription
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import urlencode
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from postapi import (
+    agents,
+    autocomplete,
+    bodystore,
+    delivery,
+    middleware,
+    renderers,
+    search,
+)
+from postapi.benchmarks import create_backlog
+from postapi.export import export_lines
+from postapi.pagination import KeysetPagination
+from postapi.counters import reconcile_counters
+from postapi.models import (
+    Box,
+    BoxCounter,
+    DeliveredPost,
+    DeliveryJob,
+    DeliveryJobRecipient,
+    DeliveryRetry,
+    Post,
+    PostBody,
+    Subscription,
+)
 import django.core.exceptions
 
 # Where used, we assume that this ID, regardless of the table, is not present in our test database.
@@ -122,6 +156,7 @@ class AuthAPITestCase(django.test.TestCase):
             "delivered-posts",
             "subscriptions",
             "actions/deliver",
+            "actions/batch-deliver",
         ]:
             r = self.client.post(
                 papi(resource), json.dumps({}), content_type="application/json"
@@ -212,8 +247,8 @@ class BoxListTestCase(APITestCase, BoxMixin):
         self.create_box("john")
         r = self.client.get(papi("boxes"))
         self.assertEqual(r.status_code, 200)
-        self.assertTrue(isinstance(r.json_content, list))
-        box_names = [box["name"] for box in r.json_content]
+        self.assertTrue(isinstance(r.json_content["results"], list))
+        box_names = [box["name"] for box in r.json_content["results"]]
         self.assertCountEqual(box_names, ["owen", "john"])
 
     def test_list_by_name_startswith(self):
@@ -227,17 +262,18 @@ class BoxListTestCase(APITestCase, BoxMixin):
         r = self.client.get(papi("boxes"), {"name_startswith": "a"})
         self.assertEqual(r.status_code, 200)
         self.assertCountEqual(
-            [box["name"] for box in r.json_content], ["annie", "archie", "armand"]
+            [box["name"] for box in r.json_content["results"]],
+            ["annie", "archie", "armand"],
         )
         # check case insensitivity
         r = self.client.get(papi("boxes"), {"name_startswith": "AR"})
         self.assertCountEqual(
-            [box["name"] for box in r.json_content], ["archie", "armand"]
+            [box["name"] for box in r.json_content["results"]], ["archie", "armand"]
         )
         # check queries with no results
         r = self.client.get(papi("boxes"), {"name_startswith": "c"})
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(r.json_content, [])
+        self.assertEqual(r.json_content["results"], [])
 
     def test_fails_if_added_twice(self):
         """Adding a box with the same name twice is illegal."""
@@ -248,6 +284,82 @@ class BoxListTestCase(APITestCase, BoxMixin):
         self.assertEqual(r.status_code, 400)
 
 
+class BoxNamesTestCase(APITestCase, BoxMixin):
+    """Tests for /postapi/box-names."""
+
+    def setUp(self):
+        super(BoxNamesTestCase, self).setUp()
+        autocomplete.cache.clear()
+        self.addCleanup(autocomplete.cache.clear)
+        for name in ["annie", "Archie", "armand", "bella", "ar-1", "ar_2"]:
+            Box.objects.create(name=name)
+
+    def names(self, prefix, **params):
+        r = self.client.get(papi("box-names"), {"prefix": prefix, **params})
+        self.assertEqual(r.status_code, 200)
+        return r.json_content["names"]
+
+    def box_queries(self, fn):
+        with CaptureQueriesContext(connection) as queries:
+            fn()
+        return [q for q in queries if Box._meta.db_table in q["sql"]]
+
+    def test_names(self):
+        """Names are matched by prefix ignoring case, in order, and capped."""
+
+        self.assertEqual(self.names("ar"), ["ar-1", "ar_2", "Archie", "armand"])
+        self.assertEqual(self.names("AR", limit=2), ["ar-1", "ar_2"])
+        self.assertEqual(self.names("ar_"), ["ar_2"])
+        self.assertEqual(self.names("c"), [])
+        with self.settings(POSTAPI_AUTOCOMPLETE_LIMIT=3):
+            self.assertEqual(self.names(""), ["annie", "ar-1", "ar_2"])
+        r = self.client.get(papi("box-names"), {"limit": "0"})
+        self.assertEqual(r.status_code, 400)
+
+    def test_cache(self):
+        """Prefixes are cached until a box with that prefix comes or goes, or they expire."""
+
+        self.assertEqual(len(self.box_queries(lambda: self.names("a"))), 1)
+        self.assertEqual(self.box_queries(lambda: self.names("A")), [])
+
+        # Another prefix is unaffected by a new box.
+        self.names("b")
+        self.create_box("alfie")
+        self.assertEqual(self.box_queries(lambda: self.names("b")), [])
+        self.assertIn("alfie", self.names("a"))
+
+        self.client.delete(papi("boxes", "alfie"))
+        self.assertNotIn("alfie", self.names("a"))
+
+        with mock.patch("time.monotonic", return_value=time.monotonic() + 3600):
+            self.assertEqual(len(self.box_queries(lambda: self.names("b"))), 1)
+
+    def test_lru(self):
+        """The least recently used prefix is evicted first."""
+
+        cache = autocomplete.PrefixCache(2, 60)
+        cache.set("a", ("annie",))
+        cache.set("b", ("bella",))
+        cache.get("a")
+        cache.set("c", ())
+        self.assertEqual(cache.get("a"), ("annie",))
+        self.assertIsNone(cache.get("b"))
+
+    def test_uses_index(self):
+        """Prefix matching is served by the lower(name) index."""
+
+        queryset = Box.objects.name_prefix("ar").values("name")
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute(f"EXPLAIN {sql}", params)
+            else:
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            plan = "\n".join(str(row) for row in cursor.fetchall())
+        self.assertIn("box_name_prefix_idx", plan)
+
+
 class BoxDetailTestCase(APITestCase, BoxMixin):
     """Tests for /postapi/boxes/<pk>."""
 
@@ -263,6 +375,54 @@ class BoxDetailTestCase(APITestCase, BoxMixin):
         self.assertEqual(r.status_code, 200)
         self.assertEqual(r.json_content["name"], self.name)
 
+    def deliver(self, count):
+        create_backlog(
+            User.objects.get(username="test"), Box.objects.get(name=self.name), count
+        )
+
+    def test_summary(self):
+        """A box's details summarize its posts instead of listing them."""
+
+        r = self.client.get(papi("boxes", self.name))
+        self.assertEqual((r.json_content["total"], r.json_content["unread"]), (0, 0))
+        self.assertIsNone(r.json_content["newest"])
+        self.assertNotIn("posts", r.json_content)
+
+        self.deliver(3)
+        DeliveredPost.objects.filter(id=DeliveredPost.objects.first().id).update(
+            is_read=True
+        )
+        r = self.client.get(papi("boxes", self.name))
+        self.assertEqual((r.json_content["total"], r.json_content["unread"]), (3, 2))
+        newest = DeliveredPost.objects.latest("post_created").post_created
+        self.assertEqual(
+            r.json_content["newest"], newest.isoformat().replace("+00:00", "Z")
+        )
+
+        # The inbox link lists the posts.
+        r = self.client.get(r.json_content["inbox"])
+        self.assertEqual(len(r.json_content["results"]), 3)
+
+    def test_posts_opt_in(self):
+        """A box's posts are listed on request."""
+
+        self.deliver(2)
+        r = self.client.get(papi("boxes", self.name), {"posts": "true"})
+        self.assertEqual(len(r.json_content["posts"]), 2)
+        self.assertEqual(r.json_content["total"], 2)
+
+    def test_query_count_independent_of_box_size(self):
+        """Getting a box takes the same number of queries no matter how many posts are in it."""
+
+        query_counts = []
+        for count in (1, 50):
+            self.deliver(count)
+            with CaptureQueriesContext(connection) as queries:
+                r = self.client.get(papi("boxes", self.name))
+            self.assertEqual(r.status_code, 200)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
     def test_put_and_patch_fail(self):
         """A box's details may not be modified."""
 
@@ -278,248 +438,1485 @@ class BoxDetailTestCase(APITestCase, BoxMixin):
         self.assertEqual(r.status_code, 404)
 
 
-class PostMixin(object):
-    """An APITestCase mixin for creating test posts.
-
-    This code relies on self.client being a JSONClient.
-    """
-
-    def create_post(self, subject, body):
-        """Creates a box with the given name and returns its PK."""
+class InboxTestCase(APITestCase, BoxMixin):
+    """Tests for /postapi/boxes/<name>/inbox."""
 
-        r = self.client.post(papi("posts"), {"subject": subject, "body": body})
-        self.assertEqual(r.status_code, 201)
-        url = r.json_content["url"]
-        return (scrape_pk(url), url)
+    def setUp(self):
+        super(InboxTestCase, self).setUp()
+        self.create_box("mannie")
+        self.box = Box.objects.get(name="mannie")
+        self.senders = [User.objects.create(username=f"sender{i}") for i in range(3)]
 
+    def deliver(self, count):
+        for i in range(count):
+            create_backlog(self.senders[i % len(self.senders)], self.box, 1)
 
-class PostListTestCase(APITestCase, PostMixin):
-    """Tests for /postapi/posts."""
+    def test_headers(self):
+        """The inbox lists header rows, newest first."""
 
-    def test_create(self):
-        """A post can be created with a body."""
+        self.deliver(3)
+        DeliveredPost.objects.filter(post_sender=self.senders[1]).update(is_read=True)
+        r = self.client.get(papi("boxes/mannie/inbox"))
+        self.assertEqual(r.status_code, 200)
+        rows = r.json_content["results"]
+        self.assertEqual(
+            set(rows[0]), {"id", "url", "sender", "subject", "created", "is_read"}
+        )
+        self.assertEqual(
+            [row["sender"] for row in rows], ["sender2", "sender1", "sender0"]
+        )
+        self.assertEqual([row["is_read"] for row in rows], [False, True, False])
+        dpost = DeliveredPost.objects.get(id=rows[0]["id"])
+        self.assertEqual(rows[0]["subject"], dpost.post_subject)
+        self.assertEqual(scrape_pk(rows[0]["url"]), dpost.id)
+
+    def test_box_links_to_inbox(self):
+        """A box's inbox link leads here."""
+
+        r = self.client.get(papi("boxes", "mannie"))
+        self.assertTrue(r.json_content["inbox"].endswith(papi("boxes/mannie/inbox")))
+
+    def test_filters(self):
+        """The inbox can be limited to unread posts, and to a range of dates."""
+
+        self.deliver(3)
+        dposts = list(DeliveredPost.objects.order_by("id"))
+        DeliveredPost.objects.filter(id=dposts[0].id).update(is_read=True)
+        base = timezone.now() - datetime.timedelta(days=10)
+        for i, dpost in enumerate(dposts):
+            DeliveredPost.objects.filter(id=dpost.id).update(
+                post_created=base + datetime.timedelta(days=i)
+            )
 
-        pk, url = self.create_post("Test", "Hello, world!")
-        try:
-            # Make sure the object exists in the database.
-            self.assertIsNotNone(Post.objects.get(id=pk))
-        except django.core.exceptions.ObjectDoesNotExist:
-            self.fail("Recently-created post not in database")
+        r = self.client.get(papi("boxes/mannie/inbox"), {"unread": "true"})
+        self.assertEqual(
+            [row["id"] for row in r.json_content["results"]],
+            [dposts[2].id, dposts[1].id],
+        )
+        r = self.client.get(
+            papi("boxes/mannie/inbox"),
+            {
+                "start": (base + datetime.timedelta(hours=12)).isoformat(),
+                "end": (base + datetime.timedelta(days=1, hours=12)).isoformat(),
+            },
+        )
+        self.assertEqual(
+            [row["id"] for row in r.json_content["results"]], [dposts[1].id]
+        )
 
-    def test_list(self):
-        """Posts can be listed."""
+    def test_missing_box(self):
+        """The inbox of a box that doesn't exist is a 404."""
 
-        self.create_post("Test", "Hello, there!")
-        self.create_post("Test 2", "Hi yourself.")
-        r = self.client.get(papi("posts"))
-        self.assertEqual(r.status_code, 200)
-        self.assertTrue(isinstance(r.json_content, list))
-        posts = [post["body"] for post in r.json_content]
-        self.assertCountEqual(posts, ["Hello, there!", "Hi yourself."])
+        r = self.client.get(papi(f"boxes/{ARBITRARY_NONEXISTENT_NAME}/inbox"))
+        self.assertEqual(r.status_code, 404)
 
+    def test_query_count_independent_of_page_size(self):
+        """A page of the inbox takes the same number of queries no matter how many rows are on it."""
 
-class PostDetailTestCase(APITestCase, PostMixin):
-    """Tests for /postapi/posts/<pk>."""
+        self.deliver(60)
+        query_counts = []
+        for page_size in (1, 50):
+            with CaptureQueriesContext(connection) as queries:
+                r = self.client.get(
+                    papi("boxes/mannie/inbox"), {"page_size": page_size}
+                )
+            self.assertEqual(len(r.json_content["results"]), page_size)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
 
-    def setUp(self):
-        super(PostDetailTestCase, self).setUp()
-        self.pk, _ = self.create_post("Beginning", "Call me Ishmael.")
+    def test_delivered_post_list_query_count(self):
+        """Listing delivered posts takes the same number of queries no matter how many there are."""
 
-    def test_get(self):
-        """A post's details may be retrieved."""
+        self.deliver(3)
+        query_counts = []
+        for page_size in (1, 3):
+            with CaptureQueriesContext(connection) as queries:
+                r = self.client.get(papi("delivered-posts"), {"page_size": page_size})
+            self.assertEqual(len(r.json_content["results"]), page_size)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
 
-        r = self.client.get(papi("posts", self.pk))
-        self.assertEqual(r.status_code, 200)
-        self.assertEqual(r.json_content["subject"], "Beginning")
-        self.assertEqual(r.json_content["body"], "Call me Ishmael.")
 
-    def test_put(self):
-        """A post's details may not be modified."""
+class SearchTestCase(APITestCase, BoxMixin):
+    """Tests for /postapi/boxes/<name>/search."""
 
-        r = self.client.put(
-            papi("posts", self.pk), {"subject": "Epilogue", "body": "The drama's done."}
+    def setUp(self):
+        super(SearchTestCase, self).setUp()
+        self.create_box("mannie")
+        self.create_box("wyoh")
+        self.sender = User.objects.get(username="test")
+
+    def deliver(self, box_name, subject, body):
+        post = Post.objects.create(sender=self.sender, subject=subject, body=body)
+        return DeliveredPost.objects.create(
+            box=Box.objects.get(name=box_name),
+            post=post,
+            post_sender=self.sender,
+            post_created=post.created,
+            post_subject=post.subject,
         )
-        self.assertEqual(r.status_code, 405)
 
-    def test_patch(self):
-        """A post's details may not be partially updated."""
+    def search(self, q, box_name="mannie", **params):
+        url = papi("boxes", box_name) + "/search"
+        r = self.client.get(url, {"q": q, **params})
+        self.assertEqual(r.status_code, 200)
+        return r
 
-        r = self.client.patch(papi("posts", self.pk), {"subject": "Epilogue"})
-        self.assertEqual(r.status_code, 405)
+    def subjects(self, q, **params):
+        return [
+            row["subject"] for row in self.search(q, **params).json_content["results"]
+        ]
 
-    def test_get_fails_if_not_present(self):
-        """Post detail gives a 404 if the box isn't present."""
+    def test_search(self):
+        """Posts in the box whose subject or body has every word are found."""
 
-        r = self.client.get(papi("posts", ARBITRARY_NONEXISTENT_ID))
-        self.assertEqual(r.status_code, 404)
+        self.deliver("mannie", "Rocks for Terra", "Throw them downhill.")
+        self.deliver("mannie", "Mike's jokes", "Some are funny, once.")
+        self.deliver("mannie", "Catapult", "Rocks go up the catapult.")
+        self.deliver("wyoh", "Rocks", "Not in Mannie's box.")
 
+        self.assertCountEqual(self.subjects("rocks"), ["Rocks for Terra", "Catapult"])
+        self.assertEqual(self.subjects("rocks catapult"), ["Catapult"])
+        self.assertEqual(self.subjects("jokes"), ["Mike's jokes"])
+        self.assertEqual(self.subjects("dinosaurs"), [])
+        row = self.search("jokes").json_content["results"][0]
+        self.assertEqual(
+            set(row), {"id", "url", "sender", "subject", "created", "is_read", "rank"}
+        )
 
-class DeliveredPostMixin(BoxMixin, PostMixin):
-    """An APITestCase mixin for creating delivered posts."""
+    def test_web_search_syntax(self):
+        """Phrases, OR, and excluded words work with or without full-text search."""
 
-    class Data(object):
-        def __init__(self, box_name, box_url, post_pk, post_url, dpost_pk, dpost_url):
-            self.box_name = box_name
-            self.box_url = box_url
-            self.post_pk = post_pk
-            self.post_url = post_url
-            self.dpost_pk = dpost_pk
-            self.dpost_url = dpost_url
+        self.deliver("mannie", "Rocks for Terra", "Launch window closes Tuesday.")
+        self.deliver("mannie", "Mike's jokes", "Some are funny, once.")
+        self.deliver("mannie", "Catapult", "Rocks leave the catapult.")
 
-    def deliver_post(self, box_url, post_url):
-        r = self.client.post(
-            papi("delivered-posts"), {"box": box_url, "post": post_url}
+        self.assertEqual(self.subjects('"window closes"'), ["Rocks for Terra"])
+        self.assertEqual(self.subjects('"closes window"'), [])
+        self.assertCountEqual(
+            self.subjects("jokes OR catapult"), ["Mike's jokes", "Catapult"]
+        )
+        self.assertEqual(self.subjects("rocks -catapult"), ["Rocks for Terra"])
+        self.assertEqual(self.subjects('-"launch window" rocks'), ["Catapult"])
+        self.assertEqual(
+            search.parse_query('OR a b OR "c  d" -e'),
+            [[("a", False)], [("b", False), ("c d", False)], [("e", True)]],
         )
-        self.assertEqual(r.status_code, 201)
-        url = r.json_content["url"]
-        return (scrape_pk(url), url)
 
-    def create_and_deliver_post(self, boxname, subject, body):
-        box_url = self.create_box(boxname)
-        post_pk, post_url = self.create_post(subject, body)
-        dpost_pk, dpost_url = self.deliver_post(box_url, post_url)
-        return DeliveredPostMixin.Data(
-            boxname, box_url, post_pk, post_url, dpost_pk, dpost_url
+    def test_pages(self):
+        """Following the next links visits every match once, best first."""
+
+        for i in range(7):
+            self.deliver("mannie", f"Post {i}", "rocks " * (i % 3 + 1))
+        self.deliver("mannie", "Other", "Nothing to see.")
+        seen, ranks = [], []
+        r = self.search("rocks", page_size=3)
+        while True:
+            seen += [row["id"] for row in r.json_content["results"]]
+            ranks += [row["rank"] for row in r.json_content["results"]]
+            if not r.json_content["next"]:
+                break
+            r = self.client.get(r.json_content["next"])
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+    def test_invalid(self):
+        """A search needs a query and a box that exists."""
+
+        r = self.client.get(papi("boxes", "mannie") + "/search")
+        self.assertEqual(r.status_code, 400)
+        r = self.client.get(
+            papi("boxes", ARBITRARY_NONEXISTENT_NAME) + "/search", {"q": "rocks"}
         )
+        self.assertEqual(r.status_code, 404)
 
+    @unittest.skipUnless(connection.vendor == "postgresql", "requires full-text search")
+    def test_ranked_full_text(self):
+        """Searches are stemmed and ranked, with subject matches first, and use the index."""
 
-class DeliveredPostListTestCase(APITestCase, DeliveredPostMixin):
-    """Tests for /postapi/delivered-posts."""
+        self.deliver("mannie", "Hello", "The rocks were delivered on time.")
+        self.deliver("mannie", "Delivering rocks", "On time.")
+        self.deliver("mannie", "Rocks", "Delivery was late, not delivered.")
+        self.assertEqual(
+            self.subjects("deliver"), ["Delivering rocks", "Rocks", "Hello"]
+        )
+        self.assertEqual(self.subjects('"delivered on time"'), ["Hello"])
+        self.assertEqual(self.subjects("rocks -late"), ["Delivering rocks", "Hello"])
+
+        post = Post.objects.get(subject="Hello")
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("SET LOCAL enable_indexscan = off")
+            query = search.matching_posts("rocks").order_by().query
+            sql, params = query.sql_with_params()
+            cursor.execute(f"EXPLAIN {sql}", params)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+            cursor.execute(
+                f"SELECT search_vector::text FROM {Post._meta.db_table} WHERE id = %s",
+                [post.id],
+            )
+            vector = cursor.fetchone()[0]
+        self.assertIn("postapi_post_search_idx", plan)
+        self.assertIn("'deliv'", vector)
 
-    def test_create(self):
-        """A post can be delivered."""
 
-        data = self.create_and_deliver_post("john", "Test", "Hello, world!")
-        try:
-            # Make sure the object exists in the database.
-            dpost = DeliveredPost.objects.get(id=data.dpost_pk)
-            self.assertIsNotNone(dpost)
+class BoxCountsTestCase(APITestCase, BoxMixin):
+    """Tests for /postapi/boxes/<name>/counts, and the counters behind it."""
 
-        except django.core.exceptions.ObjectDoesNotExist:
-            self.fail("Recently-created post not in database")
+    def setUp(self):
+        super(BoxCountsTestCase, self).setUp()
+        self.box_url = self.create_box("mannie")
+        self.box = Box.objects.get(name="mannie")
+        self.sender = User.objects.get(username="test")
 
-    def test_fails_if_delivered_twice(self):
-        """At most one instance of a post may be delivered to a box at a time."""
+    def counts(self, name="mannie"):
+        r = self.client.get(papi(f"boxes/{name}/counts"))
+        self.assertEqual(r.status_code, 200)
+        return r.json_content
 
-        box_url = self.create_box("foo")
-        _, post_url = self.create_post("Test", "Hello, world!")
-        r = self.client.post(
-            papi("delivered-posts"), {"box": box_url, "post": post_url}
-        )
-        self.assertEqual(r.status_code, 201)
-        r = self.client.post(
-            papi("delivered-posts"), {"box": box_url, "post": post_url}
-        )
-        self.assertEqual(r.status_code, 400)
+    def test_empty(self):
+        """A box with no posts has zero counts, and a missing box is a 404."""
 
-        # ...however, this counts as a separate post!
-        _, post_url2 = self.create_post("Test", "Hello, world!")
-        r = self.client.post(
-            papi("delivered-posts"), {"box": box_url, "post": post_url2}
-        )
-        self.assertEqual(r.status_code, 201)
+        self.assertEqual(self.counts(), {"total": 0, "unread": 0, "version": 0})
+        r = self.client.get(papi(f"boxes/{ARBITRARY_NONEXISTENT_NAME}/counts"))
+        self.assertEqual(r.status_code, 404)
 
-    def test_list(self):
-        """Delivered posts can be listed."""
+    def test_deliver_read_and_delete(self):
+        """The counts follow posts being delivered, marked read or unread, and deleted."""
 
-        self.create_and_deliver_post("john", "Test", "Hello, world!")
-        self.create_and_deliver_post("owen", "Test 2", "Hello again.")
-        r = self.client.get(papi("delivered-posts"))
+        r = self.client.post(
+            papi("actions/deliver"),
+            {"to": [self.box_url], "subject": "Hi", "body": "1"},
+        )
         self.assertEqual(r.status_code, 200)
-        self.assertTrue(isinstance(r.json_content, list))
-        posts = [delivered_post["subject"] for delivered_post in r.json_content]
-        self.assertCountEqual(posts, ["Test", "Test 2"])
-
-    def test_list_by_sender(self):
-        """Delivered posts can be filtered by sender."""
+        create_backlog(self.sender, self.box, 2)
+        counts = self.counts()
+        self.assertEqual((counts["total"], counts["unread"]), (3, 3))
 
-        self.create_and_deliver_post("john", "Test", "Hello, world!")
-        self.create_and_deliver_post("owen", "Test 2", "Hello again.")
-        r = self.client.get(papi("delivered-posts"), {"boxname": "owen"})
+        dposts = list(DeliveredPost.objects.filter(box=self.box).order_by("id"))
+        r = self.client.patch(papi("delivered-posts", dposts[0].id), {"is_read": True})
         self.assertEqual(r.status_code, 200)
-        self.assertTrue(isinstance(r.json_content, list))
-        posts = [delivered_post["subject"] for delivered_post in r.json_content]
-        self.assertCountEqual(posts, ["Test 2"])
-
-
-class DeliveredPostDetailTestCase(APITestCase, DeliveredPostMixin):
-    """Tests for /postapi/delivered-posts/<pk>."""
+        self.assertEqual(self.counts()["unread"], 2)
+        DeliveredPost.objects.filter(box=self.box).update(is_read=True)
+        self.assertEqual(self.counts()["unread"], 0)
+        r = self.client.patch(papi("delivered-posts", dposts[1].id), {"is_read": False})
+        self.assertEqual(self.counts()["unread"], 1)
+
+        version = self.counts()["version"]
+        r = self.client.delete(papi("delivered-posts", dposts[1].id))
+        self.assertEqual(r.status_code, 204)
+        counts = self.counts()
+        self.assertEqual((counts["total"], counts["unread"]), (2, 0))
+        self.assertGreater(counts["version"], version)
+
+        # Deleting a post deletes its deliveries.
+        dposts[0].post.delete()
+        counts = self.counts()
+        self.assertEqual((counts["total"], counts["unread"]), (1, 0))
+
+    def test_sync(self):
+        """Posts copied in by a sync are counted."""
+
+        source = Box.objects.create(name="cool-people")
+        Subscription.objects.create(source=source, target=self.box)
+        create_backlog(self.sender, source, 5)
+        delivery.sync_box(self.box)
+        self.assertEqual(self.counts()["total"], 5)
+        self.assertEqual(self.counts("cool-people")["total"], 5)
+
+    def test_moved(self):
+        """A post moved to another box is counted in its new box only."""
+
+        other = Box.objects.create(name="other")
+        create_backlog(self.sender, self.box, 2)
+        DeliveredPost.objects.filter(box=self.box).update(box=other)
+        self.assertEqual(self.counts()["total"], 0)
+        self.assertEqual(self.counts("other")["total"], 2)
+
+    def test_query_count(self):
+        """Getting the counts takes one lookup, however many posts the box holds."""
+
+        query_counts = []
+        for count in (1, 50):
+            create_backlog(self.sender, self.box, count)
+            with CaptureQueriesContext(connection) as queries:
+                self.counts()
+            lookups = [q for q in queries if "postapi_boxcounter" in q["sql"]]
+            self.assertEqual(len(lookups), 1)
+            self.assertNotIn("postapi_deliveredpost", lookups[0]["sql"])
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_reconcile(self):
+        """Reconciling repairs drifted and missing counters, and leaves correct ones alone."""
+
+        other = Box.objects.create(name="other")
+        create_backlog(self.sender, self.box, 3)
+        create_backlog(self.sender, other, 2)
+        BoxCounter.objects.filter(box=self.box).update(total=10, unread=7)
+        BoxCounter.objects.filter(box=other).delete()
+        version = BoxCounter.objects.get(box=self.box).version
+
+        self.assertEqual(reconcile_counters(batch_size=1), (2, 2))
+        counts = self.counts()
+        self.assertEqual((counts["total"], counts["unread"]), (3, 3))
+        self.assertEqual(counts["version"], version + 1)
+        self.assertEqual(self.counts("other")["total"], 2)
+
+        out = io.StringIO()
+        call_command("reconcile_counters", stdout=out)
+        self.assertIn("Checked 2 boxes, repaired 0 counters.", out.getvalue())
+
+
+class ConditionalGetTestCase(APITestCase, BoxMixin):
+    """Tests for ETags and 304 Not Modified responses."""
 
     def setUp(self):
-        super(DeliveredPostDetailTestCase, self).setUp()
-        self.data = self.create_and_deliver_post("john", "Test", "Hello, world!")
+        super(ConditionalGetTestCase, self).setUp()
+        self.create_box("mannie")
+        self.box = Box.objects.get(name="mannie")
+        self.sender = User.objects.get(username="test")
 
-    def test_get(self):
-        """A delivered post's details may be retrieved."""
+    def revalidate(self, path, data={}):
+        """GET the path, then GET it again with its ETag; returns the ETag."""
 
-        r = self.client.get(papi("delivered-posts", self.data.dpost_pk))
+        r = self.client.get(path, data)
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(r.json_content["box"], self.data.box_url)
-        self.assertEqual(r.json_content["post"], self.data.post_url)
-        self.assertIn("created", r.json_content)
-        self.assertIn("delivered", r.json_content)
-        self.assertFalse(r.json_content["is_read"])
-        self.assertEqual(r.json_content["sender"], "test")
-        self.assertEqual(r.json_content["subject"], "Test")
-
-    def test_mark_read_and_unread(self):
-        """Delivered posts may be marked read and unread, and are unread by default."""
+        etag = r["ETag"]
+        self.assertTrue(etag.startswith('"'))
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(path, data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, b"")
+        self.assertEqual(r["ETag"], etag)
+        # Nothing was serialized, so no posts were read.
+        self.assertFalse(any("postapi_deliveredpost" in q["sql"] for q in queries))
+        return etag
+
+    def test_box_resources(self):
+        """A box's details, inbox, and counts change their ETags when its posts change."""
+
+        paths = [
+            papi("boxes/mannie"),
+            papi("boxes/mannie/inbox"),
+            papi("boxes/mannie/counts"),
+        ]
+        create_backlog(self.sender, self.box, 2)
+        etags = [self.revalidate(path) for path in paths]
+        self.assertEqual(len(set(etags)), 3)
+
+        DeliveredPost.objects.filter(box=self.box).update(is_read=True)
+        for path, etag in zip(paths, etags):
+            r = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(r.status_code, 200)
+            self.assertNotEqual(r["ETag"], etag)
+
+        # Other boxes' posts don't matter.
+        etag = self.revalidate(paths[0])
+        create_backlog(self.sender, Box.objects.create(name="other"), 1)
+        r = self.client.get(paths[0], HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+
+    def test_query_in_etag(self):
+        """Different pages and filters of a list have different ETags."""
+
+        create_backlog(self.sender, self.box, 3)
+        r = self.client.get(papi("boxes/mannie/inbox"), {"page_size": 2})
+        etag = r["ETag"]
+        r = self.client.get(r.json_content["next"], HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r["ETag"], etag)
 
-        # default is unread
-        self.assertFalse(DeliveredPost.objects.get(id=self.data.dpost_pk).is_read)
+    def test_delivered_post_lists(self):
+        """The delivered post list changes its ETag when any box's posts change."""
 
-        # mark as read
-        r = self.client.patch(
-            papi("delivered-posts", self.data.dpost_pk), {"is_read": True}
+        other = Box.objects.create(name="other")
+        etag = self.revalidate(papi("delivered-posts"))
+        box_etag = self.revalidate(papi("delivered-posts"), {"boxname": "mannie"})
+        create_backlog(self.sender, other, 1)
+        r = self.client.get(papi("delivered-posts"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        r = self.client.get(
+            papi("delivered-posts"), {"boxname": "mannie"}, HTTP_IF_NONE_MATCH=box_etag
         )
+        self.assertEqual(r.status_code, 304)
+
+        # So does the box list, and creating a box changes it too.
+        etag = self.revalidate(papi("boxes"))
+        Box.objects.create(name="another")
+        r = self.client.get(papi("boxes"), HTTP_IF_NONE_MATCH=etag)
         self.assertEqual(r.status_code, 200)
-        self.assertTrue(DeliveredPost.objects.get(id=self.data.dpost_pk).is_read)
 
-        # now mark as unread again
-        r = self.client.patch(
-            papi("delivered-posts", self.data.dpost_pk), {"is_read": False}
+    def test_expanded_list(self):
+        """An expanded list's ETag changes when its posts are delivered to other boxes."""
+
+        create_backlog(self.sender, self.box, 1)
+        other = Box.objects.create(name="wyoh")
+        data = {"boxname": "mannie", "expand": "post"}
+        etag = self.revalidate(papi("delivered-posts"), data)
+        dpost = DeliveredPost.objects.get(box=self.box)
+        DeliveredPost.objects.create(
+            box=other,
+            post=dpost.post,
+            post_sender=self.sender,
+            post_created=dpost.post_created,
+            post_subject=dpost.post_subject,
         )
+        r = self.client.get(papi("delivered-posts"), data, HTTP_IF_NONE_MATCH=etag)
         self.assertEqual(r.status_code, 200)
-        self.assertFalse(DeliveredPost.objects.get(id=self.data.dpost_pk).is_read)
+        self.assertEqual(
+            len(r.json_content["results"][0]["post"]["delivered_posts"]), 2
+        )
 
-    def test_delete(self):
-        """Delivered posts can be deleted without affecting the underlying post."""
+    def test_post_detail(self):
+        """A post's ETag changes when it's delivered or a delivery is deleted."""
+
+        post = Post.objects.create(sender=self.sender, subject="Hi", body="Hello!")
+        path = papi("posts", post.id)
+        etags = []
+        for change in [
+            lambda: None,
+            lambda: self.client.post(
+                papi("delivered-posts"),
+                {"box": papi("boxes/mannie"), "post": papi("posts", post.id)},
+            ),
+            lambda: DeliveredPost.objects.filter(post=post).delete(),
+        ]:
+            change()
+            r = self.client.get(path)
+            self.assertEqual(r.status_code, 200)
+            self.assertNotIn("Cache-Control", r)
+            etag = r["ETag"]
+            if etags:
+                self.assertNotEqual(etag, etags[-1])
+            etags.append(etag)
+            r = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(r.status_code, 304)
+
+        post.delete()
+        r = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 404)
 
-        r = self.client.delete(papi("delivered-posts", self.data.dpost_pk))
-        self.assertEqual(r.status_code, 204)
-        self.assertFalse(DeliveredPost.objects.filter(id=self.data.dpost_pk).exists())
-        self.assertTrue(Post.objects.filter(id=self.data.post_pk).exists())
 
-    def test_get_fails_if_not_present(self):
-        """Delivered post detail gives a 404 if the box isn't present."""
+class FastListTestCase(APITestCase, BoxMixin):
+    """The fast list path's output is identical to the serializers'."""
 
-        r = self.client.get(papi("delivered-posts", ARBITRARY_NONEXISTENT_ID))
-        self.assertEqual(r.status_code, 404)
+    def setUp(self):
+        super(FastListTestCase, self).setUp()
+        sender = User.objects.get(username="test")
+        source = Box.objects.create(name="cool-people")
+        for name in ("mannie", "wyoh"):
+            box = Box.objects.create(name=name)
+            Subscription.objects.create(source=source, target=box, watermark=3)
+            create_backlog(sender, box, 3)
+        create_backlog(sender, source, 2)
+        DeliveredPost.objects.filter(
+            id__in=DeliveredPost.objects.values("id")[:2]
+        ).update(is_read=True)
+
+    def assertSameOutput(self, path, data={}, fast_path=True):
+        with self.settings(POSTAPI_FAST_LISTS=False):
+            slow = self.client.get(path, data)
+        if fast_path:
+            # The fast path never serializes a list.
+            with mock.patch(
+                "rest_framework.serializers.ListSerializer.to_representation",
+                side_effect=AssertionError("Serialized the list"),
+            ):
+                fast = self.client.get(path, data)
+        else:
+            fast = self.client.get(path, data)
+        self.assertEqual(fast.status_code, 200)
+        self.assertEqual(fast.content, slow.content)
+        return fast
+
+    @django.test.override_settings(TIME_ZONE="America/New_York")
+    def test_identical(self):
+        """The output is the same, times included, outside UTC too."""
+
+        for path in (
+            "delivered-posts",
+            "delivered-posts.json",
+            "boxes/mannie/inbox",
+            "subscriptions",
+        ):
+            self.assertSameOutput(papi(path))
+        self.assertSameOutput(
+            papi("delivered-posts"), {"boxname": "wyoh", "fields": "url,box,is_read"}
+        )
+        self.assertSameOutput(papi("boxes/mannie/inbox"), {"unread": "true"})
 
+        # Every page is the same, and so are the links to them.
+        r = self.assertSameOutput(papi("delivered-posts"), {"page_size": 3})
+        while r.json_content["next"]:
+            r = self.assertSameOutput(r.json_content["next"])
 
-class SubscriptionMixin(DeliveredPostMixin):
-    """An APITestCase mixin for creating test subscriptions.
+    def test_expand_uses_serializer(self):
+        """Expanded lists go through the serializer."""
 
-    This code relies on self.client being a JSONClient.
-    """
+        r = self.assertSameOutput(
+            papi("delivered-posts"), {"expand": "post"}, fast_path=False
+        )
+        self.assertIsInstance(r.json_content["results"][0]["post"], dict)
 
-    class Data(object):
-        def __init__(
-            self, source_name, source_url, target_name, target_url, sub_pk, sub_url
-        ):
-            self.source_name = source_name
-            self.source_url = source_url
-            self.target_name = target_name
-            self.target_url = target_url
-            self.sub_pk = sub_pk
-            self.sub_url = sub_url
 
-    def create_subscription(self, source_url, target_url):
-        """Creates a subscription with the given source and target, and returns its PK and URL."""
+class RenderersTestCase(APITestCase, BoxMixin):
+    """Tests for the faster renderers and parsers, and compression."""
 
-        r = self.client.post(
-            papi("subscriptions"), {"source": source_url, "target": target_url}
-        )
+    def setUp(self):
+        super(RenderersTestCase, self).setUp()
+        self.box_url = self.create_box("mannie")
+        create_backlog(
+            User.objects.get(username="test"), Box.objects.get(name="mannie"), 20
+        )
+        DeliveredPost.objects.filter(id=DeliveredPost.objects.first().id).update(
+            post_subject="Line\u2028separator \u00e9"
+        )
+
+    def test_orjson_output_matches(self):
+        """The orjson renderer's output is the same as DRF's JSON renderer's."""
+
+        r = self.client.get(papi("delivered-posts"))
+        self.assertEqual(r.status_code, 200)
+        data = r.data
+        self.assertEqual(
+            renderers.ORJSONRenderer().render(data), JSONRenderer().render(data)
+        )
+        self.assertEqual(r.content, JSONRenderer().render(data))
+        indented = renderers.ORJSONRenderer().render(data, "application/json; indent=2")
+        self.assertEqual(
+            indented, JSONRenderer().render(data, "application/json; indent=2")
+        )
+
+    def test_orjson_parser(self):
+        """JSON is parsed, and bad JSON is a 400."""
+
+        r = self.client.post(
+            papi("actions/deliver"),
+            {"to": [self.box_url], "subject": "\u00e9", "body": "Hi"},
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(Post.objects.latest("id").subject, "\u00e9")
+        r = self.client.generic(
+            "POST", papi("actions/deliver"), b"{nope", content_type="application/json"
+        )
+        self.assertEqual(r.status_code, 400)
+
+    @unittest.skipUnless(renderers.msgpack, "requires msgpack")
+    def test_msgpack(self):
+        """MessagePack can be asked for, and sent."""
+
+        # JSONClient always asks for JSON.
+        r = django.test.Client().get(
+            papi("delivered-posts"), HTTP_ACCEPT="application/msgpack"
+        )
+        self.assertEqual(r["Content-Type"], "application/msgpack")
+        self.assertEqual(
+            renderers.msgpack.unpackb(r.content),
+            json.loads(self.client.get(papi("delivered-posts")).content),
+        )
+        body = renderers.msgpack.packb(
+            [{"to": [self.box_url], "subject": "Hi", "body": "Hi"}]
+        )
+        r = self.client.generic(
+            "POST",
+            papi("actions/batch-deliver"),
+            body,
+            content_type="application/msgpack",
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(b"".join(r.streaming_content))["status"], 201)
+
+    def test_gzip(self):
+        """Large responses are gzipped if the client accepts it, but HTML pages aren't."""
+
+        plain = self.client.get(papi("delivered-posts"))
+        r = self.client.get(
+            papi("delivered-posts"), HTTP_ACCEPT_ENCODING="gzip, deflate"
+        )
+        self.assertEqual(r["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(r.content), plain.content)
+        self.assertTrue(r["ETag"].startswith("W/"))
+        r = self.client.get(papi("delivered-posts"), HTTP_IF_NONE_MATCH=r["ETag"])
+        self.assertEqual(r.status_code, 304)
+
+        # JSONClient always asks for JSON.
+        r = django.test.Client().get(
+            papi("delivered-posts"),
+            HTTP_ACCEPT="text/html",
+            HTTP_ACCEPT_ENCODING="gzip",
+        )
+        self.assertEqual(r["Content-Type"], "text/html; charset=utf-8")
+        self.assertEqual(r.status_code, 200)
+        self.assertFalse(r.has_header("Content-Encoding"))
+
+    @unittest.skipUnless(middleware.brotli, "requires brotli")
+    def test_brotli(self):
+        """Brotli is preferred when the client accepts it."""
+
+        plain = self.client.get(papi("delivered-posts"))
+        r = self.client.get(papi("delivered-posts"), HTTP_ACCEPT_ENCODING="gzip, br")
+        self.assertEqual(r["Content-Encoding"], "br")
+        self.assertEqual(middleware.brotli.decompress(r.content), plain.content)
+
+
+class ExportTestCase(APITestCase, BoxMixin):
+    """Tests for /postapi/export, /postapi/boxes/<name>/export, and the export_mail command."""
+
+    def setUp(self):
+        super(ExportTestCase, self).setUp()
+        sender = User.objects.get(username="test")
+        self.source = Box.objects.create(name="cool-people")
+        self.box = Box.objects.create(name="mannie")
+        Subscription.objects.create(source=self.source, target=self.box, watermark=2)
+        create_backlog(sender, self.source, 2)
+        create_backlog(sender, self.box, 3)
+
+    def get(self, path, data={}):
+        # JSONClient can't read streamed responses.
+        if data:
+            path = f"{path}?{urlencode(data)}"
+        return self.client.generic("GET", path)
+
+    def content(self, path):
+        r = self.get(path)
+        self.assertEqual(r.status_code, 200)
+        return b"".join(r.streaming_content)
+
+    def export(self, path, data={}):
+        r = self.get(path, data)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r["Content-Type"], "application/x-ndjson")
+        return [json.loads(line) for line in b"".join(r.streaming_content).splitlines()]
+
+    def test_export_everything(self):
+        """Everything is exported, referenced objects first, each type in ID order."""
+
+        rows = self.export(papi("export"))
+        types = [row["type"] for row in rows]
+        self.assertEqual(
+            types, ["box"] * 2 + ["post"] * 5 + ["deliveredpost"] * 5 + ["subscription"]
+        )
+        post = Post.objects.order_by("id").first()
+        self.assertEqual(
+            rows[2],
+            {
+                "type": "post",
+                "id": post.id,
+                "sender": "test",
+                "created": post.created.isoformat().replace("+00:00", "Z"),
+                "subject": post.subject,
+                "content_type": post.content_type,
+                "body": post.body,
+            },
+        )
+        self.assertEqual(rows[-1]["source"], "cool-people")
+        self.assertEqual(rows[-1]["watermark"], 2)
+
+    def test_resume(self):
+        """An export can be resumed after a given position."""
+
+        rows = self.export(papi("export"))
+        resumed = self.export(papi("export"), {"after": f"post:{rows[3]['id']}"})
+        self.assertEqual(resumed, rows[4:])
+        r = self.get(papi("export"), {"after": "mail:1"})
+        self.assertEqual(r.status_code, 400)
+
+    def test_export_box(self):
+        """A box's export has only the box, its posts, and its subscriptions."""
+
+        rows = self.export(papi("boxes/mannie/export"))
+        self.assertEqual(
+            [row["type"] for row in rows],
+            ["box"] + ["post"] * 3 + ["deliveredpost"] * 3 + ["subscription"],
+        )
+        self.assertTrue(
+            all(
+                row["box"] == "mannie" for row in rows if row["type"] == "deliveredpost"
+            )
+        )
+        r = self.get(papi(f"boxes/{ARBITRARY_NONEXISTENT_NAME}/export"))
+        self.assertEqual(r.status_code, 404)
+
+    def test_staff_only(self):
+        """Only staff can export the whole store."""
+
+        User.objects.create_user(username="plain", password="plain")
+        self.client.login(username="plain", password="plain")
+        self.assertEqual(self.get(papi("export")).status_code, 403)
+        self.assertEqual(self.get(papi("boxes/mannie/export")).status_code, 200)
+
+    def test_command(self):
+        """The export_mail command writes the same export, optionally gzipped."""
+
+        expected = self.content(papi("export"))
+        out, err = io.StringIO(), io.StringIO()
+        call_command("export_mail", "--chunk-size=2", stdout=out, stderr=err)
+        self.assertEqual(out.getvalue().encode(), expected)
+        self.assertIn("Exported 13 objects.", err.getvalue())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "mannie.ndjson.gz")
+            call_command("export_mail", "--box=mannie", f"--output={path}", stderr=err)
+            with gzip.open(path) as f:
+                self.assertEqual(f.read(), self.content(papi("boxes/mannie/export")))
+
+
+class ImportTestCase(APITestCase):
+    """Tests for the import_mail command."""
+
+    def setUp(self):
+        super(ImportTestCase, self).setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def import_mail(self, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command("import_mail", *args, stdout=out, stderr=err)
+        self.assertIn("Import complete.", out.getvalue())
+        return err.getvalue()
+
+    def inbox(self, name):
+        return list(
+            DeliveredPost.objects.filter(box__name=name)
+            .order_by("id")
+            .values_list(
+                "post__subject", "post_subject", "post_sender__username", "is_read"
+            )
+        )
+
+    def test_round_trip(self):
+        """An export imports back as it was, with watermarks translated to the new IDs."""
+
+        sender = User.objects.create(username="sender")
+        source = Box.objects.create(name="cool-people")
+        target = Box.objects.create(name="mannie")
+        create_backlog(sender, source, 3)
+        create_backlog(sender, target, 2)
+        DeliveredPost.objects.filter(
+            id=DeliveredPost.objects.filter(box=target).first().id
+        ).update(is_read=True)
+        watermark = DeliveredPost.objects.filter(box=source).order_by("id")[1]
+        Subscription.objects.create(
+            source=source, target=target, watermark=watermark.id
+        )
+        inboxes = {name: self.inbox(name) for name in ("cool-people", "mannie")}
+        path = self.write("export.ndjson.gz", gzip.compress(b"".join(export_lines())))
+
+        Box.objects.all().delete()
+        Post.objects.all().delete()
+        sender.delete()
+        err = self.import_mail(path, "--chunk-size=3")
+
+        self.assertIn("rows/s", err)
+        self.assertIn("2 boxs, 5 posts, 5 deliveredposts, 1 subscriptions", err)
+        for name, inbox in inboxes.items():
+            self.assertEqual(self.inbox(name), inbox)
+        sender = User.objects.get(username="sender")
+        self.assertFalse(sender.has_usable_password())
+        sub = Subscription.objects.get()
+        self.assertEqual(
+            sub.watermark,
+            DeliveredPost.objects.filter(box=sub.source).order_by("id")[1].id,
+        )
+        # New posts get IDs after the imported ones, and are counted.
+        self.assertGreater(
+            Post.objects.create(sender=sender, subject="New", body="").id,
+            watermark.post_id,
+        )
+        self.assertEqual(BoxCounter.objects.get(box__name="mannie").unread, 1)
+
+    def test_mbox(self):
+        """Messages in an mbox file are delivered to a box, creating their senders."""
+
+        Box.objects.create(name="mannie")
+        path = os.path.join(self.tmp.name, "mail.mbox")
+        mbox = mailbox.mbox(path)
+        mbox.add(
+            b"From: Wyoh <wyoh@luna.example>\nSubject: =?utf-8?q?Caf=C3=A9?=\n"
+            b"Date: Tue, 14 Jul 2076 10:00:00 +0000\nStatus: RO\n\nHello!\n"
+        )
+        mbox.add(b"From: mike@luna.example\nSubject: Hi\n\nIt's me.\n")
+        mbox.flush()
+        mbox.close()
+
+        self.import_mail(path, "--box=mannie")
+        posts = list(Post.objects.order_by("id"))
+        self.assertEqual([post.subject for post in posts], ["Caf\u00e9", "Hi"])
+        self.assertEqual(posts[0].sender.username, "wyoh")
+        self.assertEqual(posts[0].body, "Hello!\n")
+        self.assertEqual(posts[0].created.year, 2076)
+        self.assertEqual(
+            self.inbox("mannie"),
+            [("Caf\u00e9", "Caf\u00e9", "wyoh", True), ("Hi", "Hi", "mike", False)],
+        )
+
+        with self.assertRaises(CommandError):
+            self.import_mail(path)
+
+    def test_bad_input(self):
+        """Bad input is reported with its line number."""
+
+        path = self.write("bad.ndjson", b'{"type": "box", "name": "mannie"}\n{nope\n')
+        with self.assertRaisesRegex(CommandError, "Line 2"):
+            self.import_mail(path)
+
+    def ndjson(self, *rows):
+        return self.write(
+            "import.ndjson", b"".join(json.dumps(row).encode() + b"\n" for row in rows)
+        )
+
+    def test_missing_field(self):
+        """A row without a required field is reported with its row number."""
+
+        post = {
+            "type": "post",
+            "id": 1,
+            "created": "2076-07-04T00:00:00Z",
+            "subject": "Hi",
+            "content_type": "text/x-markdown",
+            "body": "",
+        }
+        path = self.ndjson({"type": "box", "name": "mannie"}, {**post, "sender": None})
+        with self.assertRaisesRegex(CommandError, "Row 2: post has no sender"):
+            self.import_mail(path)
+        self.assertFalse(Post.objects.exists())
+
+    def test_database_error(self):
+        """A chunk the database rejects is reported by its rows, and earlier chunks are kept."""
+
+        post = {
+            "type": "post",
+            "id": 1,
+            "sender": "mike",
+            "created": "2076-07-04T00:00:00Z",
+            "subject": "Hi",
+            "content_type": "text/x-markdown",
+            "body": "",
+        }
+        path = self.ndjson({"type": "box", "name": "mannie"}, post, post)
+        with self.assertRaisesRegex(CommandError, "Rows 3-3 couldn't be imported"):
+            self.import_mail(path, "--chunk-size=2")
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_watermark_without_posts(self):
+        """A watermark whose source box's posts weren't imported starts after the box's existing posts."""
+
+        source = Box.objects.create(name="cool-people")
+        create_backlog(User.objects.create(username="sender"), source, 2)
+        path = self.ndjson(
+            {"type": "box", "name": "cool-people"},
+            {"type": "box", "name": "mannie"},
+            {"type": "box", "name": "wyoh"},
+            {
+                "type": "subscription",
+                "source": "cool-people",
+                "target": "mannie",
+                "watermark": 12345,
+            },
+            {
+                "type": "subscription",
+                "source": "cool-people",
+                "target": "wyoh",
+                "watermark": 0,
+            },
+        )
+        self.import_mail(path)
+        latest = DeliveredPost.objects.filter(box=source).order_by("id").last()
+        self.assertEqual(
+            Subscription.objects.get(target__name="mannie").watermark, latest.id
+        )
+        self.assertEqual(Subscription.objects.get(target__name="wyoh").watermark, 0)
+
+
+class BodyStoreTestCase(APITestCase, BoxMixin):
+    """Tests for the post body store."""
+
+    LONG_BODY = "All hands to the catapult. " * 40 + "Now!"
+
+    def setUp(self):
+        super(BodyStoreTestCase, self).setUp()
+        self.sender = User.objects.get(username="test")
+        self.box_url = self.create_box("mannie")
+
+    def post(self, subject, body):
+        r = self.client.post(papi("posts"), {"subject": subject, "body": body})
+        self.assertEqual(r.status_code, 201)
+        return Post.objects.get(id=scrape_pk(r.json_content["url"]))
+
+    def report(self, *args):
+        out = io.StringIO()
+        call_command("body_storage", *args, stdout=out)
+        return out.getvalue()
+
+    @django.test.override_settings(POSTAPI_BODY_STORE=True)
+    def test_store(self):
+        """Identical bodies are stored once, large ones compressed, and read back as they were."""
+
+        posts = [self.post(f"Notice {i}", self.LONG_BODY) for i in range(3)]
+        short = self.post("Short", "Hi!")
+        self.assertEqual(PostBody.objects.count(), 2)
+        body = PostBody.objects.get(digest=posts[0].stored_body_id)
+        self.assertEqual(body.compression, bodystore.default_compression())
+        self.assertLess(len(body.data), body.size)
+        self.assertEqual(body.size, len(self.LONG_BODY))
+        self.assertEqual(
+            PostBody.objects.get(digest=short.stored_body_id).compression, ""
+        )
+        self.assertEqual(Post.objects.filter(body_text="").count(), 4)
+
+        r = self.client.get(papi("posts", posts[1].id))
+        self.assertEqual(r.json_content["body"], self.LONG_BODY)
+        self.assertEqual(Post.objects.get(id=short.id).body, "Hi!")
+        post = Post.objects.get(id=posts[2].id)
+        post.body = "Inline again."
+        post.save()
+        self.assertEqual(Post.objects.get(id=post.id).body, "Inline again.")
+
+    @django.test.override_settings(POSTAPI_BODY_STORE=True)
+    def test_batch_deliver_and_export(self):
+        """Batch delivered bodies are stored, and exported in full."""
+
+        items = [
+            {"to": [self.box_url], "subject": f"Notice {i}", "body": self.LONG_BODY}
+            for i in range(5)
+        ]
+        r = self.client.generic(
+            "POST",
+            papi("actions/batch-deliver"),
+            json.dumps(items),
+            content_type="application/json",
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(
+            [json.loads(line)["status"] for line in r.streaming_content], [201] * 5
+        )
+        self.assertEqual(Post.objects.filter(stored_body__isnull=False).count(), 5)
+        self.assertEqual(PostBody.objects.count(), 1)
+        rows = [json.loads(line) for line in b"".join(export_lines()).splitlines()]
+        bodies = [row["body"] for row in rows if row["type"] == "post"]
+        self.assertEqual(bodies, [self.LONG_BODY] * 5)
+        self.assertNotIn("body_data", rows[1])
+
+    @django.test.override_settings(POSTAPI_BODY_STORE=True)
+    def test_search(self):
+        """Stored bodies are searched along with the subject, with or without the index."""
+
+        post = self.post("Notice", self.LONG_BODY)
+        inline = Post.objects.create(sender=self.sender, subject="Catapult", body="")
+        for p in (post, inline):
+            DeliveredPost.objects.create(
+                box=Box.objects.get(name="mannie"),
+                post=p,
+                post_sender=self.sender,
+                post_created=p.created,
+                post_subject=p.subject,
+            )
+        r = self.client.get(papi("boxes", "mannie") + "/search", {"q": "notice hands"})
+        self.assertEqual(
+            [row["subject"] for row in r.json_content["results"]], ["Notice"]
+        )
+        r = self.client.get(papi("boxes", "mannie") + "/search", {"q": "catapult"})
+        self.assertEqual(
+            [row["subject"] for row in r.json_content["results"]],
+            ["Catapult", "Notice"],
+        )
+        with mock.patch(
+            "postapi.bodystore.decompress", wraps=bodystore.decompress
+        ) as decompress:
+            r = self.client.get(papi("boxes", "mannie") + "/search", {"q": "notice"})
+        self.assertEqual(
+            [row["subject"] for row in r.json_content["results"]], ["Notice"]
+        )
+        decompress.assert_not_called()
+
+    def test_compact_and_report(self):
+        """The command moves inline bodies into the store, and reports the savings."""
+
+        for i in range(4):
+            self.post(f"Notice {i}", self.LONG_BODY)
+        Post.objects.create(sender=self.sender, subject="Empty", body="")
+        out = self.report()
+        self.assertIn("Posts: 5 (5 inline, 0 in the body store)", out)
+        self.assertIn(
+            f"Inline bodies: {len(self.LONG_BODY) * 4:,} bytes, 1 distinct", out
+        )
+        for i in range(3):
+            self.post(f"Other {i}", f"{i} {self.LONG_BODY}")
+        with mock.patch(
+            "postapi.bodystore.compress", wraps=bodystore.compress
+        ) as compress:
+            out = self.report("--sample=2")
+        self.assertEqual(compress.call_count, 2)
+        self.assertIn("Posts: 8 (8 inline, 0 in the body store)", out)
+        self.assertIn("4 distinct; about ", out)
+        Post.objects.filter(subject__startswith="Other").delete()
+
+        out = self.report("--compact", "--batch-size=3")
+        self.assertIn("Moved 4 bodies into the body store.", out)
+        self.assertIn("Posts: 5 (1 inline, 4 in the body store)", out)
+        self.assertRegex(
+            out,
+            rf"Total: .* bytes for {len(self.LONG_BODY) * 4:,} bytes of post bodies \(\d+\.\dx smaller\)",
+        )
+        self.assertEqual(
+            [post.body for post in Post.objects.order_by("id")],
+            [self.LONG_BODY] * 4 + [""],
+        )
+
+        Post.objects.filter(stored_body__isnull=False).delete()
+        self.assertIn("Pruned 0 unused bodies.", self.report("--prune"))
+        PostBody.objects.update(created=timezone.now() - datetime.timedelta(days=1))
+        self.assertIn("Pruned 1 unused bodies.", self.report("--prune"))
+
+    def test_codecs(self):
+        """Bodies round-trip through every available compression."""
+
+        compressions = [bodystore.ZLIB] + (
+            [bodystore.ZSTD] if bodystore.zstandard else []
+        )
+        for compression in compressions:
+            used, data = bodystore.compress(self.LONG_BODY, compression)
+            self.assertEqual(used, compression)
+            self.assertEqual(bodystore.decompress(used, data), self.LONG_BODY)
+        self.assertEqual(bodystore.compress("Hi!", bodystore.ZLIB), ("", b"Hi!"))
+        with self.assertRaises(ValueError):
+            bodystore.decompress("lzma", b"")
+
+
+class PostMixin(object):
+    """An APITestCase mixin for creating test posts.
+
+    This code relies on self.client being a JSONClient.
+    """
+
+    def create_post(self, subject, body):
+        """Creates a box with the given name and returns its PK."""
+
+        r = self.client.post(papi("posts"), {"subject": subject, "body": body})
+        self.assertEqual(r.status_code, 201)
+        url = r.json_content["url"]
+        return (scrape_pk(url), url)
+
+
+class PostListTestCase(APITestCase, PostMixin):
+    """Tests for /postapi/posts."""
+
+    def test_create(self):
+        """A post can be created with a body."""
+
+        pk, url = self.create_post("Test", "Hello, world!")
+        try:
+            # Make sure the object exists in the database.
+            self.assertIsNotNone(Post.objects.get(id=pk))
+        except django.core.exceptions.ObjectDoesNotExist:
+            self.fail("Recently-created post not in database")
+
+    def test_list(self):
+        """Posts can be listed."""
+
+        self.create_post("Test", "Hello, there!")
+        self.create_post("Test 2", "Hi yourself.")
+        r = self.client.get(papi("posts"))
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(isinstance(r.json_content["results"], list))
+        posts = [post["body"] for post in r.json_content["results"]]
+        self.assertCountEqual(posts, ["Hello, there!", "Hi yourself."])
+
+
+class KeysetPaginationTestCase(APITestCase):
+    """Tests for paging through lists."""
+
+    def setUp(self):
+        super(KeysetPaginationTestCase, self).setUp()
+        sender = User.objects.get(username="test")
+        Post.objects.bulk_create(
+            Post(sender=sender, subject=f"Post {i}", body="Hello!") for i in range(25)
+        )
+        # Give some posts the same timestamp, so the ID has to break ties.
+        ids = list(Post.objects.order_by("id").values_list("id", flat=True))
+        Post.objects.filter(id__in=ids[5:15]).update(created=timezone.now())
+
+    def expected(self, *ordering):
+        return list(Post.objects.order_by(*ordering).values_list("id", flat=True))
+
+    def test_pages(self):
+        """Following the next links visits every row once, in order."""
+
+        seen = []
+        url, data = papi("posts"), {"page_size": 10}
+        while url:
+            r = self.client.get(url, data)
+            self.assertEqual(r.status_code, 200)
+            seen.append([scrape_pk(post["url"]) for post in r.json_content["results"]])
+            url, data = r.json_content["next"], {}
+        self.assertEqual([len(page) for page in seen], [10, 10, 5])
+        self.assertEqual(sum(seen, []), self.expected("created", "id"))
+
+    def test_descending(self):
+        """Descending orderings page backwards from the cursor."""
+
+        class View(object):
+            ordering = ("-created",)
+
+        seen = []
+        url = "/postapi/posts?page_size=7"
+        while url:
+            paginator = KeysetPagination()
+            page = paginator.paginate_queryset(
+                Post.objects.all(), Request(APIRequestFactory().get(url)), View()
+            )
+            seen.extend(post.id for post in page)
+            url = paginator.get_next_link()
+        self.assertEqual(seen, self.expected("-created", "pk"))
+
+    def test_deep_pages_without_offset(self):
+        """Later pages take the same queries as the first, and skip rows without OFFSET."""
+
+        r = self.client.get(papi("posts"), {"page_size": 10})
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(papi("posts"), {"page_size": 10})
+        with CaptureQueriesContext(connection) as later:
+            self.client.get(r.json_content["next"])
+        self.assertEqual(len(first), len(later))
+        for query in later:
+            self.assertNotIn("OFFSET", query["sql"].upper())
+
+    def test_page_size(self):
+        """The page size can be chosen, within limits."""
+
+        r = self.client.get(papi("posts"), {"page_size": 3})
+        self.assertEqual(len(r.json_content["results"]), 3)
+        r = self.client.get(papi("posts"), {"page_size": 0})
+        self.assertEqual(len(r.json_content["results"]), 1)
+        r = self.client.get(papi("posts"))
+        self.assertEqual(len(r.json_content["results"]), 25)
+        self.assertIsNone(r.json_content["next"])
+
+    def test_invalid_cursor(self):
+        """A cursor that can't be decoded is an error."""
+
+        for cursor in ["garbage", base64.urlsafe_b64encode(b'["x", "y"]').decode()]:
+            r = self.client.get(papi("posts"), {"cursor": cursor})
+            self.assertEqual(r.status_code, 404)
+
+
+class PostDetailTestCase(APITestCase, PostMixin):
+    """Tests for /postapi/posts/<pk>."""
+
+    def setUp(self):
+        super(PostDetailTestCase, self).setUp()
+        self.pk, _ = self.create_post("Beginning", "Call me Ishmael.")
+
+    def test_get(self):
+        """A post's details may be retrieved."""
+
+        r = self.client.get(papi("posts", self.pk))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json_content["subject"], "Beginning")
+        self.assertEqual(r.json_content["body"], "Call me Ishmael.")
+
+    def test_put(self):
+        """A post's details may not be modified."""
+
+        r = self.client.put(
+            papi("posts", self.pk), {"subject": "Epilogue", "body": "The drama's done."}
+        )
+        self.assertEqual(r.status_code, 405)
+
+    def test_patch(self):
+        """A post's details may not be partially updated."""
+
+        r = self.client.patch(papi("posts", self.pk), {"subject": "Epilogue"})
+        self.assertEqual(r.status_code, 405)
+
+    def test_get_fails_if_not_present(self):
+        """Post detail gives a 404 if the box isn't present."""
+
+        r = self.client.get(papi("posts", ARBITRARY_NONEXISTENT_ID))
+        self.assertEqual(r.status_code, 404)
+
+
+class DeliveredPostMixin(BoxMixin, PostMixin):
+    """An APITestCase mixin for creating delivered posts."""
+
+    class Data(object):
+        def __init__(self, box_name, box_url, post_pk, post_url, dpost_pk, dpost_url):
+            self.box_name = box_name
+            self.box_url = box_url
+            self.post_pk = post_pk
+            self.post_url = post_url
+            self.dpost_pk = dpost_pk
+            self.dpost_url = dpost_url
+
+    def deliver_post(self, box_url, post_url):
+        r = self.client.post(
+            papi("delivered-posts"), {"box": box_url, "post": post_url}
+        )
+        self.assertEqual(r.status_code, 201)
+        url = r.json_content["url"]
+        return (scrape_pk(url), url)
+
+    def create_and_deliver_post(self, boxname, subject, body):
+        box_url = self.create_box(boxname)
+        post_pk, post_url = self.create_post(subject, body)
+        dpost_pk, dpost_url = self.deliver_post(box_url, post_url)
+        return DeliveredPostMixin.Data(
+            boxname, box_url, post_pk, post_url, dpost_pk, dpost_url
+        )
+
+
+class DeliveredPostListTestCase(APITestCase, DeliveredPostMixin):
+    """Tests for /postapi/delivered-posts."""
+
+    def test_create(self):
+        """A post can be delivered."""
+
+        data = self.create_and_deliver_post("john", "Test", "Hello, world!")
+        try:
+            # Make sure the object exists in the database.
+            dpost = DeliveredPost.objects.get(id=data.dpost_pk)
+            self.assertIsNotNone(dpost)
+
+        except django.core.exceptions.ObjectDoesNotExist:
+            self.fail("Recently-created post not in database")
+
+    def test_fails_if_delivered_twice(self):
+        """At most one instance of a post may be delivered to a box at a time."""
+
+        box_url = self.create_box("foo")
+        _, post_url = self.create_post("Test", "Hello, world!")
+        r = self.client.post(
+            papi("delivered-posts"), {"box": box_url, "post": post_url}
+        )
+        self.assertEqual(r.status_code, 201)
+        r = self.client.post(
+            papi("delivered-posts"), {"box": box_url, "post": post_url}
+        )
+        self.assertEqual(r.status_code, 400)
+
+        # ...however, this counts as a separate post!
+        _, post_url2 = self.create_post("Test", "Hello, world!")
+        r = self.client.post(
+            papi("delivered-posts"), {"box": box_url, "post": post_url2}
+        )
+        self.assertEqual(r.status_code, 201)
+
+    def test_list(self):
+        """Delivered posts can be listed."""
+
+        self.create_and_deliver_post("john", "Test", "Hello, world!")
+        self.create_and_deliver_post("owen", "Test 2", "Hello again.")
+        r = self.client.get(papi("delivered-posts"))
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(isinstance(r.json_content["results"], list))
+        posts = [
+            delivered_post["subject"] for delivered_post in r.json_content["results"]
+        ]
+        self.assertCountEqual(posts, ["Test", "Test 2"])
+
+    def test_list_by_sender(self):
+        """Delivered posts can be filtered by sender."""
+
+        self.create_and_deliver_post("john", "Test", "Hello, world!")
+        self.create_and_deliver_post("owen", "Test 2", "Hello again.")
+        r = self.client.get(papi("delivered-posts"), {"boxname": "owen"})
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(isinstance(r.json_content["results"], list))
+        posts = [
+            delivered_post["subject"] for delivered_post in r.json_content["results"]
+        ]
+        self.assertCountEqual(posts, ["Test 2"])
+
+
+class DeliveredPostDetailTestCase(APITestCase, DeliveredPostMixin):
+    """Tests for /postapi/delivered-posts/<pk>."""
+
+    def setUp(self):
+        super(DeliveredPostDetailTestCase, self).setUp()
+        self.data = self.create_and_deliver_post("john", "Test", "Hello, world!")
+
+    def test_get(self):
+        """A delivered post's details may be retrieved."""
+
+        r = self.client.get(papi("delivered-posts", self.data.dpost_pk))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json_content["box"], self.data.box_url)
+        self.assertEqual(r.json_content["post"], self.data.post_url)
+        self.assertIn("created", r.json_content)
+        self.assertIn("delivered", r.json_content)
+        self.assertFalse(r.json_content["is_read"])
+        self.assertEqual(r.json_content["sender"], "test")
+        self.assertEqual(r.json_content["subject"], "Test")
+
+    def test_mark_read_and_unread(self):
+        """Delivered posts may be marked read and unread, and are unread by default."""
+
+        # default is unread
+        self.assertFalse(DeliveredPost.objects.get(id=self.data.dpost_pk).is_read)
+
+        # mark as read
+        r = self.client.patch(
+            papi("delivered-posts", self.data.dpost_pk), {"is_read": True}
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(DeliveredPost.objects.get(id=self.data.dpost_pk).is_read)
+
+        # now mark as unread again
+        r = self.client.patch(
+            papi("delivered-posts", self.data.dpost_pk), {"is_read": False}
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertFalse(DeliveredPost.objects.get(id=self.data.dpost_pk).is_read)
+
+    def test_delete(self):
+        """Delivered posts can be deleted without affecting the underlying post."""
+
+        r = self.client.delete(papi("delivered-posts", self.data.dpost_pk))
+        self.assertEqual(r.status_code, 204)
+        self.assertFalse(DeliveredPost.objects.filter(id=self.data.dpost_pk).exists())
+        self.assertTrue(Post.objects.filter(id=self.data.post_pk).exists())
+
+    def test_patch_copies_post_fields_only_for_a_new_post(self):
+        """Updating a delivered post only reads its post if the post changes."""
+
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.patch(
+                papi("delivered-posts", self.data.dpost_pk), {"is_read": True}
+            )
+        self.assertEqual(r.status_code, 200)
+        post_table = Post._meta.db_table
+        self.assertFalse(
+            [q for q in queries if f'FROM "{post_table}"' in q["sql"]],
+            queries.captured_queries,
+        )
+
+        _, post_url = self.create_post("Other", "Hello again.")
+        r = self.client.patch(
+            papi("delivered-posts", self.data.dpost_pk), {"post": post_url}
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(
+            DeliveredPost.objects.get(id=self.data.dpost_pk).post_subject, "Other"
+        )
+
+    def test_get_fails_if_not_present(self):
+        """Delivered post detail gives a 404 if the box isn't present."""
+
+        r = self.client.get(papi("delivered-posts", ARBITRARY_NONEXISTENT_ID))
+        self.assertEqual(r.status_code, 404)
+
+
+class FieldsAndExpandTestCase(APITestCase, DeliveredPostMixin):
+    """Tests for ?fields= and ?expand=."""
+
+    def setUp(self):
+        super(FieldsAndExpandTestCase, self).setUp()
+        self.data = self.create_and_deliver_post("mannie", "Test", "Hello, Mannie!")
+
+    def test_fields(self):
+        """Only the requested fields are returned."""
+
+        r = self.client.get(self.data.dpost_url, {"fields": "subject,is_read,bogus"})
+        self.assertEqual(r.json_content, {"subject": "Test", "is_read": False})
+        r = self.client.get(papi("delivered-posts"), {"fields": "id"})
+        self.assertEqual(r.json_content["results"], [{"id": self.data.dpost_pk}])
+        r = self.client.get(papi("boxes/mannie"), {"fields": "name,unread"})
+        self.assertEqual(r.json_content, {"name": "mannie", "unread": 1})
+
+    def test_expand(self):
+        """Related objects are inlined on request, and their fields can be selected too."""
+
+        r = self.client.get(self.data.dpost_url)
+        self.assertEqual(r.json_content["post"], self.data.post_url)
+        r = self.client.get(self.data.dpost_url, {"expand": "post,box"})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json_content["post"]["body"], "Hello, Mannie!")
+        self.assertEqual(
+            r.json_content["post"]["delivered_posts"], [self.data.dpost_url]
+        )
+        self.assertEqual(r.json_content["box"]["name"], "mannie")
+        self.assertEqual(r.json_content["box"]["total"], 1)
+
+        r = self.client.get(
+            self.data.dpost_url, {"expand": "post", "fields": "is_read,post.body"}
+        )
+        self.assertEqual(
+            r.json_content, {"is_read": False, "post": {"body": "Hello, Mannie!"}}
+        )
+
+    def test_writes_ignore_fields(self):
+        """Creating and updating save every field, whatever ?fields= and ?expand= say."""
+
+        r = self.client.post(
+            papi("posts") + "?fields=url", {"subject": "Hi", "body": "Hello!"}
+        )
+        self.assertEqual(r.status_code, 201)
+        post = Post.objects.get(id=scrape_pk(r.json_content["url"]))
+        self.assertEqual((post.subject, post.body), ("Hi", "Hello!"))
+
+        r = self.client.post(
+            papi("delivered-posts") + "?fields=id&expand=post",
+            {"box": self.data.box_url, "post": r.json_content["url"]},
+        )
+        self.assertEqual(r.status_code, 201)
+        self.assertTrue(DeliveredPost.objects.filter(post=post).exists())
+
+        r = self.client.patch(
+            self.data.dpost_url + "?fields=subject&expand=post", {"is_read": True}
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(DeliveredPost.objects.get(id=self.data.dpost_pk).is_read)
+
+    def test_expand_query_count(self):
+        """Expanding a list of delivered posts takes the same number of queries however long it is."""
+
+        query_counts = []
+        for page_size in (1, 5):
+            while DeliveredPost.objects.count() < page_size:
+                self.deliver_post(
+                    self.data.box_url, self.create_post("Test", "Again")[1]
+                )
+            with CaptureQueriesContext(connection) as queries:
+                r = self.client.get(
+                    papi("delivered-posts"),
+                    {"expand": "post,box", "page_size": page_size},
+                )
+            self.assertEqual(len(r.json_content["results"]), page_size)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+
+class SubscriptionMixin(DeliveredPostMixin):
+    """An APITestCase mixin for creating test subscriptions.
+
+    This code relies on self.client being a JSONClient.
+    """
+
+    class Data(object):
+        def __init__(
+            self, source_name, source_url, target_name, target_url, sub_pk, sub_url
+        ):
+            self.source_name = source_name
+            self.source_url = source_url
+            self.target_name = target_name
+            self.target_url = target_url
+            self.sub_pk = sub_pk
+            self.sub_url = sub_url
+
+    def create_subscription(self, source_url, target_url):
+        """Creates a subscription with the given source and target, and returns its PK and URL."""
+
+        r = self.client.post(
+            papi("subscriptions"), {"source": source_url, "target": target_url}
+        )
         self.assertEqual(r.status_code, 201)
         url = r.json_content["url"]
         return (scrape_pk(url), url)
@@ -559,8 +1956,8 @@ class SubscriptionListTestCase(APITestCase, SubscriptionMixin):
         data2 = self.create_boxes_and_subscription("group1", "john")
         r = self.client.get(papi("subscriptions"))
         self.assertEqual(r.status_code, 200)
-        self.assertTrue(isinstance(r.json_content, list))
-        sources = [sub["source"] for sub in r.json_content]
+        self.assertTrue(isinstance(r.json_content["results"], list))
+        sources = [sub["source"] for sub in r.json_content["results"]]
         self.assertCountEqual(sources, [data1.source_url, data2.source_url])
 
     def test_fails_if_delivered_twice(self):
@@ -592,7 +1989,7 @@ class SubscriptionDetailTestCase(APITestCase, SubscriptionMixin):
         self.assertEqual(r.status_code, 200)
         self.assertEqual(r.json_content["source"], self.data.source_url)
         self.assertEqual(r.json_content["target"], self.data.target_url)
-        self.assertIsNone(r.json_content["watermark"])
+        self.assertEqual(r.json_content["watermark"], 0)
         self.assertIn("created", r.json_content)
 
     def test_set_watermark(self):
@@ -603,11 +2000,11 @@ class SubscriptionDetailTestCase(APITestCase, SubscriptionMixin):
         )
         dpost_pk, dpost_url = self.deliver_post(self.data.source_url, post_url)
         r = self.client.patch(
-            papi("subscriptions", self.data.sub_pk), {"watermark": dpost_url}
+            papi("subscriptions", self.data.sub_pk), {"watermark": dpost_pk}
         )
         self.assertEqual(r.status_code, 200)
         self.assertEqual(
-            Subscription.objects.get(id=self.data.sub_pk).watermark.id, dpost_pk
+            Subscription.objects.get(id=self.data.sub_pk).watermark, dpost_pk
         )
 
     def test_delete(self):
@@ -617,6 +2014,14 @@ class SubscriptionDetailTestCase(APITestCase, SubscriptionMixin):
         self.assertEqual(r.status_code, 204)
         self.assertFalse(Subscription.objects.filter(id=self.data.sub_pk).exists())
 
+    def test_set_negative_watermark_fails(self):
+        """A subscription's watermark can't be negative."""
+
+        r = self.client.patch(
+            papi("subscriptions", self.data.sub_pk), {"watermark": -1}
+        )
+        self.assertEqual(r.status_code, 400)
+
     def test_get_fails_if_not_present(self):
         """Subscription detail gives a 404 if the subscription isn't present."""
 
@@ -624,79 +2029,476 @@ class SubscriptionDetailTestCase(APITestCase, SubscriptionMixin):
         self.assertEqual(r.status_code, 404)
 
 
-class DeliverActionTestCase(APITestCase, BoxMixin):
-    """Tests for /actions/deliver."""
+class DeliverActionTestCase(APITestCase, BoxMixin):
+    """Tests for /actions/deliver."""
+
+    def setUp(self):
+        super(DeliverActionTestCase, self).setUp()
+        self.box_url = self.create_box("mannie")
+
+    def test_one(self):
+        """Delivery of a message to one box works."""
+
+        r = self.client.post(
+            papi("actions/deliver"),
+            {"to": [self.box_url], "subject": "Test", "body": "Hello, world!"},
+        )
+        self.assertEqual(r.status_code, 200)
+        dposts = r.json_content["posts"]
+        self.assertEqual(len(dposts), 1)
+        dpost_pk = scrape_pk(dposts[0]["url"])
+        dpost = DeliveredPost.objects.get(id=dpost_pk)
+        self.assertIsNotNone(dpost)
+        self.assertEqual(dpost.post.body, "Hello, world!")
+
+    def test_multiple(self):
+        """Delivery of a message to multiple boxes works."""
+
+        box_url2 = self.create_box("moe")
+        r = self.client.post(
+            papi("actions/deliver"),
+            {
+                "to": [self.box_url, box_url2],
+                "subject": "Test",
+                "body": "Hello, world!",
+            },
+        )
+        self.assertEqual(r.status_code, 200)
+        dposts = r.json_content.get("posts", [])
+        self.assertEqual(len(dposts), 2)
+        for pk in [scrape_pk(dpost_data["url"]) for dpost_data in dposts]:
+            dpost = DeliveredPost.objects.get(id=pk)
+            self.assertIsNotNone(dpost)
+            self.assertEqual(dpost.post.body, "Hello, world!")
+
+    def test_fails_if_box_not_present(self):
+        """Delivery of a message to a nonexistent box fails."""
+
+        r = self.client.post(
+            papi("actions/deliver"),
+            {
+                "to": [f"http://localserver/boxes/{ARBITRARY_NONEXISTENT_NAME}"],
+                "subject": "Test",
+                "body": "Hello, world!",
+            },
+        )
+        self.assertEqual(r.status_code, 400)
+
+    def test_succeds_if_box_listed_twice(self):
+        """Delivery succeeds even if the same box is listed multiple times."""
+
+        r = self.client.post(
+            papi("actions/deliver"),
+            {
+                "to": [self.box_url, self.box_url],
+                "subject": "Test",
+                "body": "Hello, world!",
+            },
+        )
+        self.assertEqual(r.status_code, 200)
+        # Ensure we did just one delivery, and that it is reported here.
+        dposts = r.json_content.get("posts", [])
+        self.assertEqual(len(dposts), 1)
+        dpost = DeliveredPost.objects.get(id=scrape_pk(dposts[0]["url"]))
+        self.assertIsNotNone(dpost)
+        self.assertEqual(dpost.post.body, "Hello, world!")
+
+    def test_reports_missing_boxes(self):
+        """Delivery goes to the boxes that exist, and reports the ones that don't."""
+
+        missing_url = self.box_url.replace("mannie", ARBITRARY_NONEXISTENT_NAME)
+        r = self.client.post(
+            papi("actions/deliver"),
+            {
+                "to": [missing_url, self.box_url],
+                "subject": "Test",
+                "body": "Hello, world!",
+            },
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.json_content["posts"]), 1)
+        self.assertEqual(len(r.json_content["delivery_errors"]), 1)
+        self.assertIn(ARBITRARY_NONEXISTENT_NAME, r.json_content["delivery_errors"][0])
+
+    def test_fails_if_no_box_exists(self):
+        """Delivery fails without creating a post if none of the boxes exist."""
+
+        missing_url = self.box_url.replace("mannie", ARBITRARY_NONEXISTENT_NAME)
+        r = self.client.post(
+            papi("actions/deliver"),
+            {"to": [missing_url], "subject": "Test", "body": "Hello, world!"},
+        )
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(len(r.json_content["delivery_errors"]), 1)
+        self.assertFalse(Post.objects.exists())
+
+    def test_query_count_independent_of_recipients(self):
+        """Delivery uses the same number of queries no matter how many boxes it goes to."""
+
+        box_urls = [self.box_url] + [self.create_box(f"box{i}") for i in range(10)]
+        query_counts = []
+        for to in (box_urls[:1], box_urls):
+            with CaptureQueriesContext(connection) as queries:
+                r = self.client.post(
+                    papi("actions/deliver"),
+                    {"to": to, "subject": "Test", "body": "Hello, world!"},
+                )
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(len(r.json_content["posts"]), len(to))
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+
+class BatchDeliverActionTestCase(APITestCase, BoxMixin):
+    """Tests for /actions/batch-deliver."""
+
+    def setUp(self):
+        super(BatchDeliverActionTestCase, self).setUp()
+        self.box_url = self.create_box("mannie")
+        self.box_url2 = self.create_box("moe")
+
+    def batch_deliver(self, body, content_type):
+        """Post a raw body to the batch deliver action and return the response and its parsed result lines."""
+
+        r = self.client.generic(
+            "POST", papi("actions/batch-deliver"), body, content_type=content_type
+        )
+        results = None
+        if r.status_code == 200:
+            self.assertEqual(r["Content-Type"], "application/x-ndjson")
+            content = b"".join(r.streaming_content).decode()
+            results = [json.loads(line) for line in content.splitlines()]
+        return r, results
+
+    def items(self, count):
+        return [
+            {
+                "to": [self.box_url, self.box_url2],
+                "subject": f"Test {i}",
+                "body": "Hello!",
+            }
+            for i in range(count)
+        ]
+
+    def test_json_array(self):
+        """A JSON array of posts is created and delivered."""
+
+        r, results = self.batch_deliver(json.dumps(self.items(3)), "application/json")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([result["index"] for result in results], [0, 1, 2])
+        for i, result in enumerate(results):
+            self.assertEqual(result["status"], 201)
+            self.assertEqual(result["delivered"], 2)
+            post = Post.objects.get(id=scrape_pk(result["post"]))
+            self.assertEqual(post.subject, f"Test {i}")
+            self.assertEqual(post.sender.username, "test")
+        self.assertEqual(DeliveredPost.objects.count(), 6)
+
+    def test_ndjson(self):
+        """Newline-delimited JSON posts are created and delivered, and blank lines are skipped."""
+
+        body = "\n".join(json.dumps(item) for item in self.items(3)) + "\n\n"
+        r, results = self.batch_deliver(body, "application/x-ndjson")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(result["status"] == 201 for result in results))
+        self.assertEqual(Post.objects.count(), 3)
+        self.assertEqual(DeliveredPost.objects.count(), 6)
+
+    @django.test.override_settings(POSTAPI_BATCH_SIZE=2)
+    def test_errors_reported_per_item(self):
+        """Bad items are reported in place without holding up the rest."""
+
+        missing_url = self.box_url.replace("mannie", ARBITRARY_NONEXISTENT_NAME)
+        lines = [
+            json.dumps({"to": [self.box_url], "subject": "Good", "body": "Hello!"}),
+            "{not json",
+            json.dumps({"to": [self.box_url], "body": "No subject"}),
+            json.dumps({"to": [missing_url], "subject": "Nowhere", "body": "Hello!"}),
+            json.dumps(
+                {
+                    "to": [missing_url, self.box_url],
+                    "subject": "Partial",
+                    "body": "Hello!",
+                }
+            ),
+        ]
+        r, results = self.batch_deliver("\n".join(lines), "application/x-ndjson")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(
+            [result["status"] for result in results], [201, 400, 400, 400, 201]
+        )
+        self.assertIn("Line 2", results[1]["errors"]["non_field_errors"][0])
+        self.assertIn("subject", results[2]["errors"])
+        self.assertEqual(len(results[3]["delivery_errors"]), 1)
+        self.assertEqual(results[4]["delivered"], 1)
+        self.assertEqual(len(results[4]["delivery_errors"]), 1)
+        self.assertEqual(
+            sorted(Post.objects.values_list("subject", flat=True)), ["Good", "Partial"]
+        )
+
+    def test_fails_if_not_a_list(self):
+        """A single JSON object or a string isn't accepted."""
+
+        for body in (self.items(1)[0], "abc"):
+            r, _ = self.batch_deliver(json.dumps(body), "application/json")
+            self.assertEqual(r.status_code, 400)
+        self.assertFalse(Post.objects.exists())
+
+    @django.test.override_settings(POSTAPI_BATCH_SIZE=2)
+    def test_failed_batch_reported(self):
+        """A batch that can't be saved is reported in the stream, and later batches go on."""
+
+        deliver_posts = delivery.deliver_posts
+        calls = []
+
+        def fail_second_batch(deliveries):
+            calls.append(deliveries)
+            if len(calls) == 2:
+                raise DatabaseError("Disk full")
+            return deliver_posts(deliveries)
+
+        with mock.patch(
+            "postapi.delivery.deliver_posts", fail_second_batch
+        ), self.assertLogs("postapi.views", "ERROR"):
+            r, results = self.batch_deliver(
+                json.dumps(self.items(5)), "application/json"
+            )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(
+            [result["status"] for result in results], [201, 201, 500, 500, 201]
+        )
+        self.assertIn("non_field_errors", results[2]["errors"])
+        self.assertEqual(
+            sorted(Post.objects.values_list("subject", flat=True)),
+            ["Test 0", "Test 1", "Test 4"],
+        )
+
+    def test_query_count_independent_of_batch_size(self):
+        """A batch takes the same number of queries no matter how many posts are in it."""
+
+        query_counts = []
+        for count in (1, 20):
+            with CaptureQueriesContext(connection) as queries:
+                r, results = self.batch_deliver(
+                    json.dumps(self.items(count)), "application/json"
+                )
+            self.assertEqual(len(results), count)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+
+class DeferredDeliverActionTestCase(APITestCase, BoxMixin):
+    """Tests for /actions/deliver and /actions/batch-deliver with deferred delivery."""
+
+    def setUp(self):
+        super(DeferredDeliverActionTestCase, self).setUp()
+        self.box_url = self.create_box("mannie")
+        self.missing_url = self.box_url.replace("mannie", ARBITRARY_NONEXISTENT_NAME)
+
+    def deliver(self, to, **kwargs):
+        return self.client.post(
+            papi("actions/deliver"),
+            dict(to=to, subject="Test", body="Hello, world!", **kwargs),
+        )
+
+    def test_deferred(self):
+        """A deferred post is queued, and its receipt reports delivery once the job runs."""
+
+        r = self.deliver([self.box_url, self.missing_url], defer=True)
+        self.assertEqual(r.status_code, 202)
+        receipt = r.json_content["receipt"]
+        self.assertEqual(r["Location"], receipt)
+        self.assertEqual(Post.objects.get().id, scrape_pk(r.json_content["post"]))
+        self.assertFalse(DeliveredPost.objects.exists())
+
+        r = self.client.get(receipt)
+        self.assertEqual(r.status_code, 200)
+        self.assertIsNone(r.json_content["completed"])
+        self.assertEqual(
+            [(item["box"], item["status"]) for item in r.json_content["recipients"]],
+            [(self.box_url, "queued"), (self.missing_url, "queued")],
+        )
+
+        self.assertTrue(delivery.run_job(scrape_pk(receipt)))
+        self.assertEqual(DeliveredPost.objects.get().box.name, "mannie")
+        r = self.client.get(receipt)
+        self.assertIsNotNone(r.json_content["completed"])
+        self.assertEqual(
+            [item["status"] for item in r.json_content["recipients"]],
+            ["delivered", "failed"],
+        )
+        self.assertEqual(
+            r.json_content["recipients"][1]["error"], "Box does not exist."
+        )
+
+        # A finished job isn't run again.
+        self.assertFalse(delivery.run_job(scrape_pk(receipt)))
+        self.assertFalse(delivery.pending_jobs().exists())
+
+    @django.test.override_settings(POSTAPI_DEFER_DELIVERY=True)
+    def test_default_from_settings(self):
+        """Whether delivery is deferred defaults to the setting, and can be overridden."""
+
+        self.assertEqual(self.deliver([self.box_url]).status_code, 202)
+        self.assertEqual(self.deliver([self.box_url], defer=False).status_code, 200)
+
+    def test_query_count_independent_of_recipients(self):
+        """Deferred delivery uses the same number of queries no matter how many boxes it goes to."""
+
+        box_urls = [self.box_url.replace("mannie", f"box{i}") for i in range(20)]
+        query_counts = []
+        for to in (box_urls[:1], box_urls):
+            with CaptureQueriesContext(connection) as queries:
+                r = self.deliver(to, defer=True)
+            self.assertEqual(r.status_code, 202)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(DeliveryJobRecipient.objects.count(), 21)
+
+    def test_batch(self):
+        """Batch delivery queues the posts that ask for it."""
+
+        items = [
+            {"to": [self.box_url], "subject": "Now", "body": "Hello!"},
+            {"to": [self.box_url], "subject": "Later", "body": "Hello!", "defer": True},
+        ]
+        r = self.client.generic(
+            "POST",
+            papi("actions/batch-deliver"),
+            json.dumps(items),
+            content_type="application/json",
+        )
+        results = [
+            json.loads(line) for line in b"".join(r.streaming_content).splitlines()
+        ]
+        self.assertEqual([result["status"] for result in results], [201, 202])
+        job = DeliveryJob.objects.get(id=scrape_pk(results[1]["receipt"]))
+        self.assertEqual(job.post.subject, "Later")
+        self.assertEqual(DeliveredPost.objects.get().post.subject, "Now")
+
+
+class BulkActionTestCase(APITestCase, BoxMixin):
+    """Tests for /actions/bulk."""
 
     def setUp(self):
-        super(DeliverActionTestCase, self).setUp()
-        self.box_url = self.create_box("mannie")
+        super(BulkActionTestCase, self).setUp()
+        self.mannie_url = self.create_box("mannie")
+        self.wyoh_url = self.create_box("wyoh")
+        self.mannie = Box.objects.get(name="mannie")
+        self.wyoh = Box.objects.get(name="wyoh")
+        self.sender = User.objects.create(username="mike")
+        create_backlog(self.sender, self.mannie, 5)
+        create_backlog(User.objects.get(username="test"), self.mannie, 2)
+        self.dposts = list(DeliveredPost.objects.filter(box=self.mannie).order_by("id"))
+
+    def bulk(self, **data):
+        return self.client.post(papi("actions/bulk"), data)
+
+    def unread(self, box):
+        return DeliveredPost.objects.filter(box=box, is_read=False).count()
 
-    def test_one(self):
-        """Delivery of a message to one box works."""
+    def test_mark_read_and_unread(self):
+        """A whole box is marked read in one statement, and only changed posts are counted."""
 
-        r = self.client.post(
-            papi("actions/deliver"),
-            {"to": [self.box_url], "subject": "Test", "body": "Hello, world!"},
-        )
+        self.bulk(action="mark-read", ids=[self.dposts[0].id])
+        with CaptureQueriesContext(connection) as queries:
+            r = self.bulk(action="mark-read", box=self.mannie_url)
         self.assertEqual(r.status_code, 200)
-        dposts = r.json_content["posts"]
-        self.assertEqual(len(dposts), 1)
-        dpost_pk = scrape_pk(dposts[0]["url"])
-        dpost = DeliveredPost.objects.get(id=dpost_pk)
-        self.assertIsNotNone(dpost)
-        self.assertEqual(dpost.post.body, "Hello, world!")
-
-    def test_multiple(self):
-        """Delivery of a message to multiple boxes works."""
-
-        box_url2 = self.create_box("moe")
-        r = self.client.post(
-            papi("actions/deliver"),
-            {
-                "to": [self.box_url, box_url2],
-                "subject": "Test",
-                "body": "Hello, world!",
-            },
+        self.assertEqual(r.json_content, {"affected": 6})
+        self.assertEqual(self.unread(self.mannie), 0)
+        self.assertEqual(BoxCounter.objects.get(box=self.mannie).unread, 0)
+        dpost_table = DeliveredPost._meta.db_table
+        writes = [q for q in queries if q["sql"].startswith(f'UPDATE "{dpost_table}"')]
+        self.assertEqual(len(writes), 1)
+
+        r = self.bulk(action="mark-unread", box=self.mannie_url, sender="mike")
+        self.assertEqual(r.json_content, {"affected": 5})
+        self.assertEqual(self.unread(self.mannie), 5)
+
+    def test_filters(self):
+        """Posts are selected by IDs and box together with sender and date range."""
+
+        ids = [dpost.id for dpost in self.dposts[:3]]
+        r = self.bulk(action="mark-read", ids=ids, sender="test")
+        self.assertEqual(r.json_content, {"affected": 0})
+        r = self.bulk(action="mark-read", ids=ids)
+        self.assertEqual(r.json_content, {"affected": 3})
+        DeliveredPost.objects.filter(id=self.dposts[-1].id).update(
+            post_created=timezone.now() + datetime.timedelta(days=1)
         )
-        self.assertEqual(r.status_code, 200)
-        dposts = r.json_content.get("posts", [])
-        self.assertEqual(len(dposts), 2)
-        for pk in [scrape_pk(dpost_data["url"]) for dpost_data in dposts]:
-            dpost = DeliveredPost.objects.get(id=pk)
-            self.assertIsNotNone(dpost)
-            self.assertEqual(dpost.post.body, "Hello, world!")
-
-    def test_fails_if_box_not_present(self):
-        """Delivery of a message to a nonexistent box fails."""
-
-        r = self.client.post(
-            papi("actions/deliver"),
-            {
-                "to": [f"http://localserver/boxes/{ARBITRARY_NONEXISTENT_NAME}"],
-                "subject": "Test",
-                "body": "Hello, world!",
-            },
+        r = self.bulk(
+            action="delete", box=self.mannie_url, start=timezone.now().isoformat()
         )
-        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.json_content, {"affected": 1})
+        self.assertEqual(DeliveredPost.objects.filter(box=self.mannie).count(), 6)
 
-    def test_succeds_if_box_listed_twice(self):
-        """Delivery succeeds even if the same box is listed multiple times."""
-
-        r = self.client.post(
-            papi("actions/deliver"),
-            {
-                "to": [self.box_url, self.box_url],
-                "subject": "Test",
-                "body": "Hello, world!",
-            },
+    def test_delete(self):
+        """Deleting delivered posts leaves the posts themselves alone."""
+
+        r = self.bulk(action="delete", box=self.mannie_url, sender="mike")
+        self.assertEqual(r.json_content, {"affected": 5})
+        self.assertEqual(DeliveredPost.objects.filter(box=self.mannie).count(), 2)
+        self.assertEqual(Post.objects.count(), 7)
+        self.assertEqual(BoxCounter.objects.get(box=self.mannie).total, 2)
+
+    def test_move(self):
+        """Moved posts change boxes, and a post the target already has is merged."""
+
+        DeliveredPost.objects.create(
+            box=self.wyoh,
+            post=self.dposts[0].post,
+            post_sender=self.sender,
+            post_created=self.dposts[0].post_created,
+            post_subject=self.dposts[0].post_subject,
+        )
+        r = self.bulk(
+            action="move", box=self.mannie_url, sender="mike", to=self.wyoh_url
         )
         self.assertEqual(r.status_code, 200)
-        # Ensure we did just one delivery, and that it is reported here.
-        dposts = r.json_content.get("posts", [])
-        self.assertEqual(len(dposts), 1)
-        dpost = DeliveredPost.objects.get(id=scrape_pk(dposts[0]["url"]))
-        self.assertIsNotNone(dpost)
-        self.assertEqual(dpost.post.body, "Hello, world!")
+        self.assertEqual(r.json_content, {"affected": 5})
+        self.assertEqual(DeliveredPost.objects.filter(box=self.mannie).count(), 2)
+        self.assertEqual(DeliveredPost.objects.filter(box=self.wyoh).count(), 5)
+        self.assertEqual(BoxCounter.objects.get(box=self.wyoh).total, 5)
+        self.assertEqual(BoxCounter.objects.get(box=self.mannie).total, 2)
+
+    def test_move_same_post_from_two_boxes(self):
+        """Copies of one post selected from several boxes are moved as one."""
+
+        self.create_box("lunar-authority")
+        authority = Box.objects.get(name="lunar-authority")
+        wyoh_dpost = DeliveredPost.objects.create(
+            box=self.wyoh,
+            post=self.dposts[0].post,
+            post_sender=self.sender,
+            post_created=self.dposts[0].post_created,
+            post_subject=self.dposts[0].post_subject,
+        )
+        ids = [self.dposts[0].id, self.dposts[1].id, wyoh_dpost.id]
+        r = self.bulk(action="move", ids=ids, to=papi("boxes", "lunar-authority"))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json_content, {"affected": 3})
+        self.assertCountEqual(
+            DeliveredPost.objects.filter(box=authority).values_list("id", flat=True),
+            [self.dposts[0].id, self.dposts[1].id],
+        )
+        self.assertFalse(DeliveredPost.objects.filter(box=self.wyoh).exists())
+        self.assertEqual(BoxCounter.objects.get(box=authority).total, 2)
+        self.assertEqual(BoxCounter.objects.get(box=self.wyoh).total, 0)
+
+    def test_invalid(self):
+        """An unknown action, no selection, or a move without a target is rejected."""
+
+        for data in [
+            {"action": "archive", "box": self.mannie_url},
+            {"action": "mark-read"},
+            {"action": "mark-read", "sender": "mike"},
+            {"action": "move", "box": self.mannie_url},
+            {"action": "delete", "box": papi("boxes", ARBITRARY_NONEXISTENT_NAME)},
+        ]:
+            r = self.client.post(papi("actions/bulk"), data)
+            self.assertEqual(r.status_code, 400, data)
+        self.assertEqual(DeliveredPost.objects.count(), 7)
 
 
 class SyncActionTestCase(APITestCase, SubscriptionMixin):
@@ -712,14 +2514,14 @@ class SyncActionTestCase(APITestCase, SubscriptionMixin):
         post_pk, post_url = self.create_post("Test", "Hello, cool people!")
         dpost_pk, _ = self.deliver_post(self.data.source_url, post_url)
         sub = Subscription.objects.get(id=self.data.sub_pk)
-        self.assertIsNone(sub.watermark)
+        self.assertEqual(sub.watermark, 0)
         self.assertEqual(
             DeliveredPost.objects.filter(box__name=self.data.target_name).count(), 0
         )
         r = self.client.post(papi("actions/sync"), {"box": self.data.target_url})
         self.assertEqual(r.status_code, 204)
         sub = Subscription.objects.get(id=self.data.sub_pk)
-        self.assertEqual(sub.watermark.id, dpost_pk)
+        self.assertEqual(sub.watermark, dpost_pk)
         dposts = list(DeliveredPost.objects.filter(box__name=self.data.target_name))
         self.assertEqual(len(dposts), 1)
         self.assertEqual(dposts[0].post.id, post_pk)
@@ -741,17 +2543,784 @@ class SyncActionTestCase(APITestCase, SubscriptionMixin):
         ]
         self.deliver_post(self.data.target_url, posts[0][1])
         r = self.client.patch(
-            papi("subscriptions", self.data.sub_pk), {"watermark": source_dposts[0][1]}
+            papi("subscriptions", self.data.sub_pk), {"watermark": source_dposts[0][0]}
         )
         self.assertEqual(r.status_code, 200)
         sub = Subscription.objects.get(id=self.data.sub_pk)
-        self.assertEqual(sub.watermark.id, source_dposts[0][0])
+        self.assertEqual(sub.watermark, source_dposts[0][0])
 
         # Test: sync delivers the second post and updates the watermark.
         r = self.client.post(papi("actions/sync"), {"box": self.data.target_url})
         self.assertEqual(r.status_code, 204)
         sub = Subscription.objects.get(id=self.data.sub_pk)
-        self.assertEqual(sub.watermark.id, source_dposts[1][0])
+        self.assertEqual(sub.watermark, source_dposts[1][0])
         dposts = list(DeliveredPost.objects.filter(box__name=self.data.target_name))
         self.assertEqual(len(dposts), 2)
         self.assertEqual(dposts[1].post.id, posts[1][0])
+
+    def test_skips_posts_already_delivered(self):
+        """Sync doesn't deliver a post twice if the target box already has it."""
+
+        _, post_url = self.create_post("Test", "Hello, cool people!")
+        self.deliver_post(self.data.source_url, post_url)
+        self.deliver_post(self.data.target_url, post_url)
+        r = self.client.post(papi("actions/sync"), {"box": self.data.target_url})
+        self.assertEqual(r.status_code, 204)
+        self.assertEqual(
+            DeliveredPost.objects.filter(box__name=self.data.target_name).count(), 1
+        )
+
+    def test_multiple_subscriptions(self):
+        """Sync brings in posts from every subscription targeting the box."""
+
+        other_url = self.create_box("hip-people")
+        self.create_subscription(other_url, self.data.target_url)
+        _, post_url1 = self.create_post("Test", "Hello, cool people!")
+        _, post_url2 = self.create_post("Test 2", "Hello, hip people!")
+        self.deliver_post(self.data.source_url, post_url1)
+        self.deliver_post(other_url, post_url2)
+        # a post delivered to both sources is still only delivered once
+        self.deliver_post(other_url, post_url1)
+        r = self.client.post(papi("actions/sync"), {"box": self.data.target_url})
+        self.assertEqual(r.status_code, 204)
+        subjects = DeliveredPost.objects.filter(
+            box__name=self.data.target_name
+        ).values_list("post_subject", flat=True)
+        self.assertCountEqual(subjects, ["Test", "Test 2"])
+
+    def test_query_count_independent_of_backlog(self):
+        """Sync uses the same number of queries no matter how many posts are pending."""
+
+        target = Box.objects.get(name=self.data.target_name)
+        source = Box.objects.get(name=self.data.source_name)
+        for count in (1, 20):
+            for i in range(count):
+                _, post_url = self.create_post(f"Test {i}", "Hello, cool people!")
+                self.deliver_post(self.data.source_url, post_url)
+            with self.assertNumQueries(9):
+                delivery.sync_box(target)
+        self.assertEqual(DeliveredPost.objects.filter(box=target).count(), 21)
+        self.assertEqual(
+            Subscription.objects.get(id=self.data.sub_pk).watermark,
+            DeliveredPost.objects.filter(box=source).latest("id").id,
+        )
+
+    def test_marks_box_active(self):
+        """Syncing a box records that the box is in use."""
+
+        self.assertIsNone(Box.objects.get(name=self.data.target_name).last_active)
+        r = self.client.post(papi("actions/sync"), {"box": self.data.target_url})
+        self.assertEqual(r.status_code, 204)
+        self.assertIsNotNone(Box.objects.get(name=self.data.target_name).last_active)
+
+    def test_watermark_post_deleted(self):
+        """Deleting the post a watermark points at doesn't restart the subscription."""
+
+        posts = [self.create_post(f"Test {i}", "Hello, cool people!") for i in range(2)]
+        source_dposts = [
+            self.deliver_post(self.data.source_url, post_url) for _, post_url in posts
+        ]
+        r = self.client.post(papi("actions/sync"), {"box": self.data.target_url})
+        self.assertEqual(r.status_code, 204)
+
+        # The user deletes their copy of the first post, and the source's copy
+        # of the second post (the one the watermark names) is deleted too.
+        target_dpost = DeliveredPost.objects.get(
+            box__name=self.data.target_name, post_id=posts[0][0]
+        )
+        r = self.client.delete(papi("delivered-posts", target_dpost.id))
+        self.assertEqual(r.status_code, 204)
+        r = self.client.delete(papi("delivered-posts", source_dposts[1][0]))
+        self.assertEqual(r.status_code, 204)
+        self.assertEqual(
+            Subscription.objects.get(id=self.data.sub_pk).watermark, source_dposts[1][0]
+        )
+
+        # Syncing again only brings in new posts; the deleted one stays deleted.
+        new_post_pk, new_post_url = self.create_post("Test 3", "Still here?")
+        new_dpost_pk, _ = self.deliver_post(self.data.source_url, new_post_url)
+        r = self.client.post(papi("actions/sync"), {"box": self.data.target_url})
+        self.assertEqual(r.status_code, 204)
+        self.assertCountEqual(
+            DeliveredPost.objects.filter(box__name=self.data.target_name).values_list(
+                "post_id", flat=True
+            ),
+            [posts[1][0], new_post_pk],
+        )
+        self.assertEqual(
+            Subscription.objects.get(id=self.data.sub_pk).watermark, new_dpost_pk
+        )
+
+    def deliver_to_source(self, count):
+        """Delivers the given number of posts to the source box."""
+
+        for i in range(count):
+            _, post_url = self.create_post(f"Test {i}", "Hello, cool people!")
+            self.deliver_post(self.data.source_url, post_url)
+
+    def target_count(self):
+        return DeliveredPost.objects.filter(box__name=self.data.target_name).count()
+
+    @django.test.override_settings(POSTAPI_SYNC_CHUNK_SIZE=2)
+    def test_chunked(self):
+        """Sync delivers a backlog bigger than one chunk."""
+
+        self.deliver_to_source(5)
+        r = self.client.post(papi("actions/sync"), {"box": self.data.target_url})
+        self.assertEqual(r.status_code, 204)
+        self.assertEqual(self.target_count(), 5)
+
+    @django.test.override_settings(POSTAPI_SYNC_CHUNK_SIZE=2)
+    def test_max_rows(self):
+        """Sync stops after max_rows source posts, and can be resumed."""
+
+        self.deliver_to_source(5)
+        r = self.client.post(
+            papi("actions/sync"), {"box": self.data.target_url, "max_rows": 3}
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json_content, {"delivered": 3, "more_pending": True})
+        self.assertEqual(self.target_count(), 3)
+
+        # Resuming picks up where the last sync left off.
+        r = self.client.post(
+            papi("actions/sync"), {"box": self.data.target_url, "max_rows": 3}
+        )
+        self.assertEqual(r.status_code, 204)
+        self.assertEqual(self.target_count(), 5)
+
+    @django.test.override_settings(POSTAPI_SYNC_CHUNK_SIZE=2)
+    def test_max_seconds(self):
+        """Sync stops when out of time, but still makes progress."""
+
+        self.deliver_to_source(5)
+        r = self.client.post(
+            papi("actions/sync"), {"box": self.data.target_url, "max_seconds": 0.001}
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.json_content["more_pending"])
+        self.assertGreater(self.target_count(), 0)
+        self.assertLess(self.target_count(), 5)
+
+    def test_bad_budget(self):
+        """Sync budgets must be positive."""
+
+        r = self.client.post(
+            papi("actions/sync"), {"box": self.data.target_url, "max_rows": 0}
+        )
+        self.assertEqual(r.status_code, 400)
+
+
+@django.test.override_settings(POSTAPI_PUSH_ACTIVE_WITHIN=3600)
+class PushTestCase(APITestCase, BoxMixin):
+    """Tests for pushing posts delivered to a box on to its active subscribers."""
+
+    def setUp(self):
+        super(PushTestCase, self).setUp()
+        self.group_url = self.create_box("everyone")
+        self.group = Box.objects.get(name="everyone")
+        now = timezone.now()
+        self.targets = {}
+        for name, last_active in [
+            ("alice", now),
+            ("bob", None),
+            ("carol", now - datetime.timedelta(days=2)),
+        ]:
+            target = Box.objects.create(name=name, last_active=last_active)
+            Subscription.objects.create(source=self.group, target=target)
+            self.targets[name] = target
+
+    def deliver(self):
+        r = self.client.post(
+            papi("actions/deliver"),
+            {"to": [self.group_url], "subject": "Test", "body": "Hello, world!"},
+        )
+        self.assertEqual(r.status_code, 200)
+        return scrape_pk(r.json_content["posts"][0]["url"])
+
+    def count(self, name):
+        return DeliveredPost.objects.filter(box=self.targets[name]).count()
+
+    def test_pushes_to_active_targets(self):
+        """Posts are pushed to recently active targets only, and caught-up watermarks move past them."""
+
+        dpost_pk = self.deliver()
+        self.assertEqual(
+            [self.count(name) for name in ("alice", "bob", "carol")], [1, 0, 0]
+        )
+        watermarks = dict(Subscription.objects.values_list("target__name", "watermark"))
+        self.assertEqual(watermarks, {"alice": dpost_pk, "bob": 0, "carol": 0})
+
+        # There's nothing left for the active target to pull.
+        self.assertEqual(delivery.sync_box(self.targets["alice"]), (0, 0, False))
+        self.assertEqual(delivery.sync_box(self.targets["bob"]).delivered, 1)
+
+    def test_behind_target(self):
+        """A target that isn't caught up gets the post, but keeps its watermark until it syncs."""
+
+        create_backlog(User.objects.get(username="test"), self.group, 2)
+        self.deliver()
+        self.assertEqual(self.count("alice"), 1)
+        self.assertEqual(Subscription.objects.get(target__name="alice").watermark, 0)
+        result = delivery.sync_box(self.targets["alice"])
+        self.assertEqual((result.delivered, result.scanned), (2, 3))
+        self.assertEqual(self.count("alice"), 3)
+
+    @django.test.override_settings(POSTAPI_PUSH_ACTIVE_WITHIN=None)
+    def test_disabled(self):
+        """Nothing is pushed unless pushing is turned on."""
+
+        self.deliver()
+        self.assertEqual(
+            [self.count(name) for name in ("alice", "bob", "carol")], [0, 0, 0]
+        )
+
+    def test_deferred(self):
+        """Queued deliveries are pushed when they run."""
+
+        r = self.client.post(
+            papi("actions/deliver"),
+            {
+                "to": [self.group_url],
+                "subject": "Test",
+                "body": "Hello!",
+                "defer": True,
+            },
+        )
+        delivery.run_job(scrape_pk(r.json_content["receipt"]))
+        self.assertEqual(self.count("alice"), 1)
+
+    def test_query_count_independent_of_subscribers(self):
+        """Pushing uses the same number of queries no matter how many targets are active."""
+
+        query_counts = []
+        for i in range(2):
+            with CaptureQueriesContext(connection) as queries:
+                self.deliver()
+            query_counts.append(len(queries))
+            # Wake up some more targets.
+            for n in range(10):
+                target = Box.objects.create(
+                    name=f"user{i}-{n}", last_active=timezone.now()
+                )
+                Subscription.objects.create(
+                    source=self.group, target=target, watermark=10**9
+                )
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(
+            DeliveredPost.objects.filter(box__name__startswith="user0-").count(), 10
+        )
+
+
+def failing_insert(box_name):
+    """A stand-in for delivery._insert that fails whenever a delivery to the named box is included."""
+
+    def insert(dposts):
+        if any(dpost.box.name == box_name for dpost in dposts):
+            raise DatabaseError("Simulated failure")
+        DeliveredPost.objects.bulk_create(dposts, ignore_conflicts=True)
+
+    return insert
+
+
+class DeliveryRetryTestCase(APITestCase, BoxMixin):
+    """Tests for parking failed deliveries and retrying them."""
+
+    def setUp(self):
+        super(DeliveryRetryTestCase, self).setUp()
+        self.box_urls = [self.create_box(name) for name in ("mannie", "moe", "broken")]
+
+    def deliver(self, **kwargs):
+        return self.client.post(
+            papi("actions/deliver"),
+            dict(to=self.box_urls, subject="Test", body="Hello, world!", **kwargs),
+        )
+
+    def make_due(self):
+        DeliveryRetry.objects.update(next_attempt=timezone.now())
+
+    def test_deliver_parks_failures(self):
+        """A delivery that fails is parked, and the rest still go through."""
+
+        with mock.patch(
+            "postapi.delivery._insert", failing_insert("broken")
+        ), self.assertLogs("postapi.delivery", "WARNING"):
+            r = self.deliver()
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.json_content["posts"]), 2)
+        self.assertIn("broken", r.json_content["delivery_errors"][0])
+        retry = DeliveryRetry.objects.get()
+        self.assertEqual(
+            (retry.box.name, retry.status, retry.attempts), ("broken", "pending", 1)
+        )
+        self.assertIn("Simulated failure", retry.last_error)
+
+    def test_batch_deliver_parks_failures(self):
+        """A batch delivery that fails is parked, and reported per item."""
+
+        items = [{"to": self.box_urls, "subject": "Test", "body": "Hello!"}] * 2
+        with mock.patch(
+            "postapi.delivery._insert", failing_insert("broken")
+        ), self.assertLogs("postapi.delivery", "WARNING"):
+            r = self.client.generic(
+                "POST",
+                papi("actions/batch-deliver"),
+                json.dumps(items),
+                content_type="application/json",
+            )
+            results = [
+                json.loads(line) for line in b"".join(r.streaming_content).splitlines()
+            ]
+        self.assertEqual([result["delivered"] for result in results], [2, 2])
+        self.assertIn("broken", results[0]["delivery_errors"][0])
+        self.assertEqual(DeliveryRetry.objects.count(), 2)
+        self.assertEqual(DeliveredPost.objects.count(), 4)
+
+    def test_sync_parks_failures(self):
+        """A post that fails to copy during a sync is parked, and the sync moves on past it."""
+
+        source, target = Box.objects.get(name="mannie"), Box.objects.get(name="moe")
+        sub = Subscription.objects.create(source=source, target=target)
+        sender = User.objects.get(username="test")
+        create_backlog(sender, source, 3)
+        bad = DeliveredPost.objects.filter(box=source).order_by("id")[1]
+        copy_posts = delivery.copy_posts
+
+        def failing_copy(source_id, target_id, low, high):
+            if low < bad.id <= high:
+                raise DatabaseError("Simulated failure")
+            return copy_posts(source_id, target_id, low, high)
+
+        with mock.patch("postapi.delivery.copy_posts", failing_copy), self.assertLogs(
+            "postapi.delivery", "WARNING"
+        ):
+            result = delivery.sync_box(target)
+        self.assertEqual(result.delivered, 2)
+        self.assertFalse(result.more_pending)
+        sub.refresh_from_db()
+        self.assertEqual(
+            sub.watermark, DeliveredPost.objects.filter(box=source).latest("id").id
+        )
+        retry = DeliveryRetry.objects.get()
+        self.assertEqual((retry.box, retry.post_id), (target, bad.post_id))
+
+        # Once the retry gets through, the target has everything.
+        self.make_due()
+        self.assertTrue(delivery.retry_delivery(retry.id))
+        self.assertEqual(DeliveredPost.objects.filter(box=target).count(), 3)
+
+    def test_retry_delay(self):
+        """Retries back off exponentially, up to a limit."""
+
+        with django.test.override_settings(
+            POSTAPI_RETRY_BASE_DELAY=10, POSTAPI_RETRY_MAX_DELAY=60
+        ):
+            delays = [delivery.retry_delay(n).total_seconds() for n in range(1, 6)]
+        self.assertEqual(delays, [10, 20, 40, 60, 60])
+
+    @django.test.override_settings(POSTAPI_RETRY_MAX_ATTEMPTS=3)
+    def test_retry_backoff_and_give_up(self):
+        """A retry that keeps failing is rescheduled further out each time, then given up on."""
+
+        with mock.patch(
+            "postapi.delivery._insert", failing_insert("broken")
+        ), self.assertLogs("postapi.delivery", "WARNING"):
+            self.deliver()
+            retry = DeliveryRetry.objects.get()
+            self.assertEqual(list(delivery.due_retries()), [])
+
+            self.make_due()
+            before = timezone.now()
+            self.assertTrue(delivery.retry_delivery(retry.id))
+            retry.refresh_from_db()
+            self.assertEqual((retry.status, retry.attempts), ("pending", 2))
+            self.assertGreaterEqual(
+                retry.next_attempt, before + delivery.retry_delay(2)
+            )
+
+            # Not due yet, but a retry can be forced.
+            self.assertEqual(list(delivery.due_retries()), [])
+            self.assertTrue(delivery.retry_delivery(retry.id))
+            retry.refresh_from_db()
+            self.assertEqual((retry.status, retry.attempts), ("dead", 3))
+            self.assertIsNotNone(retry.resolved)
+            self.assertFalse(delivery.retry_delivery(retry.id))
+        self.assertFalse(DeliveredPost.objects.filter(box__name="broken").exists())
+
+    def test_retry_succeeds(self):
+        """A retry that gets through delivers the post and updates the receipt."""
+
+        with mock.patch(
+            "postapi.delivery._insert", failing_insert("broken")
+        ), self.assertLogs("postapi.delivery", "WARNING"):
+            r = self.deliver(defer=True)
+            delivery.run_job(scrape_pk(r.json_content["receipt"]))
+        receipt = self.client.get(r.json_content["receipt"]).json_content
+        self.assertEqual(
+            [item["status"] for item in receipt["recipients"]],
+            ["delivered", "delivered", "retrying"],
+        )
+
+        retry = DeliveryRetry.objects.get()
+        self.make_due()
+        self.assertEqual(list(delivery.due_retries()), [retry])
+        self.assertTrue(delivery.retry_delivery(retry.id))
+        retry.refresh_from_db()
+        self.assertEqual(retry.status, "delivered")
+        self.assertTrue(DeliveredPost.objects.filter(box__name="broken").exists())
+        receipt = self.client.get(r.json_content["receipt"]).json_content
+        self.assertEqual(receipt["recipients"][2]["status"], "delivered")
+
+    def test_metrics(self):
+        """The metrics endpoint reports queue depths and retry latency."""
+
+        with mock.patch(
+            "postapi.delivery._insert", failing_insert("broken")
+        ), self.assertLogs("postapi.delivery", "WARNING"):
+            self.deliver()
+            self.deliver()
+        self.deliver(defer=True)
+        r = self.client.get(papi("metrics"))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json_content["delivery_jobs"]["pending"], 1)
+        retries = r.json_content["retries"]
+        self.assertEqual(
+            (retries["pending"], retries["due"], retries["dead"]), (2, 0, 0)
+        )
+        self.assertGreaterEqual(retries["oldest_pending_age"], 0)
+        self.assertIsNone(retries["mean_latency"])
+
+        self.make_due()
+        retry = DeliveryRetry.objects.first()
+        delivery.retry_delivery(retry.id)
+        retries = self.client.get(papi("metrics")).json_content["retries"]
+        self.assertEqual(
+            (retries["pending"], retries["due"], retries["delivered"]), (1, 1, 1)
+        )
+        retry.refresh_from_db()
+        self.assertAlmostEqual(
+            retries["max_latency"],
+            (retry.resolved - retry.created).total_seconds(),
+            places=3,
+        )
+
+
+class PendingBoxesTestCase(django.test.TestCase):
+    """Tests for choosing which boxes the delivery agent works on."""
+
+    def setUp(self):
+        self.sender = User.objects.create(username="sender")
+        self.source = Box.objects.create(name="everyone")
+        now = timezone.now()
+        self.boxes = {}
+        for name, last_active in [
+            ("fallow", None),
+            ("recent", now - datetime.timedelta(minutes=5)),
+            ("stale", now - datetime.timedelta(days=30)),
+            ("idle", now),
+        ]:
+            box = Box.objects.create(name=name, last_active=last_active)
+            Subscription.objects.create(source=self.source, target=box)
+            self.boxes[name] = box
+        create_backlog(self.sender, self.source, 2)
+        # "idle" is up to date, so it has nothing pending.
+        delivery.sync_box(self.boxes["idle"])
+
+    def test_most_recently_active_first(self):
+        """Pending boxes come most recently active first, never-read boxes last."""
+
+        names = [box.name for box in delivery.pending_boxes()]
+        self.assertEqual(names, ["recent", "stale", "fallow"])
+
+    def test_active_since(self):
+        """Pending boxes can be restricted to recently active ones."""
+
+        since = timezone.now() - datetime.timedelta(days=1)
+        names = [box.name for box in delivery.pending_boxes(active_since=since)]
+        self.assertEqual(names, ["recent"])
+
+    def test_limit(self):
+        """The number of pending boxes can be capped."""
+
+        names = [box.name for box in delivery.pending_boxes(limit=2)]
+        self.assertEqual(names, ["recent", "stale"])
+
+
+class AgentTestCase(django.test.SimpleTestCase):
+    """Tests for the agent loop and its worker pool."""
+
+    class StuckAgent(agents.Agent):
+        """An agent whose every job finds its work locked by someone else."""
+
+        def __init__(self, **kwargs):
+            super(AgentTestCase.StuckAgent, self).__init__(**kwargs)
+            self.passes = 0
+            self.handled = threading.Event()
+
+        def next_batch(self):
+            self.passes += 1
+            return ["job"]
+
+        def handle(self, job):
+            self.handled.set()
+            return False
+
+    def test_no_progress_sleeps(self):
+        """A pass that gets nothing done is followed by a sleep, not another pass."""
+
+        agent = self.StuckAgent(workers=1, interval=60)
+        with mock.patch("postapi.agents.close_old_connections") as close:
+            thread = threading.Thread(target=agent.run)
+            thread.start()
+            self.assertTrue(agent.handled.wait(5))
+            time.sleep(0.2)
+            agent.stop()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(agent.passes, 1)
+        # Once before the pass, and before and after its job.
+        self.assertEqual(close.call_count, 3)
+
+
+class DeliveryAgentTestCase(django.test.TransactionTestCase):
+    """Tests for the run_delivery_agent command.
+
+    The agent's workers use their own database connections, so these tests
+    need committed data.
+    """
+
+    def test_once(self):
+        """A single pass of the agent brings every subscription up to date."""
+
+        sender = User.objects.create(username="sender")
+        source = Box.objects.create(name="everyone")
+        targets = [Box.objects.create(name=f"user{i}") for i in range(5)]
+        for target in targets:
+            Subscription.objects.create(source=source, target=target)
+        create_backlog(sender, source, 3)
+
+        # SQLite's in-memory test database can't take concurrent writers.
+        workers = 2 if connection.vendor == "postgresql" else 1
+        out = io.StringIO()
+        call_command("run_delivery_agent", "--once", workers=workers, stdout=out)
+        self.assertIn("stopped", out.getvalue())
+        for target in targets:
+            self.assertEqual(DeliveredPost.objects.filter(box=target).count(), 3)
+        self.assertFalse(delivery.pending_boxes().exists())
+
+
+class DeliveryQueueTestCase(django.test.TransactionTestCase):
+    """Tests for the run_delivery_queue command."""
+
+    def setUp(self):
+        sender = User.objects.create(username="sender")
+        self.boxes = [Box.objects.create(name=f"user{i}") for i in range(5)]
+        names = [box.name for box in self.boxes]
+        self.jobs = [
+            delivery.enqueue_post(
+                Post.objects.create(sender=sender, subject=f"Post {i}", body="Hello!"),
+                names,
+            )
+            for i in range(3)
+        ]
+
+    def test_once(self):
+        """A single pass of the queue delivers every queued post."""
+
+        # SQLite's in-memory test database can't take concurrent writers.
+        workers = 2 if connection.vendor == "postgresql" else 1
+        out = io.StringIO()
+        call_command("run_delivery_queue", "--once", workers=workers, stdout=out)
+        self.assertIn("stopped", out.getvalue())
+        for box in self.boxes:
+            self.assertEqual(DeliveredPost.objects.filter(box=box).count(), 3)
+        self.assertFalse(delivery.pending_jobs().exists())
+        self.assertFalse(
+            DeliveryJobRecipient.objects.exclude(status="delivered").exists()
+        )
+
+    def test_retry_queue_once(self):
+        """A single pass of the retry queue retries the deliveries that are due."""
+
+        with mock.patch(
+            "postapi.delivery._insert", failing_insert("user0")
+        ), self.assertLogs("postapi.delivery", "WARNING"):
+            delivery.run_job(self.jobs[0].id)
+        DeliveryRetry.objects.update(next_attempt=timezone.now())
+        workers = 2 if connection.vendor == "postgresql" else 1
+        out = io.StringIO()
+        call_command("run_retry_queue", "--once", workers=workers, stdout=out)
+        self.assertIn("stopped", out.getvalue())
+        self.assertEqual(DeliveredPost.objects.count(), 5)
+        self.assertEqual(DeliveryRetry.objects.get().status, "delivered")
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "requires row locking")
+    def test_skips_locked_jobs(self):
+        """A job that another queue processor is running is left alone."""
+
+        job = self.jobs[0]
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_lock(n):
+            with transaction.atomic():
+                DeliveryJob.objects.select_for_update().get(id=job.id)
+                locked.set()
+                release.wait(10)
+
+        holder = threading.Thread(target=run_in_threads, args=(1, hold_lock))
+        holder.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            self.assertFalse(delivery.run_job(job.id))
+        finally:
+            release.set()
+            holder.join()
+        self.assertFalse(DeliveredPost.objects.exists())
+        self.assertTrue(delivery.run_job(job.id))
+
+
+def run_in_threads(count, fn):
+    """Runs fn(n) for n in range(count), each in its own thread with its own connection.
+
+    Re-raises the first exception from any of the threads.
+    """
+
+    errors = []
+
+    def run(n):
+        try:
+            fn(n)
+        except Exception as err:
+            errors.append(err)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+@unittest.skipUnless(
+    connection.vendor == "postgresql", "requires row locking and concurrent writers"
+)
+class ConcurrentSyncTestCase(django.test.TransactionTestCase):
+    """Stress tests for syncing overlapping boxes from many threads at once."""
+
+    THREADS = 8
+    POSTS = 300
+
+    # A deliberately low bar: this catches syncs serializing behind each
+    # other's locks, not ordinary variations in machine speed.
+    MIN_ROWS_PER_SECOND = 100
+
+    def setUp(self):
+        sender = User.objects.create(username="sender")
+        self.sources = [Box.objects.create(name=f"group{i}") for i in range(3)]
+        self.targets = []
+        for i in range(6):
+            target = Box.objects.create(name=f"user{i}")
+            # Each target shares its sources with other targets.
+            for source in (self.sources[i % 3], self.sources[(i + 1) % 3]):
+                Subscription.objects.create(source=source, target=target)
+            self.targets.append(target)
+
+        # Some posts go to more than one source, so a target can receive the
+        # same post through two subscriptions.
+        posts = Post.objects.bulk_create(
+            Post(sender=sender, subject=f"Post {i}", body="Hello!")
+            for i in range(self.POSTS)
+        )
+        dposts = []
+        for i, post in enumerate(posts):
+            sources = [self.sources[i % 3]]
+            if i % 5 == 0:
+                sources.append(self.sources[(i + 1) % 3])
+            dposts.extend(
+                DeliveredPost(
+                    box=source,
+                    post=post,
+                    post_sender=sender,
+                    post_created=post.created,
+                    post_subject=post.subject,
+                )
+                for source in sources
+            )
+        DeliveredPost.objects.bulk_create(dposts)
+
+    def test_overlapping_syncs(self):
+        """Concurrent syncs deliver every post exactly once, and split the work."""
+
+        scanned = [0] * self.THREADS
+
+        def work(n):
+            # Each thread visits the targets in a different order.
+            targets = self.targets[n:] + self.targets[:n]
+            pending = True
+            while pending:
+                pending = False
+                progress = 0
+                for target in targets:
+                    result = delivery.sync_box(target, chunk_size=10)
+                    pending = pending or result.more_pending
+                    progress += result.scanned
+                scanned[n] += progress
+                if pending and not progress:
+                    # Everything left is being synced by other threads.
+                    time.sleep(0.01)
+
+        start = time.perf_counter()
+        run_in_threads(self.THREADS, work)
+        elapsed = time.perf_counter() - start
+
+        for target in self.targets:
+            expected = DeliveredPost.objects.filter(
+                box__subscriptions_from__target=target
+            ).values_list("post_id", flat=True)
+            delivered = DeliveredPost.objects.filter(box=target).values_list(
+                "post_id", flat=True
+            )
+            self.assertCountEqual(delivered, set(expected))
+
+        # Every source post was processed by exactly one thread.
+        pending_total = 0
+        for sub in Subscription.objects.all():
+            source_posts = DeliveredPost.objects.filter(box=sub.source)
+            pending_total += source_posts.count()
+            self.assertEqual(sub.watermark, source_posts.latest("id").id)
+        self.assertEqual(sum(scanned), pending_total)
+
+        self.assertGreater(pending_total / elapsed, self.MIN_ROWS_PER_SECOND)
+
+    def test_skips_locked_subscriptions(self):
+        """A sync leaves subscriptions locked by a concurrent sync alone."""
+
+        target = self.targets[0]
+        locked, release = threading.Event(), threading.Event()
+        sub = Subscription.objects.filter(target=target).first()
+
+        def hold_lock(n):
+            with transaction.atomic():
+                Subscription.objects.select_for_update().get(id=sub.id)
+                locked.set()
+                release.wait(10)
+
+        holder = threading.Thread(target=run_in_threads, args=(1, hold_lock))
+        holder.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            result = delivery.sync_box(target)
+        finally:
+            release.set()
+            holder.join()
+
+        self.assertTrue(result.more_pending)
+        self.assertEqual(Subscription.objects.get(id=sub.id).watermark, 0)
+        other = Subscription.objects.filter(target=target).exclude(id=sub.id).get()
+        self.assertGreater(other.watermark, 0)
+
+        # Once the lock is released, the rest of the box can be synced.
+        self.assertFalse(delivery.sync_box(target).more_pending)
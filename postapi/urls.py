@@ -6,11 +6,16 @@ from postapi import views as postapi
 urlpatterns = [
     path("", postapi.api_root, name="postapi-index"),
     path("boxes", postapi.BoxList.as_view(), name="box-list"),
+    path("box-names", postapi.box_names, name="box-names"),
     path(
         "boxes/<slug:name>",
         postapi.BoxDetail.as_view(),
         name="box-detail",
     ),
+    path("boxes/<slug:name>/inbox", postapi.Inbox.as_view(), name="box-inbox"),
+    path("boxes/<slug:name>/search", postapi.BoxSearch.as_view(), name="box-search"),
+    path("boxes/<slug:name>/counts", postapi.box_counts, name="box-counts"),
+    path("boxes/<slug:name>/export", postapi.box_export, name="box-export"),
     path("posts", postapi.PostList.as_view(), name="post-list"),
     path("posts/<int:pk>", postapi.PostDetail.as_view(), name="post-detail"),
     path(
@@ -29,8 +34,21 @@ urlpatterns = [
         postapi.SubscriptionDetail.as_view(),
         name="subscription-detail",
     ),
+    path(
+        "delivery-jobs/<int:pk>",
+        postapi.DeliveryJobDetail.as_view(),
+        name="deliveryjob-detail",
+    ),
     path("actions/deliver", postapi.deliver, name="deliver-action"),
+    path(
+        "actions/batch-deliver",
+        postapi.batch_deliver,
+        name="batch-deliver-action",
+    ),
+    path("actions/bulk", postapi.bulk, name="bulk-action"),
     path("actions/sync", postapi.sync, name="sync-action"),
+    path("metrics", postapi.metrics, name="metrics"),
+    path("export", postapi.export, name="export"),
     path("users", postapi.UserList.as_view(), name="user-list"),
     path("users/<int:pk>", postapi.UserDetail.as_view(), name="user-detail"),
 ]
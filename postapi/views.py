@@ -1,20 +1,58 @@
+import itertools
+import json
+import logging
+
 from django import forms
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import DatabaseError, transaction
+from django.db.models import Count, Max, Prefetch
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from rest_framework import generics, status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, parser_classes, permission_classes
+from rest_framework.exceptions import NotFound, ParseError, ValidationError
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
-from postapi.models import Box, DeliveredPost, Post, Subscription
+from rest_framework.settings import api_settings
+from postapi import autocomplete, delivery, export as exporter, search
+from postapi.conditional import (
+    ConditionalGetMixin,
+    all_boxes_state,
+    box_state,
+    conditional_response,
+)
+from postapi.fastlists import FastListMixin, format_datetime
+from postapi.models import (
+    Box,
+    DeliveredPost,
+    DeliveryJob,
+    Post,
+    PostBody,
+    Subscription,
+)
+from postapi.pagination import SearchPagination
+from postapi.parsers import MessagePackParser, NDJSONParser
 from postapi.serializers import (
     BoxSerializer,
+    BoxWithPostsSerializer,
+    BulkActionSerializer,
     DeliveredPostSerializer,
+    DeliveryJobSerializer,
+    InboxHeaderSerializer,
     PostSerializer,
+    SearchResultSerializer,
     SubscriptionSerializer,
     UserSerializer,
     DeliverActionSerializer,
     SyncActionSerializer,
+    query_param_list,
 )
 
+logger = logging.getLogger(__name__)
+
 
 @api_view(["GET"])
 @permission_classes([])
@@ -25,6 +63,7 @@ def api_root(request, format=None):
         {
             "users": reverse("user-list", request=request, format=format),
             "boxes": reverse("box-list", request=request, format=format),
+            "box-names": reverse("box-names", request=request, format=format),
             "delivered-posts": reverse(
                 "deliveredpost-list", request=request, format=format
             ),
@@ -32,8 +71,14 @@ def api_root(request, format=None):
             "subscriptions": reverse(
                 "subscription-list", request=request, format=format
             ),
+            "metrics": reverse("metrics", request=request, format=format),
+            "export": reverse("export", request=request, format=format),
             "actions": {
                 "deliver": reverse("deliver-action", request=request, format=format),
+                "batch-deliver": reverse(
+                    "batch-deliver-action", request=request, format=format
+                ),
+                "bulk": reverse("bulk-action", request=request, format=format),
             },
         }
     )
@@ -44,6 +89,7 @@ class UserList(generics.ListAPIView):
 
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    ordering = ("id",)
 
 
 class UserDetail(generics.RetrieveAPIView):
@@ -53,28 +99,186 @@ class UserDetail(generics.RetrieveAPIView):
     serializer_class = UserSerializer
 
 
-class BoxList(generics.ListCreateAPIView):
+class BoxList(ConditionalGetMixin, generics.ListCreateAPIView):
     """Operations on the collection of boxes."""
 
     serializer_class = BoxSerializer
+    ordering = ("name",)
+
+    def get_etag_state(self):
+        return all_boxes_state()
+
+    def perform_create(self, serializer):
+        box = serializer.save()
+        serializer.instance = Box.objects.with_summary().get(id=box.id)
 
     def get_queryset(self):
-        queryset = Box.objects.all()
+        queryset = Box.objects.with_summary()
         # Query support for autocompletion of box name
         name_startswith = self.request.query_params.get("name_startswith", None)
         if name_startswith is not None:
-            queryset = queryset.filter(name__istartswith=name_startswith)
+            queryset = queryset.name_prefix(name_startswith)
         queryset = queryset.order_by("name")
         return queryset
 
 
-class BoxDetail(generics.RetrieveDestroyAPIView):
-    """Operations on an individual box."""
+class BoxNamesForm(forms.Form):
+    prefix = forms.CharField(required=False, strip=False)
+    limit = forms.IntegerField(required=False, min_value=1)
 
-    queryset = Box.objects.all()
-    serializer_class = BoxSerializer
+
+@api_view(["GET"])
+def box_names(request, format=None):
+    """The names of boxes starting with a prefix, for autocompleting addresses.
+
+    Inputs:
+    - prefix: the start of the name, matched ignoring case
+    - limit: the most names to return (optional; capped by the server)
+
+    Outputs:
+    HTTP status code 200, and:
+    - names: the matching box names, in alphabetical order
+    """
+
+    form = BoxNamesForm(request.query_params)
+    if not form.is_valid():
+        raise ValidationError(form.errors)
+    names = autocomplete.box_names(
+        form.cleaned_data["prefix"], limit=form.cleaned_data["limit"]
+    )
+    return Response({"names": names})
+
+
+class BoxDetail(ConditionalGetMixin, generics.RetrieveDestroyAPIView):
+    """Operations on an individual box.
+
+    The box is summarized; add ?posts=true to list all of its posts too.
+    """
+
+    queryset = Box.objects.with_summary()
     lookup_field = "name"
 
+    def get_etag_state(self):
+        return box_state(self.kwargs["name"])
+
+    def get_serializer_class(self):
+        if self.request.query_params.get("posts") in ("true", "1"):
+            return BoxWithPostsSerializer
+        return BoxSerializer
+
+
+class InboxForm(forms.Form):
+    unread = forms.BooleanField(required=False)
+    start = forms.DateTimeField(required=False)
+    end = forms.DateTimeField(required=False)
+
+
+class Inbox(ConditionalGetMixin, FastListMixin, generics.ListAPIView):
+    """Header rows for the posts in a box, newest first.
+
+    Accepts unread=true to list only unread posts, and start and end to list
+    only posts created in that range.
+    """
+
+    serializer_class = InboxHeaderSerializer
+    ordering = ("-post_created", "-id")
+    fast_values = (
+        "id",
+        "post_sender__username",
+        "post_subject",
+        "post_created",
+        "is_read",
+    )
+
+    def fast_row(self, row, links):
+        return {
+            "id": row["id"],
+            "url": links.by_pk("deliveredpost-detail", row["id"]),
+            "sender": row["post_sender__username"],
+            "subject": row["post_subject"],
+            "created": row["post_created"],
+            "is_read": row["is_read"],
+        }
+
+    def get_etag_state(self):
+        return box_state(self.kwargs["name"])
+
+    def get_queryset(self):
+        box = get_object_or_404(Box, name=self.kwargs["name"])
+        queryset = DeliveredPost.objects.filter(box=box).select_related("post_sender")
+        form = InboxForm(self.request.query_params)
+        if form.is_valid():
+            if form.cleaned_data["unread"]:
+                queryset = queryset.filter(is_read=False)
+            if form.cleaned_data["start"]:
+                queryset = queryset.filter(post_created__gte=form.cleaned_data["start"])
+            if form.cleaned_data["end"]:
+                queryset = queryset.filter(post_created__lte=form.cleaned_data["end"])
+        return queryset
+
+
+class SearchForm(forms.Form):
+    q = forms.CharField()
+
+
+class BoxSearch(ConditionalGetMixin, generics.ListAPIView):
+    """Header rows for the posts in a box that match a full-text search, best match first.
+
+    Takes the search as q, over the posts' subjects and bodies, in web
+    search syntax: words, "quoted phrases", OR, and -excluded words.
+    """
+
+    serializer_class = SearchResultSerializer
+    pagination_class = SearchPagination
+    ordering = ("-rank", "-post_created", "-id")
+
+    def get_etag_state(self):
+        return box_state(self.kwargs["name"])
+
+    def get_queryset(self):
+        box = get_object_or_404(Box, name=self.kwargs["name"])
+        form = SearchForm(self.request.query_params)
+        if not form.is_valid():
+            raise ValidationError(form.errors)
+        queryset = search.search_box(box, form.cleaned_data["q"])
+        return queryset.select_related("post_sender")
+
+
+@api_view(["GET"])
+def box_counts(request, name, format=None):
+    """The number of posts in a box, and how many are unread.
+
+    This is cheap enough to poll for an unread badge: the counts are kept up
+    to date as posts change, so this is a single lookup by box name.
+
+    Outputs:
+    HTTP status code 200, and:
+    - total: the number of posts in the box
+    - unread: how many of those are unread
+    - version: a number that changes whenever the box's posts change
+    """
+
+    counts = (
+        Box.objects.filter(name=name)
+        .values("id", "counter__total", "counter__unread", "counter__version")
+        .first()
+    )
+    if counts is None:
+        raise NotFound()
+    etag, response = conditional_response(
+        request, (counts["id"], counts["counter__version"])
+    )
+    if response is None:
+        response = Response(
+            {
+                "total": counts["counter__total"] or 0,
+                "unread": counts["counter__unread"] or 0,
+                "version": counts["counter__version"] or 0,
+            }
+        )
+    response["ETag"] = etag
+    return response
+
 
 class PostListForm(forms.Form):
     sender = forms.CharField(required=False)
@@ -86,12 +290,13 @@ class PostList(generics.ListCreateAPIView):
     """Operations on the collection of posts."""
 
     serializer_class = PostSerializer
+    ordering = ("created", "id")
 
     def perform_create(self, serializer):
         serializer.save(sender=self.request.user)
 
     def get_queryset(self):
-        queryset = Post.objects.all()
+        queryset = Post.objects.select_related("stored_body")
         form = PostListForm(self.request.query_params)
         if form.is_valid():
             kwargs = {}
@@ -107,16 +312,52 @@ class PostList(generics.ListCreateAPIView):
         return queryset
 
 
-class PostDetail(generics.RetrieveDestroyAPIView):
-    """Operations on an individual post."""
+class PostDetail(ConditionalGetMixin, generics.RetrieveDestroyAPIView):
+    """Operations on an individual post.
+
+    A post's own fields never change once it's created, but its list of
+    delivered posts does, so the ETag covers how many there are and the
+    newest of them. Delivered post IDs are never reused, so any delivery or
+    deletion changes one or the other.
+    """
 
-    queryset = Post.objects.all()
+    queryset = Post.objects.select_related("stored_body")
     serializer_class = PostSerializer
 
+    def get_etag_state(self):
+        return (
+            Post.objects.filter(pk=self.kwargs["pk"])
+            .annotate(
+                deliveries=Count("delivered_posts"),
+                last_delivery=Max("delivered_posts__id"),
+            )
+            .values_list("id", "created", "deliveries", "last_delivery")
+            .first()
+        )
+
     def pre_save(self, obj):
         obj.sender = self.request.user
 
 
+def _delivered_posts(request):
+    """Delivered posts, fetched along with whatever the request's ?expand= inlines."""
+
+    expand = query_param_list(request, "expand")
+    queryset = DeliveredPost.objects.select_related("post_sender")
+    if "box" in expand:
+        # The expanded box is summarized, which select_related can't do.
+        queryset = queryset.prefetch_related(
+            Prefetch("box", queryset=Box.objects.with_summary())
+        )
+    else:
+        queryset = queryset.select_related("box")
+    if "post" in expand:
+        queryset = queryset.select_related(
+            "post__sender", "post__stored_body"
+        ).prefetch_related("post__delivered_posts")
+    return queryset
+
+
 class DeliveredPostListForm(forms.Form):
     sender = forms.CharField(required=False)
     boxname = forms.CharField(required=False)
@@ -124,13 +365,44 @@ class DeliveredPostListForm(forms.Form):
     end = forms.DateTimeField(required=False)
 
 
-class DeliveredPostList(generics.ListCreateAPIView):
+class DeliveredPostList(ConditionalGetMixin, FastListMixin, generics.ListCreateAPIView):
     """Operations on the collection of delivered posts."""
 
     serializer_class = DeliveredPostSerializer
+    ordering = ("post_created", "id")
+    fast_values = (
+        "id",
+        "box__name",
+        "post_id",
+        "post_created",
+        "created",
+        "is_read",
+        "post_sender__username",
+        "post_subject",
+    )
+
+    def fast_row(self, row, links):
+        return {
+            "id": row["id"],
+            "url": links.by_pk("deliveredpost-detail", row["id"]),
+            "box": links.by_name("box-detail", row["box__name"]),
+            "post": links.by_pk("post-detail", row["post_id"]),
+            "created": row["post_created"],
+            "delivered": row["created"],
+            "is_read": row["is_read"],
+            "sender": row["post_sender__username"],
+            "subject": row["post_subject"],
+        }
+
+    def get_etag_state(self):
+        boxname = self.request.query_params.get("boxname")
+        # An expanded post lists its deliveries to every box, not just this one.
+        if boxname and not query_param_list(self.request, "expand"):
+            return box_state(boxname)
+        return all_boxes_state()
 
     def get_queryset(self):
-        queryset = DeliveredPost.objects.all()
+        queryset = _delivered_posts(self.request)
         form = DeliveredPostListForm(self.request.query_params)
         if form.is_valid():
             kwargs = {}
@@ -148,17 +420,40 @@ class DeliveredPostList(generics.ListCreateAPIView):
 
 
 class DeliveredPostDetail(generics.RetrieveUpdateDestroyAPIView):
-    """Operations on an individual delivered post."""
+    """Operations on an individual delivered post.
+
+    Accepts expand=post to include the post itself, saving a second request.
+    """
 
-    queryset = DeliveredPost.objects.all()
     serializer_class = DeliveredPostSerializer
 
+    def get_queryset(self):
+        return _delivered_posts(self.request)
+
+
+class DeliveryJobDetail(generics.RetrieveAPIView):
+    """Read-only operations on a queued delivery; the receipt for a deferred deliver."""
 
-class SubscriptionList(generics.ListCreateAPIView):
+    queryset = DeliveryJob.objects.prefetch_related("recipients")
+    serializer_class = DeliveryJobSerializer
+
+
+class SubscriptionList(FastListMixin, generics.ListCreateAPIView):
     """Operations on the collection of subscriptions."""
 
     queryset = Subscription.objects.all()
     serializer_class = SubscriptionSerializer
+    ordering = ("created", "id")
+    fast_values = ("id", "source__name", "target__name", "created", "watermark")
+
+    def fast_row(self, row, links):
+        return {
+            "url": links.by_pk("subscription-detail", row["id"]),
+            "source": links.by_name("box-detail", row["source__name"]),
+            "target": links.by_name("box-detail", row["target__name"]),
+            "created": format_datetime(row["created"]),
+            "watermark": row["watermark"],
+        }
 
 
 class SubscriptionDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -168,6 +463,25 @@ class SubscriptionDetail(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = SubscriptionSerializer
 
 
+def _build_post(user, data):
+    """An unsaved post from validated deliver action input."""
+
+    post = Post(sender=user, subject=data["subject"], body=data["body"])
+    # content_type is optional. Only set it if it was specified.
+    # Otherwise, let the model choose a default.
+    if "content_type" in data:
+        post.content_type = data["content_type"]
+    return post
+
+
+def _defer(data):
+    """Whether validated deliver action input asks for queued delivery."""
+
+    if data.get("defer") is None:
+        return settings.POSTAPI_DEFER_DELIVERY
+    return data["defer"]
+
+
 @api_view(["POST"])
 def deliver(request, format=None):
     """An action that creates a post and immediately delivers it to a set of boxes.
@@ -177,77 +491,378 @@ def deliver(request, format=None):
     - subject: a string containing the subject of the message (required)
     - body: a string containing the message to send (required)
     - content_type: the type of content in the body (optional, default='markdown')
+    - defer: whether to queue the post for delivery rather than deliver it now
+      (optional, default from settings)
 
     Outputs:
     If there are validation errors, HTTP status code 400, and:
     - non_field_errors: a list of validation error messages not associated with a particular field (optional)
     - to, body, content_type: a list of validation error messages associated with these fields (optional)
     - delivery_errors: errors attempting delivery of the message (optional)
+    Otherwise, HTTP status code 200, and:
+    - posts: the delivered posts that were created
+    - delivery_errors: boxes that the post could not be delivered to (optional)
+    If none of the boxes exist, nothing is delivered, and the status code is 400.
+    If delivery is deferred, the boxes aren't checked, and the response is HTTP
+    status code 202, with the receipt URL in the Location header, and:
+    - post: the post resource URL
+    - receipt: the delivery job resource URL, which reports the status of
+      delivery to each box once the queue gets to it
     """
 
     serializer = DeliverActionSerializer(data=request.data)
     if not serializer.is_valid():
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    # Create the post.
     data = serializer.validated_data
-    post = Post(sender=request.user, subject=data["subject"], body=data["body"])
-    # content_type is optional. Only set it if it was specified.
-    # Otherwise, let the model choose a default.
-    if "content_type" in data:
-        post.content_type = data["content_type"]
-    post.save()
+    if _defer(data):
+        with transaction.atomic():
+            post = _build_post(request.user, data)
+            post.save()
+            job = delivery.enqueue_post(post, data["to"])
+        receipt = reverse("deliveryjob-detail", kwargs={"pk": job.pk}, request=request)
+        return Response(
+            {
+                "post": reverse("post-detail", kwargs={"pk": post.pk}, request=request),
+                "receipt": receipt,
+            },
+            status=status.HTTP_202_ACCEPTED,
+            headers={"Location": receipt},
+        )
 
-    # Deliver the posts to the boxes. Collect and return the created DeliveredPost objects.
-    dposts = []
-    delivery_request_errors = []
-    for box in data["to"]:
-        dpost, created = DeliveredPost.objects.get_or_create(
-            box=box,
-            post=post,
-            post_sender=request.user,
-            post_created=post.created,
-            post_subject=post.subject,
+    boxes, missing = delivery.resolve_boxes(data["to"])
+    delivery_request_errors = [f'Box "{name}" does not exist.' for name in missing]
+    if not boxes:
+        return Response(
+            {"delivery_errors": delivery_request_errors},
+            status=status.HTTP_400_BAD_REQUEST,
         )
-        if created:
-            dpost_serializer = DeliveredPostSerializer(
-                dpost, context={"request": request}
-            )
-            dposts.append(dpost_serializer.data)
+
+    # Create the post.
+    post = _build_post(request.user, data)
+    post.save()
+
+    # Deliver the post to the boxes. Collect and return the created DeliveredPost objects.
+    dposts = list(delivery.deliver_post(post, boxes))
+    delivered = {dpost.box_id for dpost in dposts}
+    delivery_request_errors.extend(
+        f'Delivery to box "{box.name}" failed, and will be retried.'
+        for box in boxes
+        if box.id not in delivered
+    )
+    dposts_serializer = DeliveredPostSerializer(
+        dposts, many=True, context={"request": request}
+    )
 
     result = {}
     if len(delivery_request_errors) > 0:
         result["delivery_errors"] = delivery_request_errors
-    if len(dposts) > 0:
-        result["posts"] = dposts
+    result["posts"] = dposts_serializer.data
+
+    return Response(result, status=status.HTTP_200_OK)
+
+
+def _batches(iterable, size):
+    """Split an iterable into lists of at most the given size."""
+
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _deliver_batch(request, batch):
+    """Create and deliver a batch of posts. Yields a result for each (index, item) in the batch."""
+
+    results = {}
+    valid = []
+    for index, item in batch:
+        if isinstance(item, ParseError):
+            errors = {"non_field_errors": [item.detail]}
+            results[index] = {"index": index, "status": 400, "errors": errors}
+            continue
+        serializer = DeliverActionSerializer(data=item)
+        if not serializer.is_valid():
+            errors = serializer.errors
+            results[index] = {"index": index, "status": 400, "errors": errors}
+            continue
+        valid.append((index, serializer.validated_data))
+
+    deferred = [
+        (index, _build_post(request.user, data), data["to"])
+        for index, data in valid
+        if _defer(data)
+    ]
+    valid = [(index, data) for index, data in valid if not _defer(data)]
+
+    # Look up every box named anywhere in the batch at once.
+    names = {name for _, data in valid for name in data["to"]}
+    boxes, _ = delivery.resolve_boxes(list(names))
+    boxes_by_name = {box.name: box for box in boxes}
+
+    deliveries = []
+    for index, data in valid:
+        to = [boxes_by_name[name] for name in data["to"] if name in boxes_by_name]
+        errors = [
+            f'Box "{name}" does not exist.'
+            for name in data["to"]
+            if name not in boxes_by_name
+        ]
+        if not to:
+            results[index] = {"index": index, "status": 400, "delivery_errors": errors}
+            continue
+        deliveries.append((index, _build_post(request.user, data), to, errors))
+
+    posts = [post for _, post, _, _ in deliveries] + [post for _, post, _ in deferred]
+    with transaction.atomic():
+        if settings.POSTAPI_BODY_STORE:
+            PostBody.objects.store(posts)
+        Post.objects.bulk_create(posts)
+        parked = delivery.deliver_posts([(post, to) for _, post, to, _ in deliveries])
+        jobs = delivery.enqueue_posts([(post, to) for _, post, to in deferred])
+
+    for (index, post, _), job in zip(deferred, jobs):
+        results[index] = {
+            "index": index,
+            "status": 202,
+            "post": reverse("post-detail", kwargs={"pk": post.pk}, request=request),
+            "receipt": reverse(
+                "deliveryjob-detail", kwargs={"pk": job.pk}, request=request
+            ),
+        }
+
+    parked_boxes = {}
+    for post, box in parked:
+        parked_boxes.setdefault(post.pk, []).append(box)
+
+    for index, post, to, errors in deliveries:
+        retrying = parked_boxes.get(post.pk, [])
+        errors.extend(
+            f'Delivery to box "{box.name}" failed, and will be retried.'
+            for box in retrying
+        )
+        result = {
+            "index": index,
+            "status": 201,
+            "post": reverse("post-detail", kwargs={"pk": post.pk}, request=request),
+            "delivered": len(to) - len(retrying),
+        }
+        if errors:
+            result["delivery_errors"] = errors
+        results[index] = result
+
+    for index, _ in batch:
+        yield results[index]
+
+
+def _deliver_batch_or_fail(request, batch):
+    """Like _deliver_batch, but returns a failure result for every item if the batch can't be saved.
+
+    The response is already under way by then, so the failure goes in the
+    stream rather than into an error status.
+    """
+
+    try:
+        return list(_deliver_batch(request, batch))
+    except DatabaseError:
+        logger.exception("Batch delivery failed")
+        errors = {"non_field_errors": ["The batch could not be saved."]}
+        return [{"index": index, "status": 500, "errors": errors} for index, _ in batch]
+
+
+@api_view(["POST"])
+@parser_classes(
+    [
+        parser
+        for parser in api_settings.DEFAULT_PARSER_CLASSES
+        if issubclass(parser, (JSONParser, MessagePackParser))
+    ]
+    + [NDJSONParser]
+)
+def batch_deliver(request, format=None):
+    """An action that creates many posts and immediately delivers each to a set of boxes.
+
+    Input is either a JSON array or newline-delimited JSON (application/x-ndjson),
+    where each item has the same fields as the input to the deliver action.
+    Newline-delimited JSON is parsed as it arrives. Items are processed in
+    batches, and each batch is created in bulk in its own transaction.
+
+    Outputs:
+    If the input isn't a list of items, HTTP status code 400.
+    Otherwise, HTTP status code 200, and newline-delimited JSON with one line
+    per item, in input order, streamed as each batch is done:
+    - index: the position of the item in the input
+    - status: 201 if the post was created and delivered, 202 if it was created
+      and queued for delivery, 400 if it wasn't created, or 500 if its batch
+      couldn't be saved, in which case nothing in the batch was created
+    - post: the post resource URL (if created)
+    - delivered: the number of boxes the post was delivered to (if delivered)
+    - receipt: the delivery job resource URL (if queued)
+    - errors: validation errors for the item (optional)
+    - delivery_errors: boxes that the post could not be delivered to (optional)
+    """
+
+    items = request.data
+    if isinstance(items, (dict, str)) or not hasattr(items, "__iter__"):
+        return Response(
+            {"non_field_errors": ["Expected a list of items."]},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    results = (
+        json.dumps(result) + "\n"
+        for batch in _batches(enumerate(items), settings.POSTAPI_BATCH_SIZE)
+        for result in _deliver_batch_or_fail(request, batch)
+    )
+    return StreamingHttpResponse(results, content_type="application/x-ndjson")
+
+
+def _export(request, box=None):
+    try:
+        after = request.query_params.get("after")
+        after = exporter.parse_position(after) if after else None
+    except ValueError as exc:
+        return Response({"after": [str(exc)]}, status=status.HTTP_400_BAD_REQUEST)
+    filename = f"{box.name if box else 'opost'}.ndjson"
+    response = StreamingHttpResponse(
+        exporter.export_lines(box=box, after=after),
+        content_type="application/x-ndjson",
+    )
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def export(request, format=None):
+    """Exports the whole message store as newline-delimited JSON. Staff only.
+
+    Inputs:
+    - after: resume after this position, "<type>:<id>" from the last line received (optional)
+
+    Outputs:
+    HTTP status code 200, and newline-delimited JSON, streamed, with one line
+    per object; see postapi.export. Compressed if the client accepts gzip.
+    """
+
+    return _export(request)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def box_export(request, name, format=None):
+    """Exports a box, the posts in it, and its subscriptions as newline-delimited JSON.
+
+    Inputs and outputs are as for the export of the whole store.
+    """
+
+    return _export(request, get_object_or_404(Box, name=name))
+
+
+@api_view(["POST"])
+def bulk(request, format=None):
+    """An action that marks, deletes, or moves many delivered posts at once.
+
+    The posts are selected and changed with one set-based statement (two
+    for a move), however many there are.
+
+    Inputs:
+    - action: one of mark-read, mark-unread, delete, or move (required)
+    - ids: a list of delivered post IDs
+    - box: a box resource URL, to select the posts in that box
+    - sender: a sender's username, to select only their posts
+    - start, end: select only posts created in this range (optional)
+    - to: the box resource URL to move posts to (required for move)
+    At least one of ids and box is required.
 
-    return Response({"posts": dposts}, status=status.HTTP_200_OK)
+    Outputs:
+    HTTP status code 200, and:
+    - affected: the number of delivered posts changed. Posts that were
+      already read (or unread) aren't counted, and a post moved to a box
+      that already has it is deleted from its old box instead.
+    """
+
+    serializer = BulkActionSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    data = serializer.validated_data
+    kwargs = {}
+    for field, query_key in [
+        ("ids", "id__in"),
+        ("box", "box"),
+        ("sender", "post_sender__username"),
+        ("start", "post_created__gte"),
+        ("end", "post_created__lte"),
+    ]:
+        if field in data:
+            kwargs[query_key] = data[field]
+    dposts = DeliveredPost.objects.filter(**kwargs)
+    action = data["action"]
+    with transaction.atomic():
+        if action == "mark-read":
+            affected = dposts.filter(is_read=False).update(is_read=True)
+        elif action == "mark-unread":
+            affected = dposts.filter(is_read=True).update(is_read=False)
+        elif action == "delete":
+            affected, _ = dposts.delete()
+        else:
+            affected = dposts.move_to(data["to"])
+    return Response({"affected": affected})
+
+
+@api_view(["GET"])
+def metrics(request, format=None):
+    """Numbers describing the state of the delivery and retry queues.
+
+    Outputs:
+    HTTP status code 200, and:
+    - delivery_jobs: the deferred delivery queue:
+      - pending: the number of jobs waiting to run
+      - oldest_pending_age: how long the oldest of them has waited, in seconds
+    - retries: the queue of failed deliveries waiting to be retried:
+      - pending: the number of deliveries waiting to be retried
+      - due: how many of those are due to be retried now
+      - dead: the number of deliveries given up on
+      - oldest_pending_age: how long ago the oldest pending delivery first failed, in seconds
+      - delivered: the number of retried deliveries that got through in the last day
+      - mean_latency, max_latency: how long those took to get through, in seconds
+    """
+
+    return Response(delivery.queue_metrics())
 
 
 @api_view(["POST"])
 def sync(request, format=None):
-    """Brings a box up to date with content from all of its subscriptions."""
+    """Brings a box up to date with content from all of its subscriptions.
+
+    Inputs:
+    - box: the box resource URL to sync (required)
+    - max_rows: the most source posts to process before stopping (optional)
+    - max_seconds: roughly how long to spend before stopping (optional)
+
+    Outputs:
+    If the box is now up to date, HTTP status code 204 with no content.
+    If the sync ran out of budget first, HTTP status code 200, and:
+    - delivered: the number of posts delivered to the box
+    - more_pending: true; sync again to continue where this one left off
+    """
 
     serializer = SyncActionSerializer(data=request.data)
     if not serializer.is_valid():
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-    box = serializer.validated_data["box"]
-    subs = Subscription.objects.filter(target=box)
-    for sub in subs:
-        source_box = sub.source
-        dposts = DeliveredPost.objects.filter(box=source_box).order_by("id")
-        if sub.watermark is not None:
-            dposts = dposts.filter(id__gt=sub.watermark.id)
-        new_watermark = sub.watermark
-        for dpost in dposts:
-            DeliveredPost.objects.get_or_create(
-                box=box,
-                post=dpost.post,
-                post_sender=dpost.post.sender,
-                post_created=dpost.post.created,
-                post_subject=dpost.post.subject,
-            )
-            new_watermark = dpost
-        sub.watermark = new_watermark
-        sub.save()
+    data = serializer.validated_data
+    box = data["box"]
+    box.mark_active()
+    result = delivery.sync_box(
+        box,
+        max_rows=data.get("max_rows", settings.POSTAPI_SYNC_MAX_ROWS),
+        max_seconds=data.get("max_seconds", settings.POSTAPI_SYNC_MAX_SECONDS),
+    )
+    if result.more_pending:
+        return Response(
+            {"delivered": result.delivered, "more_pending": True},
+            status=status.HTTP_200_OK,
+        )
     return Response({}, status=status.HTTP_204_NO_CONTENT)
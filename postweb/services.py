@@ -2,6 +2,7 @@ from django.conf import settings
 import json
 import logging
 import requests
+from urllib.parse import parse_qs, urlsplit
 from postweb.utils import service_url
 
 logger = logging.getLogger(__name__)
@@ -133,6 +134,26 @@ class BoxService(Service):
 
 
 class PostService(Service):
+    def get_inbox(self, inbox_url, cursor=None):
+        """Returns one page of the delivered posts listed by a box's inbox URL.
+
+        Returns the delivered posts, and the cursor for the next page, or None
+        if this is the last page. Pass that cursor back in to get the next page.
+        """
+
+        logger.info("Getting inbox: %s (cursor %s)", inbox_url, cursor)
+        params = {"cursor": cursor} if cursor else None
+        r = self.http.get(
+            inbox_url, params=params, headers={"Accept": "application/json"}
+        )
+        if not r.ok:
+            raise ServiceResponseError(r)
+        page = self.response_to_json(r)
+        next_cursor = None
+        if page["next"]:
+            next_cursor = parse_qs(urlsplit(page["next"]).query)["cursor"][0]
+        return page["results"], next_cursor
+
     def get_delivered_post(self, dpost_url):
         logger.info("Getting post: %s", dpost_url)
         r = self.http.get(dpost_url, headers={"Accept": "application/json"})
@@ -145,16 +166,12 @@ class PostService(Service):
     def get_post_detail(self, dpost_pk):
         logger.info("Viewing post details with delivered post id: %s", dpost_pk)
         url = service_url("postapi", f"delivered-posts/{dpost_pk}")
-        r = self.http.get(url, headers={"Accept": "application/json"})
-        if not r.ok:
-            raise ServiceResponseError(r)
-        dpost = self.response_to_json(r)
-        logger.info("Fetching post body: %s", dpost["post"])
-        r = self.http.get(dpost["post"], headers={"Accept": "application/json"})
+        r = self.http.get(
+            url, params={"expand": "post"}, headers={"Accept": "application/json"}
+        )
         if not r.ok:
             raise ServiceResponseError(r)
-        dpost["post"] = self.response_to_json(r)
-        return dpost
+        return self.response_to_json(r)
 
     def delete_post(self, dpost_pk):
         logger.info("Deleting delivered post id: %s", dpost_pk)
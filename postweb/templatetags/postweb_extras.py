@@ -34,4 +34,4 @@ def represent_date(iso_datetime_str):
 @register.filter
 @stringfilter
 def markdown_to_safe_html(markdown_text):
-    return mark_safe(postweb.utils.markdown_to_html(markdown_text))
+    return mark_safe(postweb.utils.cached_markdown_to_html(markdown_text))
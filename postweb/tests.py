@@ -1,3 +1,70 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import caches
+from django.test import SimpleTestCase
+
+from postweb import utils
+from postweb.services import PostService
+from postweb.templatetags.postweb_extras import markdown_to_safe_html
+
+
+class MarkdownCacheTestCase(SimpleTestCase):
+    """Tests for rendering post bodies to HTML once."""
+
+    TEXT = "# Hello\n\nThe *catapult* is <script>ready</script>."
+
+    def setUp(self):
+        caches["markdown"].clear()
+        self.addCleanup(caches["markdown"].clear)
+
+    def test_renders_once(self):
+        """Each text is rendered once, with the same sanitized HTML as before."""
+
+        expected = utils.markdown_to_html(self.TEXT)
+        self.assertNotIn("<script>", expected)
+        with mock.patch.object(
+            utils, "markdown_to_html", wraps=utils.markdown_to_html
+        ) as render:
+            for _ in range(3):
+                self.assertEqual(markdown_to_safe_html(self.TEXT), expected)
+            markdown_to_safe_html("Something *else*")
+        self.assertEqual(render.call_count, 2)
+
+    def test_renderer_version(self):
+        """A new renderer version renders the text again."""
+
+        with mock.patch.object(utils, "markdown_to_html", return_value="old"):
+            utils.cached_markdown_to_html(self.TEXT)
+        with mock.patch.object(utils, "RENDERER_VERSION", "next"):
+            self.assertNotEqual(utils.cached_markdown_to_html(self.TEXT), "old")
+        self.assertEqual(utils.cached_markdown_to_html(self.TEXT), "old")
+
+
+class InboxServiceTestCase(SimpleTestCase):
+    """Tests for reading a box's inbox a page at a time."""
+
+    INBOX_URL = "http://postapi.example/postapi/boxes/mannie/inbox"
+
+    def get_inbox(self, page, cursor=None):
+        svc = PostService(None)
+        response = mock.Mock(ok=True, headers={"content-type": "application/json"})
+        response.json.return_value = page
+        svc.http = mock.Mock()
+        svc.http.get.return_value = response
+        result = svc.get_inbox(self.INBOX_URL, cursor)
+        svc.http.get.assert_called_once()
+        return result, svc.http.get.call_args
+
+    def test_one_page(self):
+        """Only the requested page is fetched, and the next page's cursor is returned."""
+
+        page = {"next": f"{self.INBOX_URL}?cursor=WzJd&page_size=2", "results": [1, 2]}
+        (dposts, cursor), call = self.get_inbox(page)
+        self.assertEqual(dposts, [1, 2])
+        self.assertEqual(cursor, "WzJd")
+        self.assertIsNone(call.kwargs["params"])
+
+        (dposts, cursor), call = self.get_inbox({"next": None, "results": [3]}, cursor)
+        self.assertEqual(dposts, [3])
+        self.assertIsNone(cursor)
+        self.assertEqual(call.kwargs["params"], {"cursor": "WzJd"})
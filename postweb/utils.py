@@ -1,10 +1,14 @@
+import hashlib
+import json
+
 import bleach
 from django.conf import settings
+from django.core.cache import caches
 import dateutil.parser
 import markdown
 
 
-markdown = markdown.Markdown()
+markdown_converter = markdown.Markdown()
 
 # Tags suitable for rendering markdown
 # From https://github.com/yourcelf/bleach-allowlist/blob/main/bleach_allowlist/bleach_allowlist.py
@@ -45,6 +49,16 @@ MARKDOWN_ATTRS = {
     "a": ["href", "alt", "title"],
 }
 
+# Identifies what markdown_to_html produces. Rendered HTML is cached under
+# this, so allowing other tags or attributes, or upgrading Markdown or
+# bleach, renders every body afresh.
+RENDERER_VERSION = hashlib.sha256(
+    json.dumps(
+        [MARKDOWN_TAGS, MARKDOWN_ATTRS, markdown.__version__, bleach.__version__],
+        sort_keys=True,
+    ).encode()
+).hexdigest()[:16]
+
 
 PREFERRED_DATE_FORMAT = "%a %b %d %Y %I:%M %p"
 
@@ -87,7 +101,24 @@ def markdown_to_html(markdown_text):
     """
 
     return bleach.clean(
-        markdown.convert(markdown_text),
+        markdown_converter.convert(markdown_text),
         tags=MARKDOWN_TAGS,
         attributes=MARKDOWN_ATTRS,
     )
+
+
+def cached_markdown_to_html(markdown_text):
+    """Converts Markdown to HTML, like markdown_to_html, rendering each text once.
+
+    Posts never change, and a broadcast's body is viewed by everyone it was
+    sent to, so the HTML is cached by the Markdown's digest.
+    """
+
+    digest = hashlib.sha256(markdown_text.encode()).hexdigest()
+    key = f"postweb:html:{RENDERER_VERSION}:{digest}"
+    cache = caches["markdown"]
+    html = cache.get(key)
+    if html is None:
+        html = markdown_to_html(markdown_text)
+        cache.set(key, html)
+    return html
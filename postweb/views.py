@@ -5,6 +5,7 @@ import re
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.urls import reverse
+from django.utils.http import urlencode
 from django.shortcuts import render, redirect
 
 from postweb.forms import SendMessageForm
@@ -48,8 +49,9 @@ def index(request):
     box_svc.sync(box["url"])
 
     post_svc = PostService(request)
-    dposts = [post_svc.get_delivered_post(post) for post in box["posts"]]
-    box_empty = len(dposts) == 0
+    cursor = request.GET.get("cursor")
+    dposts, next_cursor = post_svc.get_inbox(box["inbox"], cursor)
+    box_empty = len(dposts) == 0 and not cursor
 
     post_data = pprint_json(dposts)
     logger.debug(post_data)
@@ -59,11 +61,17 @@ def index(request):
     for dpost in dposts:
         dpost["detail_url"] = reverse("postweb:post-detail", kwargs={"pk": dpost["id"]})
 
+    index_url = reverse("postweb:index")
+    older_url = None
+    if next_cursor:
+        older_url = index_url + "?" + urlencode({"cursor": next_cursor})
     data = {
         "username": username,
         "box_created": box_created,
         "box_empty": box_empty,
         "posts": dposts,
+        "newest_url": index_url if cursor else None,
+        "older_url": older_url,
     }
 
     return render(request, "postweb/index.html", data)